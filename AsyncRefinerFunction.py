@@ -0,0 +1,353 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from RefinerFunction import (
+    RUN_COMPLETION_MODE,
+    RUN_TIMEOUT_SECONDS,
+    RUN_POLL_INITIAL_INTERVAL,
+    RUN_POLL_MAX_INTERVAL,
+    RUN_POLL_BACKOFF_FACTOR,
+    TERMINAL_RUN_STATUSES,
+    UploadRegistry,
+    upload_registry,
+    refinement_cache,
+    metrics_tracker,
+    llm_metrics,
+    get_run_measurements,
+    get_env_variable,
+    get_cache_key,
+    restore_cached_output,
+    get_test_file_path,
+    ensure_directory_structure,
+    extract_changes_summary,
+    build_fused_prompt,
+    log_modifications,
+    log_fused_summaries,
+    ChatReply,
+    build_chat_messages,
+    store_chat_output
+)
+from rate_limiter import start_retry_count, retry_count
+
+# Per-key locks so concurrent coroutines never upload the same bytes twice
+_upload_locks = {}
+
+
+def _read_bytes(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+async def upload_async(client, file_path):
+    """Return the file ID for file_path, uploading it only if these bytes were not uploaded yet."""
+    file_bytes = await asyncio.to_thread(_read_bytes, file_path)
+    file_name = os.path.basename(file_path)
+    key = UploadRegistry.make_key(file_bytes, file_name)
+    lock = _upload_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        file_id = upload_registry.lookup(key)
+        if file_id:
+            logging.info(f"Reusing uploaded file {file_id} for: {file_name}")
+            llm_metrics.record('upload', file_path, None, 'reused', upload_seconds=0.0, total_seconds=0.0)
+            return file_id
+        start_time = time.time()
+        try:
+            uploaded_file = await client.files.create(file=(file_name, file_bytes), purpose='assistants')
+        except Exception:
+            elapsed = time.time() - start_time
+            llm_metrics.record('upload', file_path, None, 'error', upload_seconds=elapsed, total_seconds=elapsed)
+            raise
+        elapsed = time.time() - start_time
+        llm_metrics.record('upload', file_path, None, 'uploaded', upload_seconds=elapsed, total_seconds=elapsed)
+        upload_registry.register(key, uploaded_file.id)
+        return uploaded_file.id
+
+
+async def cancel_run_async(client, thread_id, run_id):
+    """Cancel a run so it stops holding server-side capacity."""
+    try:
+        await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        logging.info(f"Cancelled run {run_id} on thread {thread_id}")
+    except Exception as e:
+        logging.warning(f"Failed to cancel run {run_id}: {e}")
+
+
+async def _find_latest_run_async(client, thread_id):
+    """Async counterpart of RefinerFunction._find_latest_run."""
+    try:
+        runs = await client.beta.threads.runs.list(thread_id=thread_id, limit=1, order='desc')
+        return runs.data[0] if runs.data else None
+    except Exception as e:
+        logging.warning(f"Unable to look up the run on thread {thread_id}: {e}")
+        return None
+
+
+async def _stream_run_async(client, thread_id, assistant_id, deadline):
+    """Create a run with streaming enabled and follow its events until a terminal state or the deadline."""
+    run = None
+    stream = await client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id, stream=True)
+    try:
+        async for event in stream:
+            if event.event.startswith('thread.run.') and not event.event.startswith('thread.run.step.'):
+                run = event.data
+                if run.status in TERMINAL_RUN_STATUSES:
+                    break
+            if time.time() >= deadline:
+                break
+    except Exception as e:
+        if run is None:
+            raise
+        logging.warning(f"Run event stream for {run.id} interrupted, continuing by polling: {e}")
+    finally:
+        await stream.close()
+    return run
+
+
+async def execute_run_async(client, thread_id, assistant_id, description, stats=None):
+    """Async counterpart of RefinerFunction.execute_run; waiting costs a suspended coroutine, not a thread."""
+    deadline = time.time() + RUN_TIMEOUT_SECONDS
+    run = None
+
+    if RUN_COMPLETION_MODE == 'stream':
+        try:
+            run = await _stream_run_async(client, thread_id, assistant_id, deadline)
+        except Exception as e:
+            logging.warning(f"Streaming unavailable for {description}, falling back to polling: {e}")
+        if run is None:
+            # The stream may have failed after the run was created; a second run would be rejected
+            # while that one is active, so it is polled instead
+            run = await _find_latest_run_async(client, thread_id)
+
+    if run is None:
+        run = await client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
+
+    interval = RUN_POLL_INITIAL_INTERVAL
+    while run.status not in TERMINAL_RUN_STATUSES:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * RUN_POLL_BACKOFF_FACTOR, RUN_POLL_MAX_INTERVAL)
+        run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        if stats is not None:
+            stats['poll_count'] = stats.get('poll_count', 0) + 1
+
+    if run.status not in TERMINAL_RUN_STATUSES:
+        logging.warning(f"Run {run.id} for {description} exceeded {RUN_TIMEOUT_SECONDS}s, cancelling it.")
+        await cancel_run_async(client, thread_id, run.id)
+    elif run.status == 'requires_action':
+        logging.warning(f"Run {run.id} for {description} requested an unsupported action, cancelling it.")
+        await cancel_run_async(client, thread_id, run.id)
+    elif run.status != 'completed':
+        logging.error(f"Run {run.id} for {description} ended with status '{run.status}': {getattr(run, 'last_error', None)}")
+
+    return run
+
+
+async def run_assistant_request_async(client, assistant, prompt, file_ids, description, operation='refine', source_path=None):
+    """Send a prompt with attached files on a new thread. Returns the messages as a dict, or None."""
+    start_time = time.time()
+    start_retry_count()
+    stats = {'poll_count': 0}
+    outcome = 'error'
+    run = None
+    try:
+        thread = await client.beta.threads.create(
+            messages=[{"role": "user", "content": prompt, "file_ids": file_ids}]
+        )
+        upload_registry.track_thread(thread.id)
+        run = await execute_run_async(client, thread.id, assistant.id, description, stats)
+        outcome = run.status if run.status in TERMINAL_RUN_STATUSES else 'timeout'
+        if run.status != 'completed':
+            logging.warning(f"Assistant request did not complete for {description} (status: {run.status})")
+            return None
+
+        messages = await client.beta.threads.messages.list(thread_id=thread.id)
+        return json.loads(messages.model_dump_json(indent=2))
+    finally:
+        measurements = get_run_measurements(run) if run is not None else {}
+        llm_metrics.record(
+            operation, source_path, assistant.model, outcome,
+            total_seconds=time.time() - start_time, poll_count=stats['poll_count'], retries=retry_count(), **measurements
+        )
+
+
+async def download_generated_file_async(client, data, target_path):
+    """Download the file the assistant shared in its latest message. Returns False if there is none."""
+    code = None
+    if data['data'] and data['data'][0]['content'] and data['data'][0]['content'][0]['text']['annotations']:
+        code = data['data'][0]['content'][0]['text']['annotations'][0]['file_path']['file_id']
+    if not code:
+        return False
+    upload_registry.track_generated_file(code)
+    content = await client.files.content(code)
+
+    def write():
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with open(target_path, 'wb') as f:
+            f.write(content.content)
+
+    await asyncio.to_thread(write)
+    return True
+
+
+def _record_output(data, target_path, cache_key):
+    """Track, log and cache a downloaded output; run in a worker thread since the cache copies files."""
+    metrics_tracker.track_file(target_path)
+    changes_summary, next_steps = extract_changes_summary(data)
+    log_modifications(os.path.basename(target_path), changes_summary, next_steps)
+    if cache_key:
+        refinement_cache.put(cache_key, target_path, changes_summary, next_steps)
+
+
+def _record_fused_output(data, prompts, target_path, cache_key):
+    """Fused-prompt counterpart of _record_output."""
+    metrics_tracker.track_file(target_path)
+    content = data['data'][0]['content'][0]['text']['value']
+    summaries = log_fused_summaries(content, prompts, os.path.basename(target_path))
+    if cache_key:
+        refinement_cache.put(cache_key, target_path, *summaries[0], summaries=summaries)
+
+
+async def create_unit_test_file_async(client, assistant, file_path, test_file_directory):
+    """Async counterpart of create_unit_test_files for a single file. Returns False if the test could not be generated."""
+    prompt_testcase = get_env_variable('PROMPT_GENERATE_TESTCASES', is_required=False)
+    if not prompt_testcase or ", " not in prompt_testcase:
+        logging.warning("Unit test case prompt not found or incorrectly formatted in .env.")
+        return True
+    prompt, toggle = prompt_testcase.rsplit(", ", 1)
+    if toggle.strip().lower() != 'y':
+        return True
+
+    file_name = os.path.basename(file_path)
+    base_name, ext = os.path.splitext(file_name)
+    if 'test' in base_name.lower():
+        logging.info(f"Skipping test file: {file_path}")
+        return True
+
+    test_file_path = get_test_file_path(file_path, test_file_directory)
+    ensure_directory_structure(os.path.dirname(test_file_path))
+    if os.path.exists(test_file_path):
+        logging.info(f"Test file already exists: {test_file_path}")
+        return True
+
+    try:
+        prompt_formatted = prompt.format(file_extension=ext, file_name=file_name)
+        # Hashing the source and restoring cached outputs read and copy files, so they run off the event loop
+        cache_key = await asyncio.to_thread(get_cache_key, file_path, prompt_formatted, assistant)
+        if await asyncio.to_thread(restore_cached_output, cache_key, test_file_path):
+            return True
+
+        file_id = await upload_async(client, file_path)
+        data = await run_assistant_request_async(
+            client, assistant, prompt_formatted, [file_id], f"unit test creation for {file_name}",
+            operation='unit_test', source_path=file_path
+        )
+        if data is None:
+            return False
+
+        if await download_generated_file_async(client, data, test_file_path):
+            await asyncio.to_thread(_record_output, data, test_file_path, cache_key)
+            logging.info(f"Unit test file created: {test_file_path}")
+            return True
+        logging.error(f"Failed to create unit test for file: {file_path}")
+        return False
+    except Exception as e:
+        logging.error(f"Error processing file {file_name} for unit test: {e}")
+        return False
+
+
+async def apply_green_prompts_async(client, assistant, file_id, prompt, refined_file_path, cache_key=None):
+    """Async counterpart of apply_green_prompts."""
+    logging.info(f"Applying prompt: {prompt} to file {file_id}")
+    try:
+        data = await run_assistant_request_async(
+            client, assistant, prompt, [file_id], f"file {file_id}", operation='refine', source_path=refined_file_path
+        )
+        if data is None:
+            return False
+        if not await download_generated_file_async(client, data, refined_file_path):
+            logging.error(f"No code found in response for prompt: {prompt} and file {file_id}")
+            return False
+
+        await asyncio.to_thread(_record_output, data, refined_file_path, cache_key)
+        logging.info(f"File refined successfully with prompt: {prompt}")
+        return True
+    except Exception as e:
+        logging.error(f"Exception occurred while applying prompt '{prompt}' to file {file_id}: {e}")
+        return False
+
+
+async def apply_fused_prompts_async(client, assistant, file_id, prompts, refined_file_path, cache_key=None):
+    """Async counterpart of apply_fused_prompts."""
+    logging.info(f"Applying {len(prompts)} fused prompts to file {file_id}")
+    try:
+        data = await run_assistant_request_async(
+            client, assistant, build_fused_prompt(prompts), [file_id], f"file {file_id}",
+            operation='refine_fused', source_path=refined_file_path
+        )
+        if data is None:
+            return False
+        if not await download_generated_file_async(client, data, refined_file_path):
+            logging.error(f"No code found in fused response for file {file_id}")
+            return False
+
+        await asyncio.to_thread(_record_fused_output, data, prompts, refined_file_path, cache_key)
+        logging.info(f"File refined successfully with {len(prompts)} fused prompts")
+        return True
+    except Exception as e:
+        logging.error(f"Exception occurred while applying fused prompts to file {file_id}: {e}")
+        return False
+
+
+async def run_chat_request_async(client, refiner, prompt, code_path, description, operation='refine', source_path=None):
+    """Async counterpart of run_chat_request. Returns the streamed reply text, or None."""
+    reply = ChatReply(build_chat_messages(refiner, prompt, code_path))
+    try:
+        stream = await client.chat.completions.create(
+            model=refiner.model, messages=reply.messages, stream=True, timeout=RUN_TIMEOUT_SECONDS
+        )
+        async for chunk in stream:
+            reply.add(chunk)
+        if reply.finish_reason != 'stop':
+            logging.warning(f"Chat request did not complete for {description} (finish reason: {reply.finish_reason})")
+            return None
+        return reply.text
+    except Exception as e:
+        logging.error(f"Chat request failed for {description}: {e}")
+        return None
+    finally:
+        llm_metrics.record(
+            f"{operation}_chat", source_path or code_path, refiner.model,
+            reply.outcome if reply.finish_reason else 'error', **reply.measurements()
+        )
+
+
+async def apply_green_prompts_chat_async(client, refiner, file_path, prompt, refined_file_path, cache_key=None):
+    """Async counterpart of apply_green_prompts_chat."""
+    logging.info(f"Applying prompt through chat completions: {prompt} to file {os.path.basename(file_path)}")
+    try:
+        content = await run_chat_request_async(
+            client, refiner, prompt, file_path, f"file {os.path.basename(file_path)}", operation='refine'
+        )
+        return content is not None and await asyncio.to_thread(store_chat_output, content, [prompt], refined_file_path, cache_key)
+    except Exception as e:
+        logging.error(f"Exception occurred while applying prompt '{prompt}' to file {file_path}: {e}")
+        return False
+
+
+async def apply_fused_prompts_chat_async(client, refiner, file_path, prompts, refined_file_path, cache_key=None):
+    """Async counterpart of apply_fused_prompts_chat."""
+    logging.info(f"Applying {len(prompts)} fused prompts through chat completions to file {os.path.basename(file_path)}")
+    try:
+        content = await run_chat_request_async(
+            client, refiner, build_fused_prompt(prompts), file_path, f"file {os.path.basename(file_path)}",
+            operation='refine_fused'
+        )
+        return content is not None and await asyncio.to_thread(store_chat_output, content, prompts, refined_file_path, cache_key)
+    except Exception as e:
+        logging.error(f"Exception occurred while applying fused prompts to file {file_path}: {e}")
+        return False
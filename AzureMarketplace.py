@@ -1,7 +1,6 @@
 import os
 import json
 import dotenv
-import uuid
 import time
 import shutil
 import logging
@@ -29,16 +28,25 @@ load_dotenv(dotenv_path=env_path, verbose=True, override=True)
 # Import functions from RefinerFunction.py
 from RefinerFunction import (
     get_env_variable,
+    get_int_env_variable,
     check_azure_subscription,
     remove_directory,
     ensure_directory_structure,
     identify_source_files,
+    GENERATED_DIRECTORIES,
     load_prompts_from_env,
     create_unit_test_files,
     apply_green_prompts,
+    get_or_create_assistant,
+    upload_registry,
+    create_http_client,
+    cleanup_run_resources,
     MetricsTracker,
+    llm_metrics,
     finalize_processing
 )
+from code_validator import validate_source
+from refinement_scheduler import rank_files, RefinementBudget
 
 # Initialize AzureOpenAI client using environment variables
 try:
@@ -52,13 +60,17 @@ try:
     
     MODEL_NAME = os.getenv('AZURE_MODEL')
     EXCLUDED_FILES = [file.strip() for file in os.getenv('EXCLUDED_FILES', '').split(',') if file.strip()]
+    # Directories pruned during discovery, on top of the generated output directories
+    EXCLUDED_DIRECTORIES = [d.strip() for d in os.getenv('EXCLUDED_DIRECTORIES', '').split(',') if d.strip()]
     FILE_EXTENSIONS_ENV = os.getenv('FILE_EXTENSIONS')
     FILE_EXTENSIONS = ast.literal_eval(FILE_EXTENSIONS_ENV)
     
     client = AzureOpenAI(
         api_key=api_key,
         api_version=api_version,
-        azure_endpoint=azure_endpoint
+        azure_endpoint=azure_endpoint,
+        http_client=create_http_client(),
+        max_retries=0
     )
     logging.info("AzureOpenAI client initialized successfully.")
 except EnvironmentError as e:
@@ -81,12 +93,11 @@ logging.info(f"Directory '{green_code_directory}' created successfully!")
 for directory in [temp_directory, test_file_directory, green_test_file_directory]:
     ensure_directory_structure(directory)
 
-unique_name = f"GreenCodeRefiner {uuid.uuid4()}"
-
-# Create an assistant
+# Reuse the assistant from earlier runs unless its configuration changed
 try:
-    assistant = client.beta.assistants.create(
-        name=unique_name,
+    assistant = get_or_create_assistant(
+        client,
+        "GreenCodeRefiner Marketplace",
         instructions=(
             "You are a helpful AI assistant who refactors the code from an uploaded file to make it more efficient. "
             "1. Re-write the code in the same language as the original code. "
@@ -98,7 +109,6 @@ try:
         model=MODEL_NAME,
         tools=[{"type": "code_interpreter"}]
     )
-    logging.info(f"Assistant '{unique_name}' created successfully.")
 except Exception as e:
     logging.critical(f"Failed to create Azure OpenAI assistant: {e}")
     raise
@@ -109,14 +119,25 @@ prompts = load_prompts_from_env()
 metrics_tracker = MetricsTracker()
 processing_start_time = time.time()
 
-# Get initial file list
-file_list = list(identify_source_files(source_directory, FILE_EXTENSIONS, EXCLUDED_FILES))
+# Get initial file list, highest expected energy savings first
+file_list = [candidate.path for candidate in rank_files(
+    identify_source_files(source_directory, FILE_EXTENSIONS, EXCLUDED_FILES,
+                          EXCLUDED_DIRECTORIES + list(GENERATED_DIRECTORIES)),
+    os.path.join(source_directory, 'Result', 'main_before_emissions_data.csv')
+)]
 processed_files = 0
-MAX_FILES = 2  # Set your desired file limit here
+MAX_FILES = get_int_env_variable('MARKETPLACE_MAX_FILES', 2)  # Trial file limit
+VALIDATE_REFINED_CODE = (os.getenv('VALIDATE_REFINED_CODE') or 'y').strip().lower() == 'y'
+VALIDATION_TIMEOUT_SECONDS = max(1, get_int_env_variable('VALIDATION_TIMEOUT_SECONDS', 60))
+budget = RefinementBudget(
+    get_int_env_variable('REFINER_TIME_BUDGET_MINUTES', 0),
+    get_int_env_variable('REFINER_TOKEN_BUDGET', 0),
+    llm_metrics.total_tokens
+)
 
 # Process files sequentially with limit
 for file_path in file_list:
-    if processed_files >= MAX_FILES:
+    if processed_files >= MAX_FILES or budget.exhausted():
         break
         
     relative_path = os.path.relpath(file_path, source_directory)
@@ -138,8 +159,7 @@ for file_path in file_list:
         create_unit_test_files(client, assistant, [file_path], test_file_directory)
         
         # Step 2: Refine the file
-        with open(file_path, "rb") as file:
-            uploaded_file = client.files.create(file=file, purpose='assistants')
+        uploaded_file_id = upload_registry.upload(client, file_path)
         
         refined_temp_file_path = os.path.join(temp_directory, file_name)
         ensure_directory_structure(os.path.dirname(refined_temp_file_path))
@@ -147,10 +167,17 @@ for file_path in file_list:
         # Apply prompts
         refined_success = False
         for prompt in prompts:
-            if apply_green_prompts(client, assistant, uploaded_file.id, prompt, refined_temp_file_path):
+            if apply_green_prompts(client, assistant, uploaded_file_id, prompt, refined_temp_file_path):
                 refined_success = True
                 logging.info(f"Successfully applied prompt: '{prompt}' to {file_name}")
         
+        # Invalid refinements never reach GreenCode
+        if refined_success and VALIDATE_REFINED_CODE:
+            validation = validate_source(refined_temp_file_path, file_path, VALIDATION_TIMEOUT_SECONDS)
+            if not validation.ok:
+                logging.warning(f"Refined {file_name} failed {validation.checker} validation: {validation.message}")
+                refined_success = False
+        
         if not refined_success:
             shutil.copy2(file_path, refined_temp_file_path)
             logging.warning(f"Using original file as fallback for: {file_name}")
@@ -180,6 +207,9 @@ for file_path in file_list:
         shutil.copy2(file_path, final_file_path)
         logging.warning(f"Copied original file as fallback due to error: {final_file_path}")
 
+# Delete this run's uploads and threads in the background while the overview is written
+cleanup_run_resources(client)
+
 # Generate final overview
 finalize_processing()
 
@@ -1,15 +1,16 @@
 import os
 import json
 import dotenv
-import uuid
 import time
 import shutil
 import logging
 import requests 
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI
 import ast
 import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,19 +26,60 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 env_path = os.path.abspath(".env")
 load_dotenv(dotenv_path=env_path, verbose=True, override=True)
 
+# --dry-run only estimates the LLM calls, tokens, time and cost of a run, then exits
+DRY_RUN = '--dry-run' in sys.argv[1:]
+
 # Import functions from refiner_functions.py
 from RefinerFunction import (
     get_env_variable,
+    get_int_env_variable,
+    get_float_env_variable,
     check_azure_subscription,
     remove_directory,
     ensure_directory_structure,
     identify_source_files,
+    GENERATED_DIRECTORIES,
     load_prompts_from_env,
     create_unit_test_files,
     apply_green_prompts,
-    MetricsTracker,
+    apply_fused_prompts,
+    apply_green_prompts_chat,
+    apply_fused_prompts_chat,
+    ChatRefiner,
+    build_fused_prompt,
+    get_or_create_assistant,
+    apply_green_prompts_packed,
+    pack_small_files,
+    refine_file_in_chunks,
+    CHUNK_MAX_CHARS,
+    get_cache_key,
+    restore_cached_output,
+    refinement_cache,
+    get_test_file_path,
+    upload_registry,
+    create_http_client,
+    create_async_http_client,
+    cleanup_run_resources,
+    metrics_tracker,
+    llm_metrics,
     finalize_processing
 )
+from git_incremental import get_incremental_changes, save_refinement_state
+from refinement_scheduler import rank_files, RefinementBudget
+from model_router import ModelRouter
+from code_validator import validate_source, build_fix_prompt
+from dry_run_estimator import LatencyHistory, estimate_run, write_dry_run_report
+from token_counter import Tokenizer
+from refinement_pipeline import PipelineStage, run_pipeline
+from refinement_journal import RefinementJournal, STAGE_SOURCE_TESTS, STAGE_REFINED, STAGE_REFINED_TESTS
+from AsyncRefinerFunction import (
+    upload_async,
+    create_unit_test_file_async,
+    apply_green_prompts_async,
+    apply_fused_prompts_async,
+    apply_green_prompts_chat_async,
+    apply_fused_prompts_chat_async
+)
 
 # Initialize AzureOpenAI client using environment variables
 try:
@@ -46,20 +88,24 @@ try:
     azure_endpoint = get_env_variable('AZURE_ENDPOINT')
     
     # Check Azure subscription availability using the values from the .env file
-    if not check_azure_subscription(api_key, azure_endpoint, api_version):
+    if not DRY_RUN and not check_azure_subscription(api_key, azure_endpoint, api_version):
         raise EnvironmentError("Azure subscription is unavailable. Please verify your subscription status.")
     
     # Get the relevent information from .env
     MODEL_NAME = os.getenv('AZURE_MODEL')
     # Parse EXCLUDED_FILES as a list, stripping any surrounding whitespace
     EXCLUDED_FILES = [file.strip() for file in os.getenv('EXCLUDED_FILES', '').split(',') if file.strip()]
+    # Directories pruned during discovery, on top of the generated output directories
+    EXCLUDED_DIRECTORIES = [d.strip() for d in os.getenv('EXCLUDED_DIRECTORIES', '').split(',') if d.strip()]
     FILE_EXTENSIONS_ENV = os.getenv('FILE_EXTENSIONS')
     FILE_EXTENSIONS = ast.literal_eval(FILE_EXTENSIONS_ENV)
     
     client = AzureOpenAI(
         api_key=api_key,
         api_version=api_version,
-        azure_endpoint=azure_endpoint
+        azure_endpoint=azure_endpoint,
+        http_client=create_http_client(),
+        max_retries=0
     )
     logging.info("AzureOpenAI client initialized successfully.")
 except EnvironmentError as e:
@@ -73,20 +119,135 @@ temp_directory = os.path.join(green_code_directory, 'temp')
 test_file_directory = os.path.join(source_directory, 'SRC-TestSuite')
 green_test_file_directory = os.path.join(green_code_directory, 'GreenCode-TestSuite')
 
-# Create fresh directories
-remove_directory(green_code_directory)
-os.makedirs(green_code_directory, exist_ok=True)
-logging.info(f"Directory '{green_code_directory}' created successfully!")
+# Incremental mode only refines files added or modified since the last run, and the files it failed to refine
+INCREMENTAL_REFINEMENT = (os.getenv('INCREMENTAL_REFINEMENT') or 'n').strip().lower() == 'y'
+refinement_state_path = os.path.join(source_directory, 'Result', 'incremental_state.json')
+incremental_excluded_dirs = EXCLUDED_DIRECTORIES + list(GENERATED_DIRECTORIES) + ['Result']
+incremental_changes = (
+    get_incremental_changes(source_directory, refinement_state_path, incremental_excluded_dirs)
+    if INCREMENTAL_REFINEMENT else None
+)
+# Files whose refinement failed and fell back to the original; incremental mode retries them next run
+failed_files = set()
+
+# Load prompts
+prompts = load_prompts_from_env()
+
+# Fused mode sends all enabled prompts to the model as one combined request per file
+FUSE_PROMPTS = (os.getenv('FUSE_PROMPTS') or 'n').strip().lower() == 'y' and len(prompts) > 1
+request_prompts = [build_fused_prompt(prompts)] if FUSE_PROMPTS else prompts
+
+# Refined files must parse or compile before they enter GreenCode; failures are re-prompted, then fall back
+VALIDATE_REFINED_CODE = (os.getenv('VALIDATE_REFINED_CODE') or 'y').strip().lower() == 'y'
+VALIDATION_MAX_REPROMPTS = max(0, get_int_env_variable('VALIDATION_MAX_REPROMPTS', 1))
+VALIDATION_TIMEOUT_SECONDS = max(1, get_int_env_variable('VALIDATION_TIMEOUT_SECONDS', 60))
+
+# Number of files refined concurrently (1 keeps the original sequential behaviour)
+REFINER_MAX_WORKERS = max(1, get_int_env_variable('REFINER_MAX_WORKERS', 1))
+
+# 'threads' runs work items on a thread pool, 'async' runs files as coroutines on AsyncAzureOpenAI,
+# 'pipeline' runs each step as its own stage with bounded queues in between
+REFINER_ENGINE = (os.getenv('REFINER_ENGINE') or 'threads').strip().lower()
+REFINER_MAX_IN_FLIGHT = max(1, get_int_env_variable('REFINER_MAX_IN_FLIGHT', 16))
+PIPELINE_QUEUE_SIZE = max(1, get_int_env_variable('PIPELINE_QUEUE_SIZE', 8))
+PIPELINE_SOURCE_TEST_WORKERS = max(1, get_int_env_variable('PIPELINE_SOURCE_TEST_WORKERS', 2))
+PIPELINE_REFINE_WORKERS = max(1, get_int_env_variable('PIPELINE_REFINE_WORKERS', 4))
+PIPELINE_REFINED_TEST_WORKERS = max(1, get_int_env_variable('PIPELINE_REFINED_TEST_WORKERS', 2))
+
+# 'assistants' refines through Assistants threads with code_interpreter; 'chat' streams chat completions with the
+# source inline, skipping the upload, the sandbox run and the download. Unit tests always use the assistant
+REFINEMENT_API = (os.getenv('REFINEMENT_API') or 'assistants').strip().lower()
+
+file_list = list(identify_source_files(
+    source_directory, FILE_EXTENSIONS, EXCLUDED_FILES, EXCLUDED_DIRECTORIES + list(GENERATED_DIRECTORIES)
+))
+if incremental_changes is not None:
+    file_list = [path for path in file_list if os.path.normpath(os.path.abspath(path)) in incremental_changes.changed]
+    logging.info(f"Incremental mode: {len(file_list)} files selected for refinement")
+
+# Dry run: report the estimate for the selected files before any output directory or assistant is touched
+if DRY_RUN:
+    test_prompt, _, test_toggle = (get_env_variable('PROMPT_GENERATE_TESTCASES', is_required=False) or '').rpartition(', ')
+    dry_run_packs = []
+    if (REFINER_ENGINE == 'threads' and REFINEMENT_API != 'chat'
+            and (os.getenv('PACK_SMALL_FILES') or 'n').strip().lower() == 'y'):
+        dry_run_packs, _ = pack_small_files(
+            file_list,
+            get_int_env_variable('PACK_MAX_FILE_BYTES', 2048),
+            get_int_env_variable('PACK_TOKEN_BUDGET', 6000)
+        )
+    latency_history = LatencyHistory.load(os.path.join(source_directory, 'Result'))
+    tokenizer = Tokenizer()
+    estimates = estimate_run(
+        file_list, source_directory, request_prompts, FUSE_PROMPTS,
+        generate_tests=test_toggle.strip().lower() == 'y', test_prompt=test_prompt,
+        chunk_max_chars=CHUNK_MAX_CHARS, packs=dry_run_packs, history=latency_history, tokenizer=tokenizer,
+        pack_prompts=prompts
+    )
+    write_dry_run_report(
+        estimates,
+        os.path.join(source_directory, 'Result', 'dry_run_estimate.csv'),
+        concurrency={'async': REFINER_MAX_IN_FLIGHT, 'pipeline': PIPELINE_REFINE_WORKERS}.get(REFINER_ENGINE, REFINER_MAX_WORKERS),
+        prompt_cost_per_1k=get_float_env_variable('LLM_PROMPT_COST_PER_1K', 0.0),
+        completion_cost_per_1k=get_float_env_variable('LLM_COMPLETION_COST_PER_1K', 0.0),
+        requests_per_minute=get_int_env_variable('AZURE_REQUESTS_PER_MINUTE', 0),
+        tokens_per_minute=get_int_env_variable('AZURE_TOKENS_PER_MINUTE', 0),
+        token_budget=get_int_env_variable('REFINER_TOKEN_BUDGET', 0),
+        history=latency_history,
+        tokenizer=tokenizer
+    )
+    sys.exit(0)
+
+def discard_generated_outputs(file_path):
+    """Remove the GreenCode copy and generated tests of a source file so they are regenerated."""
+    final_file_path = os.path.join(green_code_directory, os.path.relpath(file_path, source_directory))
+    for output_path in (final_file_path,
+                        get_test_file_path(file_path, test_file_directory),
+                        get_test_file_path(final_file_path, green_test_file_directory)):
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+            logging.info(f"Removed stale output: {output_path}")
+
+# Journal of per-file stage completion; a run that died part-way is resumed instead of restarted
+RESUME_INTERRUPTED_RUN = (os.getenv('RESUME_INTERRUPTED_RUN') or 'y').strip().lower() == 'y'
+journal = RefinementJournal(os.path.join(source_directory, 'Result', 'refinement_journal.jsonl'), source_directory)
+resuming = RESUME_INTERRUPTED_RUN and journal.resuming
+if journal.resuming and not resuming:
+    journal.complete()
+
+if resuming:
+    # Keep everything the interrupted run produced; only its half-written temp files are dropped
+    remove_directory(temp_directory)
+    logging.info(f"Resuming interrupted run from journal: {journal.journal_path}")
+elif incremental_changes is None:
+    # Create fresh directories
+    remove_directory(green_code_directory)
+    os.makedirs(green_code_directory, exist_ok=True)
+    logging.info(f"Directory '{green_code_directory}' created successfully!")
+else:
+    # Carry forward outputs of unchanged files; only changed or deleted files lose theirs
+    remove_directory(temp_directory)
+    for stale_path in incremental_changes.changed | incremental_changes.deleted:
+        discard_generated_outputs(stale_path)
 
 # Ensure all required directories exist
 for directory in [temp_directory, test_file_directory, green_test_file_directory]:
     ensure_directory_structure(directory)
 
-# Create assistant
-unique_name = f"GreenCodeRefiner {uuid.uuid4()}"
+# Small, simple files can go to a faster deployment (AZURE_MODEL_SMALL); the rest stay on AZURE_MODEL
+model_router = ModelRouter(
+    MODEL_NAME,
+    (os.getenv('AZURE_MODEL_SMALL') or '').strip(),
+    get_int_env_variable('ROUTING_MAX_SMALL_TOKENS', 1500),
+    get_int_env_variable('ROUTING_MAX_SMALL_COMPLEXITY', 10),
+    os.path.join(source_directory, 'Result')
+)
+
+# Reuse the assistants from earlier runs unless their configuration changed; one per routed deployment
 try:
-    assistant = client.beta.assistants.create(
-        name=unique_name,
+    assistants = {model: get_or_create_assistant(
+        client,
+        "GreenCodeRefiner",
         instructions=(
             "You are a helpful AI assistant who refactors the code from an uploaded file to make it more efficient. "
             "1. Re-write the code in the same language as the original code. "
@@ -99,25 +260,44 @@ try:
             "   b) Next steps for improvement between NEXT_STEPS_START and NEXT_STEPS_END markers "
             "   Both summaries should be concise, single-line bullet points."
         ),
-        model=MODEL_NAME,
+        model=model,
         tools=[{"type": "code_interpreter"}]
-    )
-    logging.info(f"Assistant '{unique_name}' created successfully.")
+    ) for model in model_router.models}
 except Exception as e:
     logging.critical(f"Failed to create Azure OpenAI assistant: {e}")
     raise
 
-# Load prompts
-prompts = load_prompts_from_env()
+def assistant_for(file_path):
+    """Return the assistant of the deployment the file is routed to."""
+    return assistants[model_router.route(file_path).model]
+
+# Chat completions need no server-side assistant, only the deployment and the system prompt
+refiners = {model: ChatRefiner(model) for model in model_router.models} if REFINEMENT_API == 'chat' else assistants
+
+def refiner_for(file_path):
+    """Return the assistant, or its chat completions stand-in, that refines the file."""
+    return refiners[model_router.route(file_path).model]
 
-# Initialize metrics tracker at the start
-metrics_tracker = MetricsTracker()
 processing_start_time = time.time()
 
-# Process each file sequentially through all steps
-file_list = list(identify_source_files(source_directory, FILE_EXTENSIONS, EXCLUDED_FILES))
+# Count the time the interrupted attempts spent, so Total Time covers the whole run
+if resuming:
+    metrics_tracker.start_time -= journal.previous_seconds
+journal.start_run()
+
+# Refine the files expected to save the most energy first, within the configured budgets
+file_list = [candidate.path for candidate in rank_files(
+    file_list, os.path.join(source_directory, 'Result', 'main_before_emissions_data.csv')
+)]
+file_rank = {file_path: rank for rank, file_path in enumerate(file_list)}
+budget = RefinementBudget(
+    get_int_env_variable('REFINER_TIME_BUDGET_MINUTES', 0),
+    get_int_env_variable('REFINER_TOKEN_BUDGET', 0),
+    llm_metrics.total_tokens
+)
 
-for file_path in file_list:
+def should_skip_file(file_path):
+    """Return True for excluded, generated or empty files."""
     relative_path = os.path.relpath(file_path, source_directory)
     file_name = os.path.basename(file_path)
     
@@ -125,58 +305,407 @@ for file_path in file_list:
     if (file_name in EXCLUDED_FILES or 
         any(dir_name in relative_path for dir_name in ['GreenCode', 'SRC-TestSuite', 'GreenCode-TestSuite'])):
         logging.info(f"Skipping excluded file or directory: {relative_path}")
-        continue
+        return True
     
     # Skip empty files
     if os.path.getsize(file_path) == 0:
         logging.info(f"Skipping empty file: {file_path}")
-        continue
+        return True
     
-    try:
-        # Step 1: Create unit test for the source file
-        create_unit_test_files(client, assistant, [file_path], test_file_directory)
-        
-        # Step 2: Refine the file and move to GreenCode
-        with open(file_path, "rb") as file:
-            uploaded_file = client.files.create(file=file, purpose='assistants')
-        
-        refined_temp_file_path = os.path.join(temp_directory, file_name)
-        ensure_directory_structure(os.path.dirname(refined_temp_file_path))
-        
-        refined_success = False
-        for prompt in prompts:
-            if apply_green_prompts(client, assistant, uploaded_file.id, prompt, refined_temp_file_path):
-                refined_success = True
-                logging.info(f"Successfully applied prompt: '{prompt}' to {file_name}")
+    return False
+
+def get_refined_temp_file_path(file_path):
+    """Mirror the relative path inside temp so same-named files never collide between workers."""
+    refined_temp_file_path = os.path.join(temp_directory, os.path.relpath(file_path, source_directory))
+    ensure_directory_structure(os.path.dirname(refined_temp_file_path))
+    return refined_temp_file_path
+
+def get_file_prompts(validation=None):
+    """Return (prompts, request prompts), asking the model to fix the errors of a failed validation if given."""
+    if validation is None:
+        return prompts, request_prompts
+    fix_prompts = [build_fix_prompt(prompt, validation) for prompt in prompts]
+    return fix_prompts, ([build_fused_prompt(fix_prompts)] if FUSE_PROMPTS else fix_prompts)
+
+def refine_file(file_path, refined_temp_file_path, validation=None):
+    """Apply every enabled prompt to a single file. Returns True if any prompt succeeded."""
+    file_name = os.path.basename(file_path)
+    file_prompts, file_request_prompts = get_file_prompts(validation)
+    refiner = refiner_for(file_path)
+    uploaded_file_id = None
+    refined_success = False
+    for prompt in file_request_prompts:
+        cache_key = get_cache_key(file_path, prompt, refiner)
+        if restore_cached_output(cache_key, refined_temp_file_path):
+            refined_success = True
+            continue
+        # Large files are refined chunk by chunk; None means the file is sent whole
+        chunked_success = refine_file_in_chunks(client, refiner, file_path, prompt, refined_temp_file_path, cache_key)
+        if chunked_success is not None:
+            refined_success = refined_success or chunked_success
+            continue
+        if REFINEMENT_API == 'chat':
+            if FUSE_PROMPTS:
+                applied = apply_fused_prompts_chat(client, refiner, file_path, file_prompts, refined_temp_file_path, cache_key)
             else:
-                logging.warning(f"Failed to apply prompt: '{prompt}' to {file_name}")
-        
-        if not refined_success:
-            shutil.copy2(file_path, refined_temp_file_path)
-            logging.warning(f"Using original file as fallback for: {file_name}")
-        
-        final_file_path = os.path.join(green_code_directory, relative_path)
-        ensure_directory_structure(os.path.dirname(final_file_path))
-        
-        if os.path.exists(refined_temp_file_path):
-            shutil.move(refined_temp_file_path, final_file_path)
-            logging.info(f"File moved to final location: {final_file_path}")
+                applied = apply_green_prompts_chat(client, refiner, file_path, prompt, refined_temp_file_path, cache_key)
         else:
-            logging.error(f"Temp file not found: {refined_temp_file_path}")
-            shutil.copy2(file_path, final_file_path)
-            logging.warning(f"Copied original file as fallback to: {final_file_path}")
-        
-        # Step 3: Create unit test for the refined file
-        create_unit_test_files(client, assistant, [final_file_path], green_test_file_directory)
+            # Upload lazily so files fully served from the cache never hit the API
+            if uploaded_file_id is None:
+                uploaded_file_id = upload_registry.upload(client, file_path)
+            if FUSE_PROMPTS:
+                applied = apply_fused_prompts(client, refiner, uploaded_file_id, file_prompts, refined_temp_file_path, cache_key)
+            else:
+                applied = apply_green_prompts(client, refiner, uploaded_file_id, prompt, refined_temp_file_path, cache_key)
+        if applied:
+            refined_success = True
+            logging.info(f"Successfully applied prompt: '{prompt}' to {file_name}")
+        else:
+            logging.warning(f"Failed to apply prompt: '{prompt}' to {file_name}")
+    return refined_success
+
+def discard_invalid_output(file_path, file_name, validation, previous_validation):
+    """Drop the cached copies of an invalid refinement so later runs ask the model again."""
+    # A packed request may have cached it unfused and under another deployment than the file's own
+    file_prompts, file_request_prompts = get_file_prompts(previous_validation)
+    for prompt in dict.fromkeys(file_request_prompts + file_prompts):
+        for routed_refiner in refiners.values():
+            refinement_cache.discard(get_cache_key(file_path, prompt, routed_refiner))
+    logging.warning(f"Refined {file_name} failed {validation.checker} validation: {validation.message}")
+
+def validate_refined_file(file_path, refined_temp_file_path):
+    """
+    Check that the refined file parses or compiles before it enters GreenCode. A failing file is
+    re-prompted with its errors up to VALIDATION_MAX_REPROMPTS times; returns False if it stays invalid.
+    """
+    if not VALIDATE_REFINED_CODE:
+        return True
+    file_name = os.path.basename(file_path)
+    previous_validation = None
+    for attempt in range(VALIDATION_MAX_REPROMPTS + 1):
+        validation = validate_source(refined_temp_file_path, file_path, VALIDATION_TIMEOUT_SECONDS)
+        if validation.ok:
+            return True
+        discard_invalid_output(file_path, file_name, validation, previous_validation)
+        if attempt == VALIDATION_MAX_REPROMPTS or not refine_file(file_path, refined_temp_file_path, validation):
+            break
+        previous_validation = validation
+    logging.warning(f"Keeping the original {file_name}, its refinement did not pass validation")
+    return False
+
+def move_to_green_code(file_path, refined_temp_file_path, refined_success):
+    """Move the refined file into GreenCode, falling back to the original. Returns the final path."""
+    file_name = os.path.basename(file_path)
+    if not refined_success:
+        shutil.copy2(file_path, refined_temp_file_path)
+        logging.warning(f"Using original file as fallback for: {file_name}")
+    
+    final_file_path = os.path.join(green_code_directory, os.path.relpath(file_path, source_directory))
+    ensure_directory_structure(os.path.dirname(final_file_path))
+    
+    if os.path.exists(refined_temp_file_path):
+        shutil.move(refined_temp_file_path, final_file_path)
+        logging.info(f"File moved to final location: {final_file_path}")
+    else:
+        logging.error(f"Temp file not found: {refined_temp_file_path}")
+        shutil.copy2(file_path, final_file_path)
+        logging.warning(f"Copied original file as fallback to: {final_file_path}")
+    return final_file_path
+
+def copy_original_as_fallback(file_path, error):
+    """Copy the original file into GreenCode after an unexpected processing error."""
+    logging.error(f"Error processing file {os.path.basename(file_path)}: {error}")
+    failed_files.add(file_path)
+    final_file_path = os.path.join(green_code_directory, os.path.relpath(file_path, source_directory))
+    ensure_directory_structure(os.path.dirname(final_file_path))
+    shutil.copy2(file_path, final_file_path)
+    logging.warning(f"Copied original file as fallback due to error: {final_file_path}")
+
+def run_stage(file_path, stage, action, tracked_before=()):
+    """
+    Run one stage for a file unless the journal shows it finished before a restart.
+    The stage is journaled only when action() reports success, so failed stages are retried on resume.
+    """
+    if journal.skip_if_done(file_path, stage, metrics_tracker):
+        return True
+    with metrics_tracker.capture() as tracked:
+        completed = action()
+    if completed:
+        journal.mark_done(file_path, stage, list(tracked_before) + tracked)
+    return completed
+
+def refine_and_move(file_path, packed_success=False):
+    """Refine a file (unless a packed request already did) and move it to GreenCode. Returns True on success."""
+    final_file_path = os.path.join(green_code_directory, os.path.relpath(file_path, source_directory))
+    # Tests generated from an earlier version of the refined file would otherwise be kept
+    stale_test_path = get_test_file_path(final_file_path, green_test_file_directory)
+    if os.path.isfile(stale_test_path):
+        os.remove(stale_test_path)
+    refined_temp_file_path = get_refined_temp_file_path(file_path)
+    start_time = time.time()
+    refined_success = packed_success or refine_file(file_path, refined_temp_file_path)
+    refined_success = refined_success and validate_refined_file(file_path, refined_temp_file_path)
+    model_router.record(file_path, time.time() - start_time, refined_success)
+    move_to_green_code(file_path, refined_temp_file_path, refined_success)
+    if not refined_success:
+        failed_files.add(file_path)
+    return refined_success
+
+def generate_source_tests(file_path):
+    """Step 1: Create unit test for the source file."""
+    run_stage(file_path, STAGE_SOURCE_TESTS,
+              lambda: create_unit_test_files(client, assistant_for(file_path), [file_path], test_file_directory))
+    return file_path
+
+def refine_to_green_code(file_path):
+    """Step 2: Refine the file and move to GreenCode."""
+    run_stage(file_path, STAGE_REFINED, lambda: refine_and_move(file_path))
+    return file_path
+
+def generate_refined_tests(file_path):
+    """Step 3: Create unit test for the refined file."""
+    final_file_path = os.path.join(green_code_directory, os.path.relpath(file_path, source_directory))
+    run_stage(file_path, STAGE_REFINED_TESTS,
+              lambda: create_unit_test_files(client, assistant_for(file_path), [final_file_path], green_test_file_directory))
+    return file_path
+
+def process_file(file_path):
+    """Run a single file through unit test creation, refinement and refined test creation."""
+    if should_skip_file(file_path):
+        return
+    
+    try:
+        generate_source_tests(file_path)
+        refine_to_green_code(file_path)
+        generate_refined_tests(file_path)
+    except Exception as e:
+        copy_original_as_fallback(file_path, e)
+
+def process_pack(pack):
+    """Refine a group of small files with one request per prompt, then finish each file individually."""
+    pack = [file_path for file_path in pack if not should_skip_file(file_path)]
+    packed_refined = set()
+    packed_tracked = []
+    try:
+        for file_path in pack:
+            run_stage(file_path, STAGE_SOURCE_TESTS,
+                      lambda: create_unit_test_files(client, assistant_for(file_path), [file_path], test_file_directory))
         
+        pending = [file_path for file_path in pack if not journal.completed_entry(file_path, STAGE_REFINED)]
+        temp_paths = {file_path: get_refined_temp_file_path(file_path) for file_path in pending}
+        pack_assistant = assistants[model_router.route_group(pending)]
+        with metrics_tracker.capture() as packed_tracked:
+            # Packed replies carry one summary block per file, so packs always send the prompts unfused
+            for prompt in prompts:
+                entries = []
+                for file_path in pending:
+                    cache_key = get_cache_key(file_path, prompt, pack_assistant)
+                    if restore_cached_output(cache_key, temp_paths[file_path]):
+                        packed_refined.add(file_path)
+                        continue
+                    entries.append((upload_registry.upload(client, file_path), file_path, temp_paths[file_path], cache_key))
+                if entries:
+                    packed_refined |= apply_green_prompts_packed(client, pack_assistant, entries, prompt)
     except Exception as e:
-        logging.error(f"Error processing file {file_name}: {e}")
-        final_file_path = os.path.join(green_code_directory, relative_path)
-        ensure_directory_structure(os.path.dirname(final_file_path))
-        shutil.copy2(file_path, final_file_path)
-        logging.warning(f"Copied original file as fallback due to error: {final_file_path}")
+        logging.error(f"Error refining packed files, falling back to per-file processing: {e}")
+        packed_refined = set()
+    
+    for file_path in pack:
+        try:
+            # Files the packed request did not return are refined on their own
+            refined_temp_file_path = get_refined_temp_file_path(file_path)
+            run_stage(file_path, STAGE_REFINED,
+                      lambda: refine_and_move(file_path, file_path in packed_refined),
+                      [item for item in packed_tracked if item[0] == refined_temp_file_path])
+            final_file_path = os.path.join(green_code_directory, os.path.relpath(file_path, source_directory))
+            run_stage(file_path, STAGE_REFINED_TESTS,
+                      lambda: create_unit_test_files(client, assistant_for(file_path), [final_file_path], green_test_file_directory))
+        except Exception as e:
+            copy_original_as_fallback(file_path, e)
+
+# Small-file packing groups tiny files into a single refinement request up to a token budget
+# (assistants only: it relies on the assistant sharing several files in one reply)
+PACK_SMALL_FILES = (os.getenv('PACK_SMALL_FILES') or 'n').strip().lower() == 'y' and REFINEMENT_API != 'chat'
+if PACK_SMALL_FILES:
+    packs, single_files = pack_small_files(
+        file_list,
+        get_int_env_variable('PACK_MAX_FILE_BYTES', 2048),
+        get_int_env_variable('PACK_TOKEN_BUDGET', 6000)
+    )
+    logging.info(f"Packed {sum(len(pack) for pack in packs)} small files into {len(packs)} requests")
+    work_items = [(process_pack, pack) for pack in packs] + [(process_file, path) for path in single_files]
+    # Keep the impact order: a pack runs at the position of its highest-ranked file
+    work_items.sort(key=lambda item: min(file_rank[path] for path in item[1]) if isinstance(item[1], list) else file_rank[item[1]])
+else:
+    work_items = [(process_file, path) for path in file_list]
+
+def run_work_item(work_item):
+    handler, target = work_item
+    if budget.exhausted():
+        return
+    handler(target)
+
+async def refine_file_async(async_client, file_path, refined_temp_file_path, validation=None):
+    """Async counterpart of refine_file."""
+    file_name = os.path.basename(file_path)
+    file_prompts, file_request_prompts = get_file_prompts(validation)
+    refiner = refiner_for(file_path)
+    uploaded_file_id = None
+    refined_success = False
+    for prompt in file_request_prompts:
+        # Hashing the source and restoring cached outputs read and copy files, so they run off the event loop
+        cache_key = await asyncio.to_thread(get_cache_key, file_path, prompt, refiner)
+        if await asyncio.to_thread(restore_cached_output, cache_key, refined_temp_file_path):
+            refined_success = True
+            continue
+        # Chunked refinement keeps its own worker pool, so run it off the event loop
+        chunked_success = await asyncio.to_thread(
+            refine_file_in_chunks, client, refiner, file_path, prompt, refined_temp_file_path, cache_key
+        )
+        if chunked_success is not None:
+            refined_success = refined_success or chunked_success
+            continue
+        if REFINEMENT_API == 'chat':
+            if FUSE_PROMPTS:
+                applied = await apply_fused_prompts_chat_async(async_client, refiner, file_path, file_prompts, refined_temp_file_path, cache_key)
+            else:
+                applied = await apply_green_prompts_chat_async(async_client, refiner, file_path, prompt, refined_temp_file_path, cache_key)
+        else:
+            if uploaded_file_id is None:
+                uploaded_file_id = await upload_async(async_client, file_path)
+            if FUSE_PROMPTS:
+                applied = await apply_fused_prompts_async(async_client, refiner, uploaded_file_id, file_prompts, refined_temp_file_path, cache_key)
+            else:
+                applied = await apply_green_prompts_async(async_client, refiner, uploaded_file_id, prompt, refined_temp_file_path, cache_key)
+        if applied:
+            refined_success = True
+            logging.info(f"Successfully applied prompt: '{prompt}' to {file_name}")
+        else:
+            logging.warning(f"Failed to apply prompt: '{prompt}' to {file_name}")
+    return refined_success
+
+async def run_stage_async(file_path, stage, action):
+    """Async counterpart of run_stage; action is a coroutine function. Journal hashing and fsync run in a worker thread."""
+    if await asyncio.to_thread(journal.skip_if_done, file_path, stage, metrics_tracker):
+        return True
+    with metrics_tracker.capture() as tracked:
+        completed = await action()
+    if completed:
+        await asyncio.to_thread(journal.mark_done, file_path, stage, tracked)
+    return completed
+
+async def validate_refined_file_async(async_client, file_path, refined_temp_file_path):
+    """Async counterpart of validate_refined_file; compilers run in a worker thread."""
+    if not VALIDATE_REFINED_CODE:
+        return True
+    file_name = os.path.basename(file_path)
+    previous_validation = None
+    for attempt in range(VALIDATION_MAX_REPROMPTS + 1):
+        validation = await asyncio.to_thread(validate_source, refined_temp_file_path, file_path, VALIDATION_TIMEOUT_SECONDS)
+        if validation.ok:
+            return True
+        discard_invalid_output(file_path, file_name, validation, previous_validation)
+        if (attempt == VALIDATION_MAX_REPROMPTS
+                or not await refine_file_async(async_client, file_path, refined_temp_file_path, validation)):
+            break
+        previous_validation = validation
+    logging.warning(f"Keeping the original {file_name}, its refinement did not pass validation")
+    return False
+
+async def refine_and_move_async(async_client, file_path):
+    """Async counterpart of refine_and_move."""
+    final_file_path = os.path.join(green_code_directory, os.path.relpath(file_path, source_directory))
+    stale_test_path = get_test_file_path(final_file_path, green_test_file_directory)
+    if os.path.isfile(stale_test_path):
+        os.remove(stale_test_path)
+    refined_temp_file_path = get_refined_temp_file_path(file_path)
+    start_time = time.time()
+    refined_success = await refine_file_async(async_client, file_path, refined_temp_file_path)
+    refined_success = refined_success and await validate_refined_file_async(async_client, file_path, refined_temp_file_path)
+    model_router.record(file_path, time.time() - start_time, refined_success)
+    await asyncio.to_thread(move_to_green_code, file_path, refined_temp_file_path, refined_success)
+    if not refined_success:
+        failed_files.add(file_path)
+    return refined_success
+
+async def process_file_async(async_client, semaphore, file_path):
+    """Async counterpart of process_file; the semaphore bounds how many files are in flight."""
+    if should_skip_file(file_path):
+        return
+    
+    async with semaphore:
+        if budget.exhausted():
+            return
+        try:
+            await run_stage_async(file_path, STAGE_SOURCE_TESTS,
+                                  lambda: create_unit_test_file_async(async_client, assistant_for(file_path), file_path, test_file_directory))
+            
+            await run_stage_async(file_path, STAGE_REFINED, lambda: refine_and_move_async(async_client, file_path))
+            
+            final_file_path = os.path.join(green_code_directory, os.path.relpath(file_path, source_directory))
+            await run_stage_async(file_path, STAGE_REFINED_TESTS,
+                                  lambda: create_unit_test_file_async(async_client, assistant_for(file_path), final_file_path, green_test_file_directory))
+            
+        except Exception as e:
+            copy_original_as_fallback(file_path, e)
+
+async def run_async_refinement(file_paths):
+    """Refine all files concurrently on AsyncAzureOpenAI with at most REFINER_MAX_IN_FLIGHT files at once."""
+    async_client = AsyncAzureOpenAI(
+        api_key=api_key,
+        api_version=api_version,
+        azure_endpoint=azure_endpoint,
+        http_client=create_async_http_client(),
+        max_retries=0
+    )
+    semaphore = asyncio.Semaphore(REFINER_MAX_IN_FLIGHT)
+    try:
+        await asyncio.gather(*(process_file_async(async_client, semaphore, path) for path in file_paths))
+    finally:
+        await async_client.close()
+
+if REFINER_ENGINE == 'pipeline':
+    # Source tests of later files overlap refinement of earlier ones; packing is a threads-engine feature
+    logging.info(
+        f"Processing {len(file_list)} files in a pipeline with {PIPELINE_SOURCE_TEST_WORKERS}/"
+        f"{PIPELINE_REFINE_WORKERS}/{PIPELINE_REFINED_TEST_WORKERS} workers per stage"
+    )
+    run_pipeline(
+        (file_path for file_path in file_list if not should_skip_file(file_path)),
+        [
+            PipelineStage('source-tests', generate_source_tests, PIPELINE_SOURCE_TEST_WORKERS),
+            PipelineStage('refine', refine_to_green_code, PIPELINE_REFINE_WORKERS),
+            PipelineStage('refined-tests', generate_refined_tests, PIPELINE_REFINED_TEST_WORKERS)
+        ],
+        PIPELINE_QUEUE_SIZE,
+        on_error=copy_original_as_fallback,
+        should_stop=budget.exhausted
+    )
+elif REFINER_ENGINE == 'async':
+    # Small-file packing is a thread-engine feature; the async engine refines every file on its own
+    logging.info(f"Processing {len(file_list)} files asynchronously with up to {REFINER_MAX_IN_FLIGHT} in flight")
+    asyncio.run(run_async_refinement(file_list))
+elif REFINER_MAX_WORKERS > 1:
+    # Process work items concurrently; each worker runs all steps for one file or pack
+    logging.info(f"Processing {len(work_items)} work items with {REFINER_MAX_WORKERS} concurrent workers")
+    with ThreadPoolExecutor(max_workers=REFINER_MAX_WORKERS) as executor:
+        list(executor.map(run_work_item, work_items))
+else:
+    # Process each file sequentially through all steps
+    for work_item in work_items:
+        run_work_item(work_item)
+
+# Delete this run's uploads and threads in the background while the overview is written
+cleanup_run_resources(client)
 
 # Generate final overview after all processing is complete
+model_router.log_summary()
 finalize_processing()
 
+if INCREMENTAL_REFINEMENT:
+    save_refinement_state(source_directory, refinement_state_path, failed_files, incremental_excluded_dirs)
+
+# The run finished, so the next start begins fresh instead of resuming
+journal.complete()
+
 logging.info("Code refinement process completed successfully!")
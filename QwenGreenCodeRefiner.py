@@ -1,16 +1,25 @@
 import os
 import shutil
+import asyncio
 import logging
 import time
-import requests
+import httpx
 import json
 from pathlib import Path
 from typing import List, Set
 from dotenv import load_dotenv
 from tqdm import tqdm
-import csv
 from collections import defaultdict
-from datetime import datetime
+from git_incremental import get_incremental_changes, save_refinement_state
+from code_chunker import split_into_chunks
+from llm_metrics import LLMMetricsRecorder
+from file_discovery import get_file_index
+from run_ledger import RunLedger
+from code_validator import validate_code, build_fix_prompt
+from rate_limiter import RateLimiter, THROTTLED_STATUS_CODES, ESTIMATED_BYTES_PER_TOKEN
+from http_session import ConnectionStats, create_pooled_client, create_pooled_async_client
+from inference_backends import HUGGINGFACE, ColdStartGate, create_backend
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(
@@ -26,6 +35,9 @@ env_path = os.path.abspath(".env")
 BASE_DIR = os.path.dirname(env_path)
 RESULT_DIR = os.path.join(BASE_DIR, 'Result')
 
+# Runs, converted files and modifications of every run (Result/refinement_ledger.db)
+run_ledger = RunLedger(os.path.join(RESULT_DIR, 'refinement_ledger.db'), 'QwenGreenCodeRefiner')
+
 class MetricsTracker:
     def __init__(self, base_dir):
         """Initialize metrics tracking."""
@@ -49,133 +61,24 @@ class MetricsTracker:
         loc = self.count_loc(file_path)
         ext = file_path.suffix[1:] if file_path.suffix.startswith('.') else file_path.suffix
         self.loc_by_extension[ext] += loc
+        run_ledger.record_file(file_path, ext, loc)
         
     def get_processing_time(self) -> float:
         """Get processing time in minutes."""
         return (time.time() - self.start_time) / 60
 
 class MetricsHandler:
-    @staticmethod
-    def load_historical_data(csv_path: Path) -> dict:
-        """Load historical data from existing CSV file."""
-        historical_data = {}
-        if csv_path.exists():
-            try:
-                with open(csv_path, 'r', newline='') as csvfile:
-                    reader = csv.reader(csvfile)
-                    historical_section = False
-                    for row in reader:
-                        if not row:
-                            continue
-                        if row[0] == '=== Historical Overview ===':
-                            historical_section = True
-                            continue
-                        if historical_section and len(row) == 2:
-                            metric, value = row[0], row[1]
-                            # Handle different value formats
-                            if 'LOC' in value:
-                                # Extract numeric value before 'LOC'
-                                historical_data[metric] = int(value.split()[0])
-                            elif '.' in value:
-                                # Handle floating point values
-                                historical_data[metric] = float(value)
-                            else:
-                                # Handle integer values
-                                historical_data[metric] = int(value)
-            except Exception as e:
-                logging.warning(f"Error loading historical data: {e}")
-        return historical_data
-
     @staticmethod
     def update_final_overview(metrics_tracker, project_path: Path):
-        """Update the final overview CSV with fresh and historical data."""
+        """Close this run in the ledger and export final_overview.csv and modification_overview.csv from it."""
         result_dir = project_path / 'Result'  # Use the provided project_path
-        result_dir.mkdir(parents=True, exist_ok=True)
-        csv_path = result_dir / 'final_overview.csv'
-        
-        # Load historical data
-        historical_data = MetricsHandler.load_historical_data(csv_path)
-        
-        # Get current run metrics
-        current_metrics = MetricsHandler.get_current_run_metrics(metrics_tracker)
-        
-        try:
-            with open(csv_path, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                
-                # Write headers
-                writer.writerow(['Metric', 'Value'])
-                writer.writerow([])  # Empty row for separation
-                
-                # Fresh Details Section
-                writer.writerow(['=== Fresh Details (Last Run) ==='])
-                for metric, value in current_metrics.items():
-                    writer.writerow([metric, value])
-                
-                writer.writerow([])  # Empty row for separation
-                
-                # Historical Overview Section
-                writer.writerow(['=== Historical Overview ==='])
-                historical_metrics = MetricsHandler.combine_metrics(historical_data, current_metrics)
-                for metric, value in historical_metrics.items():
-                    writer.writerow([metric, value])
-                    
-            logging.info(f"Updated final overview at: {csv_path}")
-        except Exception as e:
-            logging.error(f"Failed to update final overview: {e}")
-
-    @staticmethod
-    def get_current_run_metrics(metrics_tracker) -> dict:
-        """Get metrics for the current run."""
-        metrics = {
-            'Total Files Modified (Last run)': metrics_tracker.files_modified,
-            'Total LOC Converted (Last run)': sum(metrics_tracker.loc_by_extension.values()),
-            'Total Time (minutes) (Last run)': round(metrics_tracker.get_processing_time(), 2)
-        }
-        
-        # Add per-extension metrics
-        for ext, loc in metrics_tracker.loc_by_extension.items():
-            metrics[f'.{ext} Files (Last run)'] = f"{loc} LOC"
-        
-        return metrics
-
-    @staticmethod
-    def combine_metrics(historical, current):
-        """Combine historical and current metrics."""
-        combined = {}
-        
-        # Base metrics
-        combined['Total Files Modified'] = (
-            historical.get('Total Files Modified', 0) +
-            current.get('Total Files Modified (Last run)', 0)
+        run_ledger.finish_run(
+            metrics_tracker.files_modified,
+            dict(metrics_tracker.loc_by_extension),
+            metrics_tracker.get_processing_time()
         )
-        
-        combined['Total LOC Converted'] = (
-            historical.get('Total LOC Converted', 0) +
-            current.get('Total LOC Converted (Last run)', 0)
-        )
-        
-        combined['Total Time (minutes)'] = round(
-            historical.get('Total Time (minutes)', 0) +
-            current.get('Total Time (minutes) (Last run)', 0),
-            2
-        )
-        
-        # Combine extension-specific metrics
-        extension_metrics = {}
-        for key, value in current.items():
-            if key.endswith('Files (Last run)'):
-                ext = key.split()[0]
-                extension_metrics[ext] = int(value.split()[0])
-        
-        for key, historical_value in historical.items():
-            if isinstance(historical_value, str) and 'LOC' in historical_value:
-                ext = f'.{key.split()[0]}'
-                hist_loc = int(historical_value.split()[0])
-                current_loc = extension_metrics.get(ext, 0)
-                combined[f'{ext} Files'] = f"{hist_loc + current_loc} LOC"
-        
-        return combined
+        run_ledger.export_final_overview(str(result_dir / 'final_overview.csv'))
+        run_ledger.export_modifications(str(result_dir / 'modification_overview.csv'))
 
 def ensure_result_directory():
     """Ensure the Result directory exists."""
@@ -187,21 +90,6 @@ def ensure_result_directory():
             logging.error(f"Failed to create Result directory: {e}")
             raise
 
-def ensure_csv_exists():
-    """Ensure the CSV file exists and has the correct headers."""
-    ensure_result_directory()  # Make sure the Result directory exists
-    csv_path = os.path.join(RESULT_DIR, 'modification_overview.csv')
-    
-    if not os.path.exists(csv_path):
-        try:
-            with open(csv_path, 'w', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=['File Name', 'Modification Timestamp', 'Changes', 'Next Steps'])
-                writer.writeheader()
-            logging.info(f"Created modification_overview.csv at: {csv_path}")
-        except Exception as e:
-            logging.error(f"Failed to create CSV file: {e}")
-            raise
-
 def extract_section(content, start_marker, end_marker):
     """Extract content between specific markers."""
     try:
@@ -229,25 +117,17 @@ def extract_section(content, start_marker, end_marker):
         return None
 
 def log_modifications(file_name, changes, next_steps):
-    """Log modifications to the CSV file."""
-    csv_path = os.path.join(RESULT_DIR, 'modification_overview.csv')
-    ensure_csv_exists()
-    
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
+    """Log modifications to the run ledger (exported to modification_overview.csv)."""
     try:
-        with open(csv_path, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=['File Name', 'Modification Timestamp', 'Changes', 'Next Steps'])
-            writer.writerow({
-                'File Name': file_name,
-                'Modification Timestamp': timestamp,
-                'Changes': changes,
-                'Next Steps': next_steps
-            })
+        run_ledger.record_modification(file_name, changes, next_steps)
         logging.info(f"Logged modifications for file: {file_name}")
     except Exception as e:
         logging.error(f"Failed to log modifications: {e}")
 
+# Logged for a file whose refinements all failed validation, so the original was written instead
+KEPT_ORIGINAL_SUMMARY = ("No changes: the refinement did not pass validation, the original was kept",
+                         "Refine the file again")
+
 def extract_changes_summary(response):
     """Extract changes summary from the assistant's response."""
     try:
@@ -275,6 +155,10 @@ class CodeRefiner:
         self.metrics_tracker = MetricsTracker(BASE_DIR)
         self.load_environment()
         self.setup_api()
+        # Per-request latency and retry metrics (Result/llm_requests_<run>.csv)
+        self.llm_metrics = LLMMetricsRecorder(RESULT_DIR)
+        # Files that kept their original code; incremental mode retries them next run
+        self.failed_files = set()
 
     def parse_extensions(self, extensions_str: str) -> Set[str]:
         """Parse file extensions from string to set."""
@@ -369,12 +253,51 @@ class CodeRefiner:
                 'Create testcase functions for the given code. Provide only the code without any markdown, comments, or explanations.')
             self.hf_token = env_vars.get('HF_TOKEN') or os.getenv('HF_TOKEN')
 
+            # Incremental mode only refines files changed since the last refined commit
+            self.incremental = (env_vars.get('INCREMENTAL_REFINEMENT') or os.getenv('INCREMENTAL_REFINEMENT', 'n')).strip().lower() == 'y'
+
+            # Large files are split by function/class and refined chunk by chunk (0 disables chunking)
+            self.chunk_max_chars = int(env_vars.get('CHUNK_MAX_CHARS') or os.getenv('CHUNK_MAX_CHARS', '6000'))
+            self.chunk_max_workers = max(1, int(env_vars.get('CHUNK_MAX_WORKERS') or os.getenv('CHUNK_MAX_WORKERS', '4')))
+
+            # Requests/tokens per minute shared by all workers (0 disables a limit) and retries on throttling
+            self.rate_limiter = RateLimiter(
+                int(env_vars.get('HF_REQUESTS_PER_MINUTE') or os.getenv('HF_REQUESTS_PER_MINUTE', '0')),
+                int(env_vars.get('HF_TOKENS_PER_MINUTE') or os.getenv('HF_TOKENS_PER_MINUTE', '0')),
+                max_retries=int(env_vars.get('RATE_LIMIT_MAX_RETRIES') or os.getenv('RATE_LIMIT_MAX_RETRIES', '5'))
+            )
+
+            # Keep-alive connections to the inference endpoint shared by all workers (HTTP/2 when h2 is installed)
+            self.http_pool_size = max(1, int(env_vars.get('HF_POOL_SIZE') or os.getenv('HF_POOL_SIZE', '10')))
+            self.http2 = (env_vars.get('HF_HTTP2') or os.getenv('HF_HTTP2', 'y')).strip().lower() == 'y'
+
+            # REFINER_ENGINE=async refines files and generates tests concurrently on httpx.AsyncClient,
+            # at most REFINER_MAX_IN_FLIGHT files at a time; any other engine processes files one by one
+            self.async_mode = (env_vars.get('REFINER_ENGINE') or os.getenv('REFINER_ENGINE', 'threads')).strip().lower() == 'async'
+            self.max_in_flight = max(1, int(env_vars.get('REFINER_MAX_IN_FLIGHT') or os.getenv('REFINER_MAX_IN_FLIGHT', '16')))
+
+            # Refined code must parse or compile before it is written to GreenCode; failures are re-prompted
+            self.validate_refined = (env_vars.get('VALIDATE_REFINED_CODE') or os.getenv('VALIDATE_REFINED_CODE', 'y')).strip().lower() == 'y'
+            self.validation_max_reprompts = max(0, int(env_vars.get('VALIDATION_MAX_REPROMPTS') or os.getenv('VALIDATION_MAX_REPROMPTS', '1')))
+            self.validation_timeout = max(1, int(env_vars.get('VALIDATION_TIMEOUT_SECONDS') or os.getenv('VALIDATION_TIMEOUT_SECONDS', '60')))
+
             # Test suite directory names
             self.src_test_suite = 'SRC-TestSuite'
             self.greencode_test_suite = 'GreenCode-TestSuite'
             
             # Load API URL
             self.api_base_url = env_vars.get('API_URL') or os.getenv('API_URL', 'https://api-inference.huggingface.co/models/')
+
+            # Inference server: huggingface (API_URL), azure (an Azure OpenAI deployment) or openai (a local
+            # OpenAI-compatible server such as vLLM or llama.cpp); batches of up to INFERENCE_BATCH_SIZE
+            # prompts share a request where the server supports it
+            self.backend_name = (env_vars.get('INFERENCE_BACKEND') or os.getenv('INFERENCE_BACKEND', HUGGINGFACE)).strip().lower()
+            self.batch_size = max(1, int(env_vars.get('INFERENCE_BATCH_SIZE') or os.getenv('INFERENCE_BATCH_SIZE', '1')))
+
+            # Parallel pings sent at start-up to load a cold model (0 disables), and how long requests are
+            # held while it loads before loading responses count as ordinary failures
+            self.warm_up_pings = max(0, int(env_vars.get('HF_WARMUP_PINGS') or os.getenv('HF_WARMUP_PINGS', '4')))
+            self.max_cold_start_seconds = max(0, int(env_vars.get('HF_MAX_COLD_START_SECONDS') or os.getenv('HF_MAX_COLD_START_SECONDS', '600')))
             
             # Load and parse file extensions
             extensions_str = env_vars.get('QWEN_FILE_EXTENSIONS') or os.getenv('QWEN_FILE_EXTENSIONS', '.py,.java,.cpp,.cs,.js,.ts')
@@ -394,11 +317,12 @@ class CodeRefiner:
                 raise ValueError(f"Invalid or missing model selection in .env file. Choose from: {available_models}")
             
             # Validate required variables
-            if not all([self.project_path, self.prompt, self.hf_token]):
+            needs_hf_token = self.backend_name == HUGGINGFACE
+            if not all([self.project_path, self.prompt, self.hf_token or not needs_hf_token]):
                 missing = []
                 if not self.project_path: missing.append('PROJECT_PATH')
                 if not self.prompt: missing.append('PROMPT_1')
-                if not self.hf_token: missing.append('HF_TOKEN')
+                if needs_hf_token and not self.hf_token: missing.append('HF_TOKEN')
                 raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
                 
             self.project_path = Path(self.project_path)
@@ -410,7 +334,7 @@ class CodeRefiner:
             logging.info(f"Selected model: {self.model_key}")
             logging.info(f"Project path: {self.project_path}")
             logging.info(f"Supported extensions: {self.supported_extensions}")
-            logging.info(f"API URL: {self.api_base_url}")
+            logging.info(f"Inference backend: {self.backend_name}")
             logging.info(f"Excluded files: {self.excluded_files}")
             
         except Exception as e:
@@ -420,72 +344,360 @@ class CodeRefiner:
     def setup_api(self) -> None:
         """Setup the API connection."""
         try:
-            self.model_url = self.api_base_url + self.available_models[self.model_key]
-            self.headers = {"Authorization": f"Bearer {self.hf_token}"}
-            logging.info(f"API setup completed for model: {self.available_models[self.model_key]}")
+            self.backend = create_backend(
+                self.backend_name, self.available_models[self.model_key], dict(os.environ, API_URL=self.api_base_url)
+            )
+            self.batching = self.batch_size > 1 and self.backend.supports_batching
+            self.cold_start = ColdStartGate(self.max_cold_start_seconds)
+            # One pooled client for the whole run, so requests reuse connections instead of handshaking again
+            self.connection_stats = ConnectionStats('Inference API')
+            self.http_client = create_pooled_client(self.http_pool_size, 30, self.http2, self.connection_stats)
+            logging.info(f"API setup completed for model: {self.backend.describe()}")
         except Exception as e:
             logging.error(f"Error setting up API: {str(e)}")
             raise
 
-    def query_api(self, payload: dict) -> dict:
-        """Send request to Hugging Face API."""
-        max_retries = 3
-        retry_delay = 5
-        
-        for attempt in range(max_retries):
+    def query_api(self, payload: dict, operation: str = 'refine', file_path: Path = None) -> dict:
+        """Send request to the inference backend, throttled by the shared rate limiter."""
+        return self.send_request([payload], operation, file_path)[0]
+
+    def query_api_batch(self, payloads: List[dict], operation: str = 'refine', file_path: Path = None) -> list:
+        """Send several payloads, in one request when the backend batches; returns one response per payload."""
+        if not self.batching or len(payloads) == 1:
+            return [self.query_api(payload, operation, file_path) for payload in payloads]
+        return self.send_request(payloads, f"{operation}_batch", file_path)
+
+    def post_when_warm(self, url: str, headers: dict, body: dict, estimated_tokens: int) -> httpx.Response:
+        """POST once the model is loaded; loading responses hold the request instead of failing it."""
+        while True:
+            self.cold_start.wait()
+            self.rate_limiter.acquire(estimated_tokens)
+            try:
+                response = self.http_client.post(url, headers=headers, json=body, extensions=self.connection_stats.extensions)
+            except httpx.HTTPError:
+                self.cold_start.abandon_probe()
+                raise
+            loading_seconds = self.backend.loading_seconds(response)
+            if loading_seconds is not None and self.cold_start.loading(loading_seconds):
+                continue
+            if loading_seconds is None:
+                self.cold_start.ready()
+            return response
+
+    async def post_when_warm_async(self, url: str, headers: dict, body: dict, estimated_tokens: int) -> httpx.Response:
+        """Async counterpart of post_when_warm."""
+        while True:
+            await self.cold_start.wait_async()
+            await self.rate_limiter.acquire_async(estimated_tokens)
             try:
-                response = requests.post(
-                    self.model_url,
-                    headers=self.headers,
-                    json=payload,
-                    timeout=30
+                response = await self.async_http_client.post(
+                    url, headers=headers, json=body, extensions=self.connection_stats.async_extensions
                 )
+            except httpx.HTTPError:
+                self.cold_start.abandon_probe()
+                raise
+            loading_seconds = self.backend.loading_seconds(response)
+            if loading_seconds is not None and self.cold_start.loading(loading_seconds):
+                continue
+            if loading_seconds is None:
+                self.cold_start.ready()
+            return response
+
+    def warm_up(self) -> None:
+        """Send parallel pings so a cold model loads before the workers start; they are held until it is ready."""
+        if not self.warm_up_pings or self.backend_name != HUGGINGFACE:
+            return
+        payload = self.backend.warm_up_payload()
+
+        def ping(_):
+            try:
+                self.send_request([payload], 'warm_up')
+                return True
+            except Exception as e:
+                logging.warning(f"Warm-up ping failed: {str(e)}")
+                return False
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.warm_up_pings) as executor:
+            answered = sum(executor.map(ping, range(self.warm_up_pings)))
+        logging.info(f"Warm-up: {answered} of {self.warm_up_pings} pings answered in {time.time() - start_time:.1f}s")
+
+    def send_request(self, payloads: List[dict], operation: str, file_path: Path = None) -> list:
+        """Send payloads as one backend request with retries; returns the normalised response of each payload."""
+        max_attempts = self.rate_limiter.max_retries + 1
+        url, headers, body = self.backend.build_request(payloads)
+        estimated_tokens = len(json.dumps(body)) // ESTIMATED_BYTES_PER_TOKEN + 1
+        start_time = time.time()
+        
+        for attempt in range(max_attempts):
+            request_start = time.time()
+            try:
+                response = self.post_when_warm(url, headers, body, estimated_tokens)
+                retry_after = self.rate_limiter.update_from_headers(response.headers, response.status_code)
+                if response.status_code in THROTTLED_STATUS_CODES and attempt < max_attempts - 1:
+                    retry_delay = self.rate_limiter.backoff_delay(attempt, retry_after)
+                    logging.warning(f"API request throttled ({response.status_code}), retrying in {retry_delay:.1f} seconds...")
+                    time.sleep(retry_delay)
+                    continue
                 response.raise_for_status()
-                return response.json()
+                result = self.backend.parse_response(response.json(), payloads)
+                self.llm_metrics.record(
+                    operation, file_path, self.model_key, 'success',
+                    run_seconds=time.time() - request_start, total_seconds=time.time() - start_time, retries=attempt
+                )
+                return result
                 
-            except requests.exceptions.RequestException as e:
-                if attempt == max_retries - 1:
-                    raise Exception(f"API request failed after {max_retries} attempts: {str(e)}")
-                logging.warning(f"API request attempt {attempt + 1} failed, retrying in {retry_delay} seconds...")
+            except httpx.HTTPError as e:
+                if attempt == max_attempts - 1:
+                    self.llm_metrics.record(
+                        operation, file_path, self.model_key, 'error',
+                        run_seconds=time.time() - request_start, total_seconds=time.time() - start_time, retries=attempt
+                    )
+                    raise Exception(f"API request failed after {max_attempts} attempts: {str(e)}")
+                retry_delay = self.rate_limiter.backoff_delay(attempt)
+                logging.warning(f"API request attempt {attempt + 1} failed, retrying in {retry_delay:.1f} seconds...")
                 time.sleep(retry_delay)
 
-    def refine_code(self, code: str, file_path: Path) -> str:
-        """Refine code using the Hugging Face API."""
-        try:
-            # Prepare the prompt
-            prompt = f"{self.prompt}\n\nCode:\n{code}\n\nRefined Code:"
-            
-            # Prepare the payload
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "max_new_tokens": 2048,
-                    "temperature": 0.7,
-                    "top_p": 0.95,
-                    "do_sample": True
-                }
+            except Exception:
+                # Malformed response bodies (ValueError, KeyError, TypeError) are not retried
+                self.llm_metrics.record(
+                    operation, file_path, self.model_key, 'error',
+                    run_seconds=time.time() - request_start, total_seconds=time.time() - start_time, retries=attempt
+                )
+                raise
+
+    async def query_api_async(self, payload: dict, operation: str = 'refine', file_path: Path = None) -> dict:
+        """Async counterpart of query_api, sent on the pooled httpx.AsyncClient."""
+        return (await self.send_request_async([payload], operation, file_path))[0]
+
+    async def query_api_batch_async(self, payloads: List[dict], operation: str = 'refine', file_path: Path = None) -> list:
+        """Async counterpart of query_api_batch."""
+        if not self.batching or len(payloads) == 1:
+            return [await self.query_api_async(payload, operation, file_path) for payload in payloads]
+        return await self.send_request_async(payloads, f"{operation}_batch", file_path)
+
+    async def send_request_async(self, payloads: List[dict], operation: str, file_path: Path = None) -> list:
+        """Async counterpart of send_request."""
+        max_attempts = self.rate_limiter.max_retries + 1
+        url, headers, body = self.backend.build_request(payloads)
+        estimated_tokens = len(json.dumps(body)) // ESTIMATED_BYTES_PER_TOKEN + 1
+        start_time = time.time()
+
+        for attempt in range(max_attempts):
+            request_start = time.time()
+            try:
+                response = await self.post_when_warm_async(url, headers, body, estimated_tokens)
+                retry_after = self.rate_limiter.update_from_headers(response.headers, response.status_code)
+                if response.status_code in THROTTLED_STATUS_CODES and attempt < max_attempts - 1:
+                    retry_delay = self.rate_limiter.backoff_delay(attempt, retry_after)
+                    logging.warning(f"API request throttled ({response.status_code}), retrying in {retry_delay:.1f} seconds...")
+                    await asyncio.sleep(retry_delay)
+                    continue
+                response.raise_for_status()
+                result = self.backend.parse_response(response.json(), payloads)
+                self.llm_metrics.record(
+                    operation, file_path, self.model_key, 'success',
+                    run_seconds=time.time() - request_start, total_seconds=time.time() - start_time, retries=attempt
+                )
+                return result
+
+            except httpx.HTTPError as e:
+                if attempt == max_attempts - 1:
+                    self.llm_metrics.record(
+                        operation, file_path, self.model_key, 'error',
+                        run_seconds=time.time() - request_start, total_seconds=time.time() - start_time, retries=attempt
+                    )
+                    raise Exception(f"API request failed after {max_attempts} attempts: {str(e)}")
+                retry_delay = self.rate_limiter.backoff_delay(attempt)
+                logging.warning(f"API request attempt {attempt + 1} failed, retrying in {retry_delay:.1f} seconds...")
+                await asyncio.sleep(retry_delay)
+
+            except Exception:
+                # Malformed response bodies (ValueError, KeyError, TypeError) are not retried
+                self.llm_metrics.record(
+                    operation, file_path, self.model_key, 'error',
+                    run_seconds=time.time() - request_start, total_seconds=time.time() - start_time, retries=attempt
+                )
+                raise
+
+    def generation_payload(self, prompt: str) -> dict:
+        """Text generation request body for the Hugging Face API."""
+        return {
+            "inputs": prompt,
+            "parameters": {
+                "max_new_tokens": 2048,
+                "temperature": 0.7,
+                "top_p": 0.95,
+                "do_sample": True
             }
-            
-            # Query the API
-            response = self.query_api(payload)
-            
-            # Extract the refined code
-            if isinstance(response, list) and len(response) > 0:
-                generated_text = response[0].get('generated_text', '')
-                refined_code = generated_text.split("Refined Code:")[-1].strip()
-                
-                # Extract changes and next steps
-                changes, next_steps = extract_changes_summary(response)
-                log_modifications(file_path.name, changes, next_steps)
-                
-                return refined_code
-            else:
-                raise ValueError("Unexpected API response format")
-            
+        }
+
+    def chunk_payload(self, chunk: str, header: str, file_path: Path, index: int, total: int, validation=None) -> dict:
+        """Refinement request for one chunk of a large file, with the errors of a failed validation if given."""
+        instructions = build_fix_prompt(self.prompt, validation) if validation else self.prompt
+        prompt = (
+            f"{instructions}\n\n"
+            f"The code below is part {index} of {total} of the file {file_path.name}. "
+            f"The file starts with these imports and declarations, which are kept unchanged:\n{header}\n"
+            "Refine only this part, keep its public names and signatures, and do not repeat the imports."
+            f"\n\nCode:\n{chunk}\n\nRefined Code:"
+        )
+        return self.generation_payload(prompt)
+
+    def refine_chunk(self, chunk: str, header: str, file_path: Path, index: int, total: int, validation=None):
+        """Refine one chunk of a large file. Returns (refined_chunk, response)."""
+        payload = self.chunk_payload(chunk, header, file_path, index, total, validation)
+        response = self.query_api(payload, 'refine_chunk', file_path)
+        return self.parse_refined_chunk(response), response
+
+    def parse_refined_chunk(self, response) -> str:
+        """Extract a refined chunk from a response, without its summary markers."""
+        if not (isinstance(response, list) and len(response) > 0):
+            raise ValueError("Unexpected API response format")
+        refined_chunk = response[0].get('generated_text', '').split("Refined Code:")[-1]
+        # Keep the summary markers out of the reassembled file
+        return refined_chunk.split('CHANGES_START')[0].strip('\n')
+
+    def refine_chunks_batched(self, chunks, file_path: Path, validation=None) -> list:
+        """Refine chunks in batched requests. Returns (refined_chunk, response) or None per chunk."""
+        total = len(chunks.chunks)
+        payloads = [self.chunk_payload(chunk, chunks.header, file_path, index + 1, total, validation)
+                    for index, chunk in enumerate(chunks.chunks)]
+        results = []
+        for start in range(0, total, self.batch_size):
+            batch = payloads[start:start + self.batch_size]
+            try:
+                responses = self.query_api_batch(batch, 'refine_chunk', file_path)
+            except Exception as e:
+                logging.error(f"Error refining chunks {start + 1}-{start + len(batch)} of {file_path.name}: {str(e)}")
+                results.extend([None] * len(batch))
+                continue
+            for index, response in enumerate(responses, start + 1):
+                try:
+                    results.append((self.parse_refined_chunk(response), response))
+                except Exception as e:
+                    logging.error(f"Error refining chunk {index} of {file_path.name}: {str(e)}")
+                    results.append(None)
+        return results
+
+    def refine_code_in_chunks(self, chunks, file_path: Path, validation=None):
+        """
+        Refine chunks in parallel (or batched) and reassemble them with the original ordering and imports.
+        Returns (refined code, (changes, next steps)).
+        """
+        total = len(chunks.chunks)
+        logging.info(f"Refining {file_path.name} in {total} chunks")
+
+        def refine(index):
+            try:
+                return self.refine_chunk(chunks.chunks[index], chunks.header, file_path, index + 1, total, validation)
+            except Exception as e:
+                logging.error(f"Error refining chunk {index + 1} of {file_path.name}: {str(e)}")
+                return None
+
+        if self.batching:
+            results = self.refine_chunks_batched(chunks, file_path, validation)
+        else:
+            with ThreadPoolExecutor(max_workers=self.chunk_max_workers) as executor:
+                results = list(executor.map(refine, range(total)))
+
+        if not any(results):
+            raise ValueError(f"No chunk of {file_path.name} could be refined")
+
+        # Chunks that failed keep their original text so the file stays complete
+        refined_chunks = [result[0] if result and result[0].strip() else chunk
+                          for result, chunk in zip(results, chunks.chunks)]
+        summaries = [extract_changes_summary(result[1]) for result in results if result]
+        changes = '; '.join(dict.fromkeys(changes for changes, _ in summaries if changes))
+        next_steps = next((steps for _, steps in summaries if steps), None)
+        summary = (changes or "No specific changes provided", next_steps or "No specific next steps identified")
+        return chunks.reassemble(refined_chunks), summary
+
+    def split_large_code(self, code: str, file_path: Path):
+        """Chunks of a file too large to refine in one request, or None to send it whole."""
+        # Large files are refined per function/class so they are not truncated by max_new_tokens
+        if self.chunk_max_chars > 0 and len(code) > self.chunk_max_chars:
+            return split_into_chunks(code, file_path.suffix, self.chunk_max_chars)
+        return None
+
+    def refine_payload(self, code: str, validation=None) -> dict:
+        """Refinement request, asking to fix the errors of a failed validation if given."""
+        instructions = build_fix_prompt(self.prompt, validation) if validation else self.prompt
+        return self.generation_payload(f"{instructions}\n\nCode:\n{code}\n\nRefined Code:")
+
+    def parse_refined_code(self, response):
+        """Extract the refined code and its changes summary from a response. Returns (refined code, (changes, next steps))."""
+        if isinstance(response, list) and len(response) > 0:
+            generated_text = response[0].get('generated_text', '')
+            refined_code = generated_text.split("Refined Code:")[-1].strip()
+            return refined_code, extract_changes_summary(response)
+        raise ValueError("Unexpected API response format")
+
+    def refine_code(self, code: str, file_path: Path, validation=None):
+        """
+        Refine code using the Hugging Face API, asking to fix the errors of a failed validation if given.
+        Returns (refined code, (changes, next steps)); the summary is logged once the file is written.
+        """
+        try:
+            chunks = self.split_large_code(code, file_path)
+            if chunks:
+                return self.refine_code_in_chunks(chunks, file_path, validation)
+
+            response = self.query_api(self.refine_payload(code, validation), 'refine', file_path)
+            return self.parse_refined_code(response)
+
         except Exception as e:
             logging.error(f"Error refining code: {str(e)}")
             raise
 
+    async def refine_code_async(self, code: str, file_path: Path, validation=None):
+        """Async counterpart of refine_code."""
+        try:
+            chunks = self.split_large_code(code, file_path)
+            if chunks:
+                # Chunks keep their own worker pool on the sync client, so run them off the event loop
+                return await asyncio.to_thread(self.refine_code_in_chunks, chunks, file_path, validation)
+
+            response = await self.query_api_async(self.refine_payload(code, validation), 'refine', file_path)
+            return self.parse_refined_code(response)
+
+        except Exception as e:
+            logging.error(f"Error refining code: {str(e)}")
+            raise
+
+    def ensure_valid_code(self, refined_code: str, summary, original_code: str, file_path: Path):
+        """
+        Return (code, summary) for refined code that parses or compiles, re-prompting with its errors,
+        or the original with a note that it was kept if no attempt does.
+        """
+        for attempt in range(self.validation_max_reprompts + 1):
+            validation = validate_code(refined_code, file_path.name, str(file_path), self.validation_timeout)
+            if validation.ok:
+                return refined_code, summary
+            logging.warning(f"Refined {file_path.name} failed {validation.checker} validation: {validation.message}")
+            if attempt == self.validation_max_reprompts:
+                break
+            refined_code, summary = self.refine_code(original_code, file_path, validation)
+        logging.warning(f"Keeping the original {file_path.name}, its refinement did not pass validation")
+        self.failed_files.add(file_path)
+        return original_code, KEPT_ORIGINAL_SUMMARY
+
+    async def ensure_valid_code_async(self, refined_code: str, summary, original_code: str, file_path: Path):
+        """Async counterpart of ensure_valid_code; compilers run off the event loop."""
+        for attempt in range(self.validation_max_reprompts + 1):
+            validation = await asyncio.to_thread(
+                validate_code, refined_code, file_path.name, str(file_path), self.validation_timeout
+            )
+            if validation.ok:
+                return refined_code, summary
+            logging.warning(f"Refined {file_path.name} failed {validation.checker} validation: {validation.message}")
+            if attempt == self.validation_max_reprompts:
+                break
+            refined_code, summary = await self.refine_code_async(original_code, file_path, validation)
+        logging.warning(f"Keeping the original {file_path.name}, its refinement did not pass validation")
+        self.failed_files.add(file_path)
+        return original_code, KEPT_ORIGINAL_SUMMARY
+
     def process_file(self, file_path: Path) -> None:
         """Process a single code file."""
         try:
@@ -499,33 +711,67 @@ class CodeRefiner:
                 original_code = f.read()
                 
             # Refine the code (pass file_path to refine_code)
-            refined_code = self.refine_code(original_code, file_path)
-            
-            # Calculate relative path
-            relative_path = file_path.relative_to(self.project_path)
-            output_file = self.output_path / relative_path
+            refined_code, summary = self.refine_code(original_code, file_path)
+            if self.validate_refined:
+                refined_code, summary = self.ensure_valid_code(refined_code, summary, original_code, file_path)
             
-            # Create necessary directories
-            output_file.parent.mkdir(parents=True, exist_ok=True)
+            self.write_refined_code(file_path, refined_code)
+            log_modifications(file_path.name, *summary)
             
-            # Write refined code
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(refined_code)
-                
-            logging.info(f"Successfully processed: {relative_path}")
+        except Exception as e:
+            logging.error(f"Error processing file {file_path}: {str(e)}")
+            raise
+
+    async def process_file_async(self, file_path: Path) -> None:
+        """Async counterpart of process_file."""
+        try:
+            if file_path.name in self.excluded_files:
+                logging.info(f"Skipping excluded file: {file_path.name}")
+                return
+
+            with open(file_path, 'r', encoding='utf-8') as f:
+                original_code = f.read()
+
+            refined_code, summary = await self.refine_code_async(original_code, file_path)
+            if self.validate_refined:
+                refined_code, summary = await self.ensure_valid_code_async(refined_code, summary, original_code, file_path)
+
+            self.write_refined_code(file_path, refined_code)
+            log_modifications(file_path.name, *summary)
 
-            # Track metrics for the processed file
-            self.metrics_tracker.track_file(output_file)
-            
         except Exception as e:
             logging.error(f"Error processing file {file_path}: {str(e)}")
             raise
 
-    def setup_output_directory(self) -> None:
+    def write_refined_code(self, file_path: Path, refined_code: str) -> None:
+        """Write refined code to its GreenCode location and track it."""
+        # Calculate relative path
+        relative_path = file_path.relative_to(self.project_path)
+        output_file = self.output_path / relative_path
+
+        # Create necessary directories
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write refined code
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(refined_code)
+
+        logging.info(f"Successfully processed: {relative_path}")
+
+        # Track metrics for the processed file
+        self.metrics_tracker.track_file(output_file)
+
+    def setup_output_directory(self, preserve_existing: bool = False) -> None:
         """Setup the GreenCode output directory."""
         try:
             self.output_path = self.project_path / 'GreenCode'
             
+            if preserve_existing:
+                # Incremental runs carry forward the outputs of unchanged files
+                self.output_path.mkdir(parents=True, exist_ok=True)
+                logging.info(f"Reusing existing output directory: {self.output_path}")
+                return
+
             if self.output_path.exists():
                 logging.info("Removing existing GreenCode directory...")
                 shutil.rmtree(self.output_path)
@@ -540,31 +786,16 @@ class CodeRefiner:
     def get_code_files(self) -> List[Path]:
         """Recursively find all supported code files in the project."""
         try:
-            code_files = []
-            total_files = 0
-            processed_files = 0
-            skipped_files = 0
-            
             # Log the start of file scanning
             logging.info("Starting to scan for code files...")
             logging.info(f"Looking for files with extensions: {self.supported_extensions}")
             
-            for file_path in self.project_path.rglob('*'):
-                total_files += 1
-                
-                # Skip directories and handle files only
-                if not file_path.is_file():
-                    continue
-                    
-                # Check if file is in SRC-TestSuite folder or other excluded conditions
-                if (file_path.suffix in self.supported_extensions and 
-                    'GreenCode' not in file_path.parts and
-                    self.src_test_suite not in file_path.parts and  # Exclude SRC-TestSuite folder
-                    file_path.name not in self.excluded_files):
-                    code_files.append(file_path)
-                    processed_files += 1
-                else:
-                    skipped_files += 1
+            # Generated output directories are pruned during the walk rather than filtered afterwards
+            index = self.file_index(self.project_path)
+            code_files = [Path(path) for path in index.find(self.supported_extensions, self.excluded_files)]
+            total_files = len(index.paths)
+            processed_files = len(code_files)
+            skipped_files = total_files - processed_files
             
             # Log detailed statistics
             logging.info(f"File scanning completed:")
@@ -583,6 +814,34 @@ class CodeRefiner:
             logging.error(f"Error finding code files: {str(e)}")
             raise
 
+    def file_index(self, root: Path):
+        """
+        Pruned, .gitignore-aware index of root shared by every file lookup of the run. Generated
+        test suites, and GreenCode when indexing the project, are pruned during the walk.
+        """
+        if root == self.project_path:
+            excluded_dirs = ('GreenCode', self.src_test_suite)
+        else:
+            excluded_dirs = (self.greencode_test_suite,)
+        return get_file_index(root, excluded_dirs, cache_path=self.project_path / '.greencode_cache' / 'file_index.json')
+
+    def discard_generated_outputs(self, source_file: Path) -> None:
+        """Remove the GreenCode copy and generated tests of a source file so they are regenerated."""
+        try:
+            relative_path = source_file.relative_to(self.project_path)
+        except ValueError:
+            return
+        output_file = self.output_path / relative_path
+        stale_paths = [
+            output_file,
+            self.get_test_file_path(source_file, self.project_path, self.project_path / self.src_test_suite),
+            self.get_test_file_path(output_file, self.output_path, self.output_path / self.greencode_test_suite)
+        ]
+        for stale_path in stale_paths:
+            if stale_path.is_file():
+                stale_path.unlink()
+                logging.info(f"Removed stale output: {stale_path}")
+
     def is_test_file(self, file_path: Path) -> bool:
         """Check if a file is a test file."""
         test_indicators = ['test', 'spec', 'Tests']
@@ -621,66 +880,83 @@ class CodeRefiner:
         return False
 
 
-    def generate_test_case(self, code: str) -> str:
+    def generate_test_case(self, code: str, file_path: Path = None) -> str:
         """Generate test cases using the API."""
         try:
-            # Prepare the prompt
-            prompt = f"{self.test_prompt}\n\nCode:\n{code}"
-            
-            # Prepare the payload
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "max_new_tokens": 2048,
-                    "temperature": 0.7,
-                    "top_p": 0.95,
-                    "do_sample": True
-                }
-            }
-            
             # Query the API
-            response = self.query_api(payload)
-            
-            # Extract the test code
-            if isinstance(response, list) and len(response) > 0:
-                generated_text = response[0].get('generated_text', '')
-                test_code = generated_text.split("Code:")[-1].strip()
-                return test_code
-            else:
-                raise ValueError("Unexpected API response format")
+            response = self.query_api(self.test_payload(code), 'unit_test', file_path)
+            return self.parse_test_code(response)
             
         except Exception as e:
             logging.error(f"Error generating test case: {str(e)}")
             raise
 
+    async def generate_test_case_async(self, code: str, file_path: Path = None) -> str:
+        """Async counterpart of generate_test_case."""
+        try:
+            response = await self.query_api_async(self.test_payload(code), 'unit_test', file_path)
+            return self.parse_test_code(response)
+
+        except Exception as e:
+            logging.error(f"Error generating test case: {str(e)}")
+            raise
+
+    def test_payload(self, code: str) -> dict:
+        """Test generation request for the given code."""
+        return self.generation_payload(f"{self.test_prompt}\n\nCode:\n{code}")
+
+    def parse_test_code(self, response) -> str:
+        """Extract the test code from a response."""
+        if isinstance(response, list) and len(response) > 0:
+            generated_text = response[0].get('generated_text', '')
+            return generated_text.split("Code:")[-1].strip()
+        raise ValueError("Unexpected API response format")
+
+    def find_files_needing_tests(self, source_dir: Path, test_suite_dir: Path) -> List[Path]:
+        """Collect the files in a directory that need test cases."""
+        index = self.file_index(source_dir)
+        code_files = []
+        for file_path in map(Path, index.find(self.supported_extensions, self.excluded_files)):
+            if (not self.is_test_file(file_path) and
+                not self.existing_test_file(file_path, test_suite_dir) and
+                'TestSuite' not in file_path.relative_to(source_dir).parts):
+                code_files.append(file_path)
+
+        logging.info(f"Found {len(code_files)} files requiring test cases in {source_dir}")
+            
+        # Add more detailed logging
+        if not code_files:
+            logging.warning(f"No files found matching criteria in {source_dir}. Check file extensions and exclusion rules.")
+            for file_path in map(Path, index.paths):
+                logging.debug(f"Found file: {file_path}, Extension: {file_path.suffix}")
+        return code_files
+
+    def write_test_case(self, file_path: Path, source_dir: Path, test_suite_dir: Path, test_code: str) -> None:
+        """Write a generated test case next to its counterparts in the test suite directory."""
+        # Get test file path
+        test_file_path = self.get_test_file_path(file_path, source_dir, test_suite_dir)
+
+        # Create directory if it doesn't exist
+        test_file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write test file
+        with open(test_file_path, 'w', encoding='utf-8') as f:
+            f.write(test_code)
+
+        logging.info(f"Generated test case for: {file_path.relative_to(source_dir)}")
+
     def process_tests_for_directory(self, source_dir: Path, test_suite_dir: Path) -> None:
         """Process test cases for all files in a directory."""
         try:
             # Create test suite directory
             test_suite_dir.mkdir(parents=True, exist_ok=True)
             
-            # Collect files that need test cases
-            code_files = []
-            for file_path in source_dir.rglob('*'):
-                # Determine if we're processing GreenCode directory
-                is_greencode = 'GreenCode' in source_dir.parts
-                
-                if (file_path.suffix in self.supported_extensions and 
-                    not self.is_test_file(file_path) and 
-                    not self.existing_test_file(file_path, test_suite_dir) and
-                    (is_greencode or 'GreenCode' not in file_path.parts) and  # Modified condition
-                    'TestSuite' not in file_path.parts and
-                    file_path.name not in self.excluded_files):
-                    code_files.append(file_path)
-            
-            logging.info(f"Found {len(code_files)} files requiring test cases in {source_dir}")
-            
-            # Add more detailed logging
-            if not code_files:
-                logging.warning(f"No files found matching criteria in {source_dir}. Check file extensions and exclusion rules.")
-                for file_path in source_dir.rglob('*'):
-                    if file_path.is_file():
-                        logging.debug(f"Found file: {file_path}, Extension: {file_path.suffix}")
+            code_files = self.find_files_needing_tests(source_dir, test_suite_dir)
+
+            if self.batching:
+                for batch in tqdm(self.batches(code_files), desc=f"Generating tests for {source_dir.name} (batched)"):
+                    self.generate_tests_for_batch(batch, source_dir, test_suite_dir)
+                return
             
             for file_path in tqdm(code_files, desc=f"Generating tests for {source_dir.name}"):
                 try:
@@ -689,19 +965,8 @@ class CodeRefiner:
                         source_code = f.read()
                     
                     # Generate test case
-                    test_code = self.generate_test_case(source_code)
-                    
-                    # Get test file path
-                    test_file_path = self.get_test_file_path(file_path, source_dir, test_suite_dir)
-                    
-                    # Create directory if it doesn't exist
-                    test_file_path.parent.mkdir(parents=True, exist_ok=True)
-                    
-                    # Write test file
-                    with open(test_file_path, 'w', encoding='utf-8') as f:
-                        f.write(test_code)
-                    
-                    logging.info(f"Generated test case for: {file_path.relative_to(source_dir)}")
+                    test_code = self.generate_test_case(source_code, file_path)
+                    self.write_test_case(file_path, source_dir, test_suite_dir, test_code)
                     
                 except Exception as e:
                     logging.error(f"Error processing tests for {file_path}: {str(e)}")
@@ -711,6 +976,128 @@ class CodeRefiner:
             logging.error(f"Error processing tests for directory {source_dir}: {str(e)}")
             raise
 
+    def batches(self, items: list) -> List[list]:
+        """Split items into groups of at most batch_size."""
+        return [items[start:start + self.batch_size] for start in range(0, len(items), self.batch_size)]
+
+    def read_sources(self, file_paths: List[Path]) -> dict:
+        """Read the files of a batch; unreadable files are logged and left out."""
+        sources = {}
+        for file_path in file_paths:
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    sources[file_path] = f.read()
+            except Exception as e:
+                logging.error(f"Error processing tests for {file_path}: {str(e)}")
+        return sources
+
+    def write_batch_tests(self, sources: dict, responses: list, source_dir: Path, test_suite_dir: Path) -> None:
+        """Write the test case of every file in a batch from its response."""
+        for file_path, response in zip(sources, responses):
+            try:
+                self.write_test_case(file_path, source_dir, test_suite_dir, self.parse_test_code(response))
+            except Exception as e:
+                logging.error(f"Error processing tests for {file_path}: {str(e)}")
+
+    def generate_tests_for_batch(self, file_paths: List[Path], source_dir: Path, test_suite_dir: Path) -> None:
+        """Generate and write tests for several files in one batched request; failures are logged per file."""
+        sources = self.read_sources(file_paths)
+        if not sources:
+            return
+        try:
+            payloads = [self.test_payload(code) for code in sources.values()]
+            responses = self.query_api_batch(payloads, 'unit_test', next(iter(sources)))
+        except Exception as e:
+            for file_path in sources:
+                logging.error(f"Error processing tests for {file_path}: {str(e)}")
+            return
+        self.write_batch_tests(sources, responses, source_dir, test_suite_dir)
+
+    async def generate_tests_for_batch_async(self, file_paths: List[Path], source_dir: Path, test_suite_dir: Path) -> None:
+        """Async counterpart of generate_tests_for_batch."""
+        sources = self.read_sources(file_paths)
+        if not sources:
+            return
+        try:
+            payloads = [self.test_payload(code) for code in sources.values()]
+            responses = await self.query_api_batch_async(payloads, 'unit_test', next(iter(sources)))
+        except Exception as e:
+            for file_path in sources:
+                logging.error(f"Error processing tests for {file_path}: {str(e)}")
+            return
+        self.write_batch_tests(sources, responses, source_dir, test_suite_dir)
+
+    async def run_bounded(self, items, handler, desc: str) -> None:
+        """Await handler(item) for every item, at most max_in_flight at once, with a tqdm progress bar."""
+        progress = tqdm(total=len(items), desc=desc)
+
+        async def run_item(item):
+            async with self.in_flight:
+                try:
+                    await handler(item)
+                finally:
+                    progress.update(1)
+
+        try:
+            await asyncio.gather(*(run_item(item) for item in items))
+        finally:
+            progress.close()
+
+    async def process_tests_for_directory_async(self, source_dir: Path, test_suite_dir: Path) -> None:
+        """Async counterpart of process_tests_for_directory; files are processed concurrently."""
+        try:
+            test_suite_dir.mkdir(parents=True, exist_ok=True)
+            code_files = self.find_files_needing_tests(source_dir, test_suite_dir)
+
+            async def process(file_path):
+                try:
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        source_code = f.read()
+                    test_code = await self.generate_test_case_async(source_code, file_path)
+                    self.write_test_case(file_path, source_dir, test_suite_dir, test_code)
+                except Exception as e:
+                    logging.error(f"Error processing tests for {file_path}: {str(e)}")
+
+            if self.batching:
+                await self.run_bounded(
+                    self.batches(code_files),
+                    lambda batch: self.generate_tests_for_batch_async(batch, source_dir, test_suite_dir),
+                    f"Generating tests for {source_dir.name} (batched)"
+                )
+            else:
+                await self.run_bounded(code_files, process, f"Generating tests for {source_dir.name}")
+
+        except Exception as e:
+            logging.error(f"Error processing tests for directory {source_dir}: {str(e)}")
+            raise
+
+    async def process_all_async(self, code_files: List[Path]) -> None:
+        """
+        Refine files and generate tests for the original sources concurrently, then generate tests
+        for GreenCode, sharing one pooled AsyncClient and at most max_in_flight files in flight.
+        """
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        async def refine(file_path):
+            try:
+                print(f"\nOptimizing: {file_path.name}")
+                await self.process_file_async(file_path)
+            except Exception as e:
+                logging.error(f"Skipping file {file_path} due to error: {str(e)}")
+                self.failed_files.add(file_path)
+
+        async with create_pooled_async_client(self.http_pool_size, 30, self.http2, self.connection_stats) as client:
+            self.async_http_client = client
+            print("\nRefining files and generating tests for original source files...")
+            await asyncio.gather(
+                self.run_bounded(code_files, refine, "Processing files for optimization"),
+                self.process_tests_for_directory_async(self.project_path, self.project_path / self.src_test_suite)
+            )
+            logging.info("Code refinement completed successfully")
+
+            print("\nGenerating tests for optimized files...")
+            await self.process_tests_for_directory_async(self.output_path, self.output_path / self.greencode_test_suite)
+
     def process_greencode_tests(self) -> None:
         """Process test cases for GreenCode directory."""
         try:
@@ -746,36 +1133,54 @@ class CodeRefiner:
             # Ensure Result directory exists
             ensure_result_directory()
 
+            # Incremental mode: find files changed since the last run, plus those it failed to refine (None means a full run)
+            refinement_state_path = self.project_path / 'Result' / 'incremental_state.json'
+            incremental_excluded_dirs = ('GreenCode', self.src_test_suite, 'Result')
+            changes = (get_incremental_changes(self.project_path, refinement_state_path, incremental_excluded_dirs)
+                       if self.incremental else None)
+
             # First phase: Code refinement
-            self.setup_output_directory()
+            self.setup_output_directory(preserve_existing=changes is not None)
             code_files = self.get_code_files()
             
+            if changes is not None:
+                for stale_path in changes.changed | changes.deleted:
+                    self.discard_generated_outputs(Path(stale_path))
+                code_files = [f for f in code_files if os.path.normpath(str(f)) in changes.changed]
+                logging.info(f"Incremental mode: {len(code_files)} files selected for refinement")
+            
             if not code_files:
                 print("No files to process. Please check your QWEN_FILE_EXTENSIONS configuration.")
                 return
-                
-            # Process code refinement
-            for file_path in tqdm(code_files, desc="Processing files for optimization"):
-                try:
-                    print(f"\nOptimizing: {file_path.name}")
-                    self.process_file(file_path)
-                    time.sleep(0.1)
-                except Exception as e:
-                    logging.error(f"Skipping file {file_path} due to error: {str(e)}")
-                    continue
-            
-            logging.info("Code refinement completed successfully")
-            
-            # Second phase: Test case generation
-            print("\nStarting test case generation...")
-            
-            # Generate tests for root directory first
-            print("\nGenerating tests for original source files...")
-            self.process_source_tests()
-            
-            # Generate tests for GreenCode directory
-            print("\nGenerating tests for optimized files...")
-            self.process_greencode_tests()
+
+            self.warm_up()
+
+            if self.async_mode:
+                asyncio.run(self.process_all_async(code_files))
+            else:
+                # Process code refinement
+                for file_path in tqdm(code_files, desc="Processing files for optimization"):
+                    try:
+                        print(f"\nOptimizing: {file_path.name}")
+                        self.process_file(file_path)
+                        time.sleep(0.1)
+                    except Exception as e:
+                        logging.error(f"Skipping file {file_path} due to error: {str(e)}")
+                        self.failed_files.add(file_path)
+                        continue
+
+                logging.info("Code refinement completed successfully")
+
+                # Second phase: Test case generation
+                print("\nStarting test case generation...")
+
+                # Generate tests for root directory first
+                print("\nGenerating tests for original source files...")
+                self.process_source_tests()
+
+                # Generate tests for GreenCode directory
+                print("\nGenerating tests for optimized files...")
+                self.process_greencode_tests()
 
             # Track metrics for generated test files
             self.track_test_files()
@@ -785,6 +1190,12 @@ class CodeRefiner:
             
             # Update final overview
             MetricsHandler.update_final_overview(self.metrics_tracker, self.project_path)
+            self.llm_metrics.write_summary()
+            self.connection_stats.log_summary()
+            run_ledger.close()
+
+            if self.incremental:
+                save_refinement_state(self.project_path, refinement_state_path, self.failed_files, incremental_excluded_dirs)
             
             logging.info("Test case generation completed successfully")
             print("\nCode refinement and test generation process completed!")
@@ -792,6 +1203,8 @@ class CodeRefiner:
         except Exception as e:
             logging.error(f"Error during execution: {str(e)}")
             raise
+        finally:
+            self.http_client.close()
 
     def track_test_files(self):
         """Track metrics for generated test files."""
@@ -802,9 +1215,8 @@ class CodeRefiner:
         
         for test_dir in test_directories:
             if test_dir.exists():
-                for test_file in test_dir.rglob('*'):
-                    if test_file.is_file() and test_file.suffix in self.supported_extensions:
-                        self.metrics_tracker.track_file(test_file)
+                for test_file in self.file_index(test_dir).find(self.supported_extensions):
+                    self.metrics_tracker.track_file(Path(test_file))
 
 if __name__ == "__main__":
     try:
@@ -1,14 +1,30 @@
 import os
+import re
 import json
 import shutil
 import logging
 import time
 import requests
 from dotenv import load_dotenv
-import csv
+from openai import DefaultHttpxClient, DefaultAsyncHttpxClient
 from datetime import datetime
 import sys
+import hashlib
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
+from refinement_cache import RefinementCache
+from llm_metrics import LLMMetricsRecorder
+from rate_limiter import RateLimiter, RateLimitedTransport, AsyncRateLimitedTransport, ESTIMATED_BYTES_PER_TOKEN
+from rate_limiter import start_retry_count, retry_count
+from code_chunker import split_into_chunks
+from file_discovery import get_file_index
+from run_ledger import RunLedger
+from token_counter import Tokenizer
 
 def get_env_variable(var_name, is_required=True):
     value = os.getenv(var_name)
@@ -17,6 +33,28 @@ def get_env_variable(var_name, is_required=True):
         raise EnvironmentError(f"Missing required environment variable: {var_name}")
     return value
 
+def get_int_env_variable(var_name, default):
+    """Read an integer environment variable, falling back to the default on missing or invalid values."""
+    value = os.getenv(var_name)
+    if value is None or not value.strip():
+        return default
+    try:
+        return int(value.strip())
+    except ValueError:
+        logging.warning(f"Environment variable '{var_name}' is not a valid integer ('{value}'), using default {default}.")
+        return default
+
+def get_float_env_variable(var_name, default):
+    """Read a float environment variable, falling back to the default on missing or invalid values."""
+    value = os.getenv(var_name)
+    if value is None or not value.strip():
+        return default
+    try:
+        return float(value.strip())
+    except ValueError:
+        logging.warning(f"Environment variable '{var_name}' is not a valid number ('{value}'), using default {default}.")
+        return default
+
 def check_azure_subscription(api_key, azure_endpoint, api_version):
     logging.info("Checking Azure subscription availability...")
 
@@ -81,7 +119,7 @@ def ensure_directory_structure(path):
                 os.makedirs(path)
                 logging.info(f"Directory '{path}' created successfully after removing the conflicting file.")
         else:
-            os.makedirs(path)
+            os.makedirs(path, exist_ok=True)
             logging.info(f"Directory '{path}' created successfully.")
     except FileExistsError:
         logging.warning(f"Directory '{path}' already exists. This error was safely handled.")
@@ -89,13 +127,13 @@ def ensure_directory_structure(path):
         logging.error(f"An unexpected error occurred while ensuring directory '{path}': {e}")
 
 
-def identify_source_files(directory, extensions, excluded_files):
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file in excluded_files:
-                continue
-            if file.endswith(tuple(extensions)):
-                yield os.path.join(root, file)
+# Generated output directories, never treated as source
+GENERATED_DIRECTORIES = ('GreenCode', 'SRC-TestSuite', 'GreenCode-TestSuite')
+
+def identify_source_files(directory, extensions, excluded_files, excluded_dirs=()):
+    """List files with the given extensions, pruning excluded and .gitignore'd directories during the walk."""
+    index = get_file_index(directory, excluded_dirs, cache_path=FILE_INDEX_CACHE)
+    return index.find(extensions, excluded_files)
 
 def load_prompts_from_env():
     prompts = []
@@ -117,6 +155,9 @@ load_dotenv(dotenv_path=env_path, verbose=True, override=True)
 source_directory = os.path.dirname(env_path)
 RESULT_DIR = os.path.join(source_directory , 'Result')
 
+# Persisted directory listings shared by every script that discovers files
+FILE_INDEX_CACHE = os.path.join(source_directory, '.greencode_cache', 'file_index.json')
+
 # Existing logging configuration remains the same...
 
 def ensure_result_directory():
@@ -129,21 +170,6 @@ def ensure_result_directory():
             logging.error(f"Failed to create Result directory: {e}")
             raise
 
-def ensure_csv_exists():
-    """Ensure the CSV file exists and has the correct headers."""
-    ensure_result_directory()  # Make sure the Result directory exists
-    csv_path = os.path.join(RESULT_DIR, 'modification_overview.csv')
-    
-    if not os.path.exists(csv_path):
-        try:
-            with open(csv_path, 'w', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=['File Name', 'Modification Timestamp', 'Changes', 'Next Steps'])
-                writer.writeheader()
-            logging.info(f"Created modification_overview.csv at: {csv_path}")
-        except Exception as e:
-            logging.error(f"Failed to create CSV file: {e}")
-            raise
-
 def extract_section(content, start_marker, end_marker):
     """Extract content between specific markers."""
     try:
@@ -171,21 +197,9 @@ def extract_section(content, start_marker, end_marker):
         return None
 
 def log_modifications(file_name, changes, next_steps):
-    """Log modifications to the CSV file."""
-    csv_path = os.path.join(RESULT_DIR, 'modification_overview.csv')
-    ensure_csv_exists()
-    
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
+    """Log modifications to the run ledger (exported to modification_overview.csv)."""
     try:
-        with open(csv_path, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=['File Name', 'Modification Timestamp', 'Changes', 'Next Steps'])
-            writer.writerow({
-                'File Name': file_name,
-                'Modification Timestamp': timestamp,
-                'Changes': changes,
-                'Next Steps': next_steps
-            })
+        run_ledger.record_modification(file_name, changes, next_steps)
         logging.info(f"Logged modifications for file: {file_name}")
     except Exception as e:
         logging.error(f"Failed to log modifications: {e}")
@@ -211,11 +225,15 @@ def extract_changes_summary(data):
         logging.warning(f"Error extracting changes summary: {e}")
         return "Error extracting changes", "Error identifying next steps"
     
+# Collects (file_path, extension, loc) for files tracked inside MetricsTracker.capture()
+_captured_files = contextvars.ContextVar('captured_files', default=None)
+
 class MetricsTracker:
     def __init__(self):
         self.start_time = time.time()
         self.files_modified = 0
         self.loc_by_extension = defaultdict(int)
+        self._lock = threading.Lock()
         
     def count_loc(self, file_path):
         """Count lines of code in a file."""
@@ -232,137 +250,430 @@ class MetricsTracker:
         
     def track_file(self, file_path):
         """Track metrics for a single file."""
-        self.files_modified += 1
         loc = self.count_loc(file_path)
         ext = self.get_extension(file_path)
-        self.loc_by_extension[ext] += loc
+        with self._lock:
+            self.files_modified += 1
+            self.loc_by_extension[ext] += loc
+        captured = _captured_files.get()
+        if captured is not None:
+            captured.append((file_path, ext, loc))
+        run_ledger.record_file(file_path, ext, loc)
+
+    @contextmanager
+    def capture(self):
+        """Collect the files tracked in the current thread or task, e.g. to journal a stage's counters."""
+        captured = []
+        token = _captured_files.set(captured)
+        try:
+            yield captured
+        finally:
+            _captured_files.reset(token)
+
+    def add_tracked(self, tracked):
+        """Re-apply (file_path, extension, loc) entries recorded by an earlier, interrupted attempt."""
+        for file_path, ext, loc in tracked:
+            with self._lock:
+                self.files_modified += 1
+                self.loc_by_extension[ext] += loc
+            run_ledger.record_file(file_path, ext, loc)
         
     def get_processing_time(self):
         """Get processing time in minutes."""
         return (time.time() - self.start_time) / 60
 
 def update_final_overview():
-    """Update the final overview CSV with fresh and historical data."""
-    csv_path = os.path.join(RESULT_DIR, 'final_overview.csv')
-    historical_data = load_historical_data(csv_path)
-    current_metrics = get_current_run_metrics()
-    
+    """Close this run in the ledger and export final_overview.csv and modification_overview.csv from it."""
+    run_ledger.finish_run(
+        metrics_tracker.files_modified,
+        dict(metrics_tracker.loc_by_extension),
+        metrics_tracker.get_processing_time()
+    )
+    run_ledger.export_final_overview(os.path.join(RESULT_DIR, 'final_overview.csv'))
+    run_ledger.export_modifications(os.path.join(RESULT_DIR, 'modification_overview.csv'))
+
+# Runs, converted files and modifications of every run (Result/refinement_ledger.db)
+run_ledger = RunLedger(
+    os.path.join(RESULT_DIR, 'refinement_ledger.db'),
+    os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'RefinerFunction'
+)
+
+# Initialize global metrics tracker
+metrics_tracker = MetricsTracker()
+
+# Per-request LLM timings, token usage and cost for this run (Result/llm_requests_<run>.csv)
+llm_metrics = LLMMetricsRecorder(
+    RESULT_DIR,
+    get_float_env_variable('LLM_PROMPT_COST_PER_1K', 0.0),
+    get_float_env_variable('LLM_COMPLETION_COST_PER_1K', 0.0)
+)
+
+class UploadRegistry:
+    """
+    Per-run registry of uploaded files keyed by content hash and file name, so the same
+    bytes are uploaded once and their file ID is reused across prompts and steps.
+    Also remembers threads and generated files so they can be deleted at the end of the run.
+    """
+    def __init__(self):
+        self._file_ids = {}
+        self._upload_locks = {}
+        self._thread_ids = []
+        self._generated_file_ids = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(file_bytes, file_name):
+        # The name is part of the key because code_interpreter exposes the upload under its file name
+        return (hashlib.sha256(file_bytes).hexdigest(), file_name)
+
+    def lookup(self, key):
+        """Return the file ID already uploaded for key, if any."""
+        with self._lock:
+            return self._file_ids.get(key)
+
+    def register(self, key, file_id):
+        """Record an upload made outside upload(), e.g. by the async client."""
+        with self._lock:
+            self._file_ids[key] = file_id
+
+    def upload(self, client, file_path):
+        """Return the file ID for file_path, uploading it only if these bytes were not uploaded yet."""
+        with open(file_path, 'rb') as f:
+            file_bytes = f.read()
+        file_name = os.path.basename(file_path)
+        key = self.make_key(file_bytes, file_name)
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(key, threading.Lock())
+        with upload_lock:
+            file_id = self.lookup(key)
+            if file_id:
+                logging.info(f"Reusing uploaded file {file_id} for: {file_name}")
+                llm_metrics.record('upload', file_path, None, 'reused', upload_seconds=0.0, total_seconds=0.0)
+                return file_id
+            start_time = time.time()
+            try:
+                uploaded_file = client.files.create(file=(file_name, file_bytes), purpose='assistants')
+            except Exception:
+                elapsed = time.time() - start_time
+                llm_metrics.record('upload', file_path, None, 'error', upload_seconds=elapsed, total_seconds=elapsed)
+                raise
+            elapsed = time.time() - start_time
+            llm_metrics.record('upload', file_path, None, 'uploaded', upload_seconds=elapsed, total_seconds=elapsed)
+            self.register(key, uploaded_file.id)
+            return uploaded_file.id
+
+    def track_thread(self, thread_id):
+        with self._lock:
+            self._thread_ids.append(thread_id)
+
+    def track_generated_file(self, file_id):
+        with self._lock:
+            self._generated_file_ids.append(file_id)
+
+    @staticmethod
+    def _delete(delete_func, resource_id):
+        try:
+            delete_func(resource_id)
+            return True
+        except Exception as e:
+            logging.warning(f"Failed to delete {resource_id}: {e}")
+            return False
+
+    def start_cleanup(self, client):
+        """Delete every tracked upload, generated file and thread on a background thread."""
+        with self._lock:
+            file_ids = list(self._file_ids.values()) + self._generated_file_ids
+            thread_ids = list(self._thread_ids)
+            self._file_ids.clear()
+            self._upload_locks.clear()
+            self._generated_file_ids = []
+            self._thread_ids = []
+
+        def cleanup():
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(lambda file_id: self._delete(client.files.delete, file_id), file_ids))
+                results += list(executor.map(lambda thread_id: self._delete(client.beta.threads.delete, thread_id), thread_ids))
+            logging.info(f"Cleaned up {sum(results)} of {len(results)} uploaded files and threads")
+
+        # Non-daemon so the interpreter waits for the deletions before exiting
+        worker = threading.Thread(target=cleanup, name='upload-cleanup')
+        worker.start()
+        return worker
+
+# Uploads, threads and generated files of the current run
+upload_registry = UploadRegistry()
+
+# One limiter shared by every Azure OpenAI client in the process (0 disables a limit)
+rate_limiter = RateLimiter(
+    get_int_env_variable('AZURE_REQUESTS_PER_MINUTE', 0),
+    get_int_env_variable('AZURE_TOKENS_PER_MINUTE', 0),
+    max_retries=get_int_env_variable('RATE_LIMIT_MAX_RETRIES', 5)
+)
+
+def create_http_client():
+    """
+    HTTP client for AzureOpenAI(http_client=...) that applies the shared rate limiter.
+    The transport retries throttled and transient failures, so the client must be created with max_retries=0.
+    """
+    return DefaultHttpxClient(transport=RateLimitedTransport(rate_limiter))
+
+def create_async_http_client():
+    """HTTP client for AsyncAzureOpenAI(http_client=...) that applies the shared rate limiter."""
+    return DefaultAsyncHttpxClient(transport=AsyncRateLimitedTransport(rate_limiter))
+
+def cleanup_run_resources(client):
+    """Start deleting this run's uploads and threads in the background."""
+    return upload_registry.start_cleanup(client)
+
+# Local record of the assistants created by earlier runs, so they can be reused
+ASSISTANT_STATE_FILE = os.getenv('ASSISTANT_STATE_FILE') or os.path.join(RESULT_DIR, 'assistant_state.json')
+
+def _load_assistant_state(state_path):
     try:
-        with open(csv_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            
-            # Write headers
-            writer.writerow(['Metric', 'Value'])
-            writer.writerow([])  # Empty row for separation
-            
-            # Fresh Details Section
-            writer.writerow(['=== Fresh Details (Last Run) ==='])
-            for metric, value in current_metrics.items():
-                writer.writerow([metric, value])
-            
-            writer.writerow([])  # Empty row for separation
-            
-            # Historical Overview Section
-            writer.writerow(['=== Historical Overview ==='])
-            historical_metrics = combine_metrics(historical_data, current_metrics)
-            for metric, value in historical_metrics.items():
-                writer.writerow([metric, value])
-                
-        logging.info(f"Updated final overview at: {csv_path}")
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
     except Exception as e:
-        logging.error(f"Failed to update final overview: {e}")
+        logging.warning(f"Ignoring unreadable assistant state file {state_path}: {e}")
+        return {}
+
+def get_or_create_assistant(client, name_prefix, instructions, model, tools, state_path=None):
+    """
+    Reuse the assistant recorded in the state file when its instructions, model and tools are unchanged.
+    A new assistant is created (and the outdated one deleted) only when the configuration hash changes.
+    """
+    state_path = state_path or ASSISTANT_STATE_FILE
+    config_hash = hashlib.sha256(
+        json.dumps({'instructions': instructions, 'model': model, 'tools': tools}, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+    slot = f"{name_prefix}:{model}"
+    state = _load_assistant_state(state_path)
+    recorded = state.get(slot) or {}
 
-def load_historical_data(csv_path):
-    """Load historical data from existing CSV file."""
-    historical_data = {}
-    if os.path.exists(csv_path):
+    if recorded.get('config_hash') == config_hash and recorded.get('assistant_id'):
+        try:
+            assistant = client.beta.assistants.retrieve(recorded['assistant_id'])
+            logging.info(f"Reusing assistant '{assistant.name}' ({assistant.id}).")
+            return assistant
+        except Exception as e:
+            logging.warning(f"Recorded assistant {recorded['assistant_id']} is unavailable, creating a new one: {e}")
+    elif recorded.get('assistant_id'):
+        # Configuration changed; remove the outdated assistant instead of leaving it orphaned
         try:
-            with open(csv_path, 'r', newline='') as csvfile:
-                reader = csv.reader(csvfile)
-                historical_section = False
-                for row in reader:
-                    if not row:
-                        continue
-                    if row[0] == '=== Historical Overview ===':
-                        historical_section = True
-                        continue
-                    if historical_section and len(row) == 2:
-                        metric, value = row[0], row[1]
-                        # Handle different value formats
-                        if 'LOC' in value:
-                            # Extract numeric value before 'LOC'
-                            historical_data[metric] = int(value.split()[0])
-                        elif '.' in value:
-                            # Handle floating point values
-                            historical_data[metric] = float(value)
-                        else:
-                            # Handle integer values
-                            historical_data[metric] = int(value)
+            client.beta.assistants.delete(recorded['assistant_id'])
+            logging.info(f"Deleted outdated assistant {recorded['assistant_id']}.")
         except Exception as e:
-            logging.warning(f"Error loading historical data: {e}")
-    return historical_data
-
-def get_current_run_metrics():
-    """Get metrics for the current run."""
-    metrics = {
-        'Total Files Modified (Last run)': metrics_tracker.files_modified,
-        'Total LOC Converted (Last run)': sum(metrics_tracker.loc_by_extension.values()),
-        'Total Time (minutes) (Last run)': round(metrics_tracker.get_processing_time(), 2)
+            logging.warning(f"Failed to delete outdated assistant {recorded['assistant_id']}: {e}")
+
+    name = f"{name_prefix} {config_hash[:12]}"
+    assistant = client.beta.assistants.create(name=name, instructions=instructions, model=model, tools=tools)
+    logging.info(f"Assistant '{name}' created successfully.")
+
+    state[slot] = {
+        'assistant_id': assistant.id,
+        'config_hash': config_hash,
+        'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     }
-    
-    # Add per-extension metrics
-    for ext, loc in metrics_tracker.loc_by_extension.items():
-        metrics[f'.{ext} Files (Last run)'] = f"{loc} LOC"
-    
-    return metrics
+    try:
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(state_path, 'w') as f:
+            json.dump(state, f, indent=2)
+    except Exception as e:
+        logging.warning(f"Failed to record assistant state in {state_path}: {e}")
+    return assistant
 
-def combine_metrics(historical, current):
-    """Combine historical and current metrics."""
-    combined = {}
-    
-    # Base metrics
-    combined['Total Files Modified'] = (
-        historical.get('Total Files Modified', 0) +
-        current['Total Files Modified (Last run)']
-    )
-    
-    combined['Total LOC Converted'] = (
-        historical.get('Total LOC Converted', 0) +
-        sum(metrics_tracker.loc_by_extension.values())
-    )
-    
-    combined['Total Time (minutes)'] = round(
-        historical.get('Total Time (minutes)', 0) +
-        current['Total Time (minutes) (Last run)'],
-        2
-    )
-    
-    # Combine extension-specific metrics
-    for ext, loc in metrics_tracker.loc_by_extension.items():
-        hist_key = f'.{ext} Files'
-        # Get historical LOC value, assuming 0 if not present
-        hist_loc = historical.get(hist_key, 0)
-        # If historical value is still in "X LOC" format, extract the number
-        if isinstance(hist_loc, str) and 'LOC' in hist_loc:
-            hist_loc = int(hist_loc.split()[0])
-        combined[hist_key] = f"{hist_loc + loc} LOC"
-    
-    return combined
+# Content-addressed cache of refined files and generated tests, kept outside GreenCode so it survives wipes
+refinement_cache = RefinementCache(
+    os.getenv('REFINEMENT_CACHE_DIR') or os.path.join(source_directory, '.greencode_cache'),
+    get_int_env_variable('REFINEMENT_CACHE_MAX_MB', 512)
+)
 
-# Initialize global metrics tracker
-metrics_tracker = MetricsTracker()
+def get_cache_key(file_path, prompt, assistant):
+    """Build the refinement cache key for a file, prompt and assistant configuration."""
+    with open(file_path, 'rb') as f:
+        file_bytes = f.read()
+    return RefinementCache.make_key(file_bytes, prompt, assistant.model, assistant.instructions)
+
+def restore_cached_output(cache_key, target_path):
+    """Restore a cached output to target_path, tracking and logging it like a fresh result."""
+    metadata = refinement_cache.restore(cache_key, target_path)
+    if metadata is None:
+        return False
+    metrics_tracker.track_file(target_path)
+    # Fused entries hold one summary per prompt, logged as separate rows like a fresh result
+    summaries = metadata.get('summaries') or [(metadata.get('changes'), metadata.get('next_steps'))]
+    for changes, next_steps in summaries:
+        log_modifications(os.path.basename(target_path), changes, next_steps)
+    logging.info(f"Restored {os.path.basename(target_path)} from refinement cache")
+    return True
+
+# Run completion settings: 'poll' uses adaptive backoff, 'stream' consumes run events as they happen
+RUN_COMPLETION_MODE = (os.getenv('RUN_COMPLETION_MODE') or 'poll').strip().lower()
+RUN_TIMEOUT_SECONDS = get_int_env_variable('RUN_TIMEOUT_SECONDS', 1200)
+RUN_POLL_INITIAL_INTERVAL = 0.5
+RUN_POLL_MAX_INTERVAL = 5.0
+RUN_POLL_BACKOFF_FACTOR = 1.5
+
+# Run states after which the assistant makes no further progress on its own
+TERMINAL_RUN_STATUSES = {'completed', 'failed', 'cancelled', 'expired', 'incomplete', 'requires_action'}
+
+def cancel_run(client, thread_id, run_id):
+    """Cancel a run so it stops holding server-side capacity."""
+    try:
+        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        logging.info(f"Cancelled run {run_id} on thread {thread_id}")
+    except Exception as e:
+        logging.warning(f"Failed to cancel run {run_id}: {e}")
+
+def _find_latest_run(client, thread_id):
+    """Return the most recent run on a thread, or None if it has none or the lookup fails."""
+    try:
+        runs = client.beta.threads.runs.list(thread_id=thread_id, limit=1, order='desc')
+        return runs.data[0] if runs.data else None
+    except Exception as e:
+        logging.warning(f"Unable to look up the run on thread {thread_id}: {e}")
+        return None
+
+def _stream_run(client, thread_id, assistant_id, deadline):
+    """Create a run with streaming enabled and follow its events until a terminal state or the deadline."""
+    run = None
+    stream = client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id, stream=True)
+    try:
+        for event in stream:
+            # Only run lifecycle events carry the run object; steps and message deltas are ignored
+            if event.event.startswith('thread.run.') and not event.event.startswith('thread.run.step.'):
+                run = event.data
+                if run.status in TERMINAL_RUN_STATUSES:
+                    break
+            if time.time() >= deadline:
+                break
+    except Exception as e:
+        if run is None:
+            raise
+        logging.warning(f"Run event stream for {run.id} interrupted, continuing by polling: {e}")
+    finally:
+        stream.close()
+    return run
+
+def _poll_run(client, thread_id, run, deadline, stats=None):
+    """Poll a run with exponential backoff until it reaches a terminal state or the deadline passes."""
+    interval = RUN_POLL_INITIAL_INTERVAL
+    while run.status not in TERMINAL_RUN_STATUSES:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+        interval = min(interval * RUN_POLL_BACKOFF_FACTOR, RUN_POLL_MAX_INTERVAL)
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        if stats is not None:
+            stats['poll_count'] = stats.get('poll_count', 0) + 1
+    return run
+
+def execute_run(client, thread_id, assistant_id, description, stats=None):
+    """
+    Create an assistant run on a new thread and wait for it to finish.
+    Returns the final run object. Runs that miss RUN_TIMEOUT_SECONDS are cancelled.
+    If a stats dict is given, the number of status polls is counted in stats['poll_count'].
+    """
+    deadline = time.time() + RUN_TIMEOUT_SECONDS
+    run = None
+
+    if RUN_COMPLETION_MODE == 'stream':
+        try:
+            run = _stream_run(client, thread_id, assistant_id, deadline)
+        except Exception as e:
+            logging.warning(f"Streaming unavailable for {description}, falling back to polling: {e}")
+        if run is None:
+            # The stream may have failed after the run was created; a second run would be rejected
+            # while that one is active, so it is polled instead
+            run = _find_latest_run(client, thread_id)
+
+    if run is None:
+        run = client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
+
+    if run.status not in TERMINAL_RUN_STATUSES:
+        run = _poll_run(client, thread_id, run, deadline, stats)
+
+    if run.status not in TERMINAL_RUN_STATUSES:
+        logging.warning(f"Run {run.id} for {description} exceeded {RUN_TIMEOUT_SECONDS}s, cancelling it.")
+        cancel_run(client, thread_id, run.id)
+    elif run.status == 'requires_action':
+        # The assistant only has code_interpreter, so nothing can satisfy a tool call request
+        logging.warning(f"Run {run.id} for {description} requested an unsupported action, cancelling it.")
+        cancel_run(client, thread_id, run.id)
+    elif run.status != 'completed':
+        logging.error(f"Run {run.id} for {description} ended with status '{run.status}': {getattr(run, 'last_error', None)}")
+
+    return run
+
+def get_run_measurements(run):
+    """Server-side queue and run time and token usage of a finished run, as llm_metrics measurements."""
+    measurements = {}
+    created_at = getattr(run, 'created_at', None)
+    started_at = getattr(run, 'started_at', None)
+    finished_at = (getattr(run, 'completed_at', None) or getattr(run, 'failed_at', None)
+                   or getattr(run, 'cancelled_at', None))
+    if created_at and started_at:
+        measurements['queue_seconds'] = float(started_at - created_at)
+    if started_at and finished_at:
+        measurements['run_seconds'] = float(finished_at - started_at)
+    usage = getattr(run, 'usage', None)
+    if usage is not None:
+        measurements['prompt_tokens'] = usage.prompt_tokens
+        measurements['completion_tokens'] = usage.completion_tokens
+    return measurements
+
+def run_assistant_request(client, assistant, prompt, file_ids, description, operation='refine', source_path=None):
+    """
+    Send a prompt with attached files to the assistant on a new thread and wait for the run.
+    Returns the thread messages as a dict, or None if the run did not complete.
+    Timings, poll count, throttling retries and token usage are recorded in llm_metrics under the given operation.
+    """
+    start_time = time.time()
+    start_retry_count()
+    stats = {'poll_count': 0}
+    outcome = 'error'
+    run = None
+    try:
+        thread = client.beta.threads.create(
+            messages=[{"role": "user", "content": prompt, "file_ids": file_ids}]
+        )
+        upload_registry.track_thread(thread.id)
+        run = execute_run(client, thread.id, assistant.id, description, stats)
+        outcome = run.status if run.status in TERMINAL_RUN_STATUSES else 'timeout'
+        if run.status != 'completed':
+            logging.warning(f"Assistant request did not complete for {description} (status: {run.status})")
+            return None
+
+        messages = client.beta.threads.messages.list(thread_id=thread.id)
+        return json.loads(messages.model_dump_json(indent=2))
+    finally:
+        measurements = get_run_measurements(run) if run is not None else {}
+        llm_metrics.record(
+            operation, source_path, assistant.model, outcome,
+            total_seconds=time.time() - start_time, poll_count=stats['poll_count'], retries=retry_count(), **measurements
+        )
+
+def get_test_file_path(file_path, test_file_directory):
+    """Return the generated test path for a file, mirroring its location relative to the source directory."""
+    base_name, ext = os.path.splitext(os.path.basename(file_path))
+    relative_path = os.path.relpath(file_path, source_directory)
+    return os.path.join(test_file_directory, os.path.dirname(relative_path), f"{base_name}Test{ext}")
 
 def create_unit_test_files(client, assistant, file_list, test_file_directory):
+    """Generate unit tests for the given files. Returns False if any test could not be generated."""
     prompt_testcase = get_env_variable('PROMPT_GENERATE_TESTCASES', is_required=False)
     if not prompt_testcase or ", " not in prompt_testcase:
         logging.warning("Unit test case prompt not found or incorrectly formatted in .env.")
-        return
+        return True
     
     prompt, toggle = prompt_testcase.rsplit(", ", 1)
     if toggle.strip().lower() != 'y':
         logging.info("Skipping unit test generation as per .env configuration.")
-        return
+        return True
 
+    all_created = True
     for file_path in file_list:
         file_name = os.path.basename(file_path)
         base_name, ext = os.path.splitext(file_name)
@@ -371,51 +682,35 @@ def create_unit_test_files(client, assistant, file_list, test_file_directory):
             logging.info(f"Skipping test file: {file_path}")
             continue
 
-            # -----------------modefied code-----------------
-
-        # Get the relative path of the file from the source directory
-        relative_path = os.path.relpath(file_path, source_directory)       #added
-            
-        # test_file_name = f"{base_name}Test{ext}"
-        # test_file_path = os.path.join(test_file_directory, test_file_name)
-
         # Construct the test file path preserving the directory structure
-        test_file_name = f"{base_name}Test{ext}"    #replaced
-        test_file_path = os.path.join(test_file_directory, os.path.dirname(relative_path), test_file_name) #replaced
+        test_file_name = f"{base_name}Test{ext}"
+        test_file_path = get_test_file_path(file_path, test_file_directory)
         
         # Ensure the directory structure exists in the test directory
-        ensure_directory_structure(os.path.dirname(test_file_path)) #added
-
-            #-------------------------------------------------
+        ensure_directory_structure(os.path.dirname(test_file_path))
 
         if os.path.exists(test_file_path):
             logging.info(f"Test file already exists: {test_file_path}")
             continue
 
         try:
-            with open(file_path, "rb") as file:
-                uploaded_file = client.files.create(file=file, purpose='assistants')
-                logging.info(f"File uploaded for unit test creation: {file_name}")
-
             prompt_formatted = prompt.format(file_extension=ext, file_name=file_name)
-            thread = client.beta.threads.create(
-                messages=[{"role": "user", "content": prompt_formatted, "file_ids": [uploaded_file.id]}]
-            )
-            run = client.beta.threads.runs.create(thread_id=thread.id, assistant_id=assistant.id)
 
-            # Wait for completion
-            start_time = time.time()
-            while True:
-                run_status = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id).status
-                if run_status == 'completed':
-                    break
-                elif time.time() - start_time > 1200:
-                    logging.warning(f"Unit test creation timed out for file: {file_name}")
-                    break
-                time.sleep(5)
+            # Reuse a previously generated test when neither the file nor the request changed
+            cache_key = get_cache_key(file_path, prompt_formatted, assistant)
+            if restore_cached_output(cache_key, test_file_path):
+                continue
+
+            file_id = upload_registry.upload(client, file_path)
+            logging.info(f"File uploaded for unit test creation: {file_name}")
 
-            messages = client.beta.threads.messages.list(thread_id=thread.id)
-            data = json.loads(messages.model_dump_json(indent=2))
+            data = run_assistant_request(
+                client, assistant, prompt_formatted, [file_id], f"unit test creation for {file_name}",
+                operation='unit_test', source_path=file_path
+            )
+            if data is None:
+                all_created = False
+                continue
             
             # Extract code and changes summary
             code = None
@@ -423,6 +718,7 @@ def create_unit_test_files(client, assistant, file_list, test_file_directory):
                 code = data['data'][0]['content'][0]['text']['annotations'][0]['file_path']['file_id']
 
             if code:
+                upload_registry.track_generated_file(code)
                 content = client.files.content(code)
                 content.write_to_file(test_file_path)
 
@@ -432,41 +728,35 @@ def create_unit_test_files(client, assistant, file_list, test_file_directory):
                 # Log modifications to the central CSV file
                 changes_summary, next_steps = extract_changes_summary(data)
                 log_modifications(test_file_name, changes_summary, next_steps)
+                refinement_cache.put(cache_key, test_file_path, changes_summary, next_steps)
                 
                 logging.info(f"Unit test file created: {test_file_path}")
 
             else:
+                all_created = False
                 logging.error(f"Failed to create unit test for file: {file_path}")
 
         except Exception as e:
+            all_created = False
             logging.error(f"Error processing file {file_name} for unit test: {e}")
+
+    return all_created
             
-def apply_green_prompts(client, assistant, file_id, prompt, refined_file_path):
+def apply_green_prompts(client, assistant, file_id, prompt, refined_file_path, cache_key=None):
     logging.info(f"Applying prompt: {prompt} to file {file_id}")
     try:
-        thread = client.beta.threads.create(
-            messages=[{"role": "user", "content": prompt, "file_ids": [file_id]}]
+        data = run_assistant_request(
+            client, assistant, prompt, [file_id], f"file {file_id}", operation='refine', source_path=refined_file_path
         )
-        run = client.beta.threads.runs.create(thread_id=thread.id, assistant_id=assistant.id)
-
-        start_time = time.time()
-        while True:
-            run_status = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id).status
-            if run_status == 'completed':
-                break
-            elif time.time() - start_time > 1200:
-                logging.warning(f"Processing timed out for file: {file_id}")
-                return False
-            time.sleep(5)
-
-        messages = client.beta.threads.messages.list(thread_id=thread.id)
-        data = json.loads(messages.model_dump_json(indent=2))
+        if data is None:
+            return False
 
         code = None
         if data['data'] and data['data'][0]['content'] and data['data'][0]['content'][0]['text']['annotations']:
             code = data['data'][0]['content'][0]['text']['annotations'][0]['file_path']['file_id']
 
         if code:
+            upload_registry.track_generated_file(code)
             try:
                 content = client.files.content(code)
                 content.write_to_file(refined_file_path)
@@ -477,6 +767,8 @@ def apply_green_prompts(client, assistant, file_id, prompt, refined_file_path):
                 # Log modifications to the central CSV file
                 changes_summary, next_steps = extract_changes_summary(data)
                 log_modifications(os.path.basename(refined_file_path), changes_summary, next_steps)
+                if cache_key:
+                    refinement_cache.put(cache_key, refined_file_path, changes_summary, next_steps)
                 
                 logging.info(f"File refined successfully with prompt: {prompt}")
                 return True
@@ -491,6 +783,457 @@ def apply_green_prompts(client, assistant, file_id, prompt, refined_file_path):
         logging.error(f"Exception occurred while applying prompt '{prompt}' to file {file_id}: {e}")
         return False
 
+def build_fused_prompt(prompts):
+    """Combine several refinement prompts into one request with a numbered summary per prompt."""
+    instructions = '\n'.join(f"{index}. {prompt}" for index, prompt in enumerate(prompts, 1))
+    return (
+        "Apply all of the following refinement instructions to the attached file in a single pass "
+        "and share one refined file that satisfies every instruction:\n"
+        f"{instructions}\n\n"
+        "Ignore the summary format requested inside the individual instructions. Instead, after the code, "
+        "give one block for each instruction number n in the form: "
+        "PROMPT_n_CHANGES_START - [change] PROMPT_n_CHANGES_END "
+        "PROMPT_n_NEXT_STEPS_START - [recommendation] PROMPT_n_NEXT_STEPS_END"
+    )
+
+def apply_fused_prompts(client, assistant, file_id, prompts, refined_file_path, cache_key=None):
+    """Apply every enabled prompt with a single assistant request and log a change summary per prompt."""
+    logging.info(f"Applying {len(prompts)} fused prompts to file {file_id}")
+    try:
+        data = run_assistant_request(
+            client, assistant, build_fused_prompt(prompts), [file_id], f"file {file_id}",
+            operation='refine_fused', source_path=refined_file_path
+        )
+        if data is None:
+            return False
+
+        code = None
+        if data['data'] and data['data'][0]['content'] and data['data'][0]['content'][0]['text']['annotations']:
+            code = data['data'][0]['content'][0]['text']['annotations'][0]['file_path']['file_id']
+        if not code:
+            logging.error(f"No code found in fused response for file {file_id}")
+            return False
+
+        upload_registry.track_generated_file(code)
+        client.files.content(code).write_to_file(refined_file_path)
+        metrics_tracker.track_file(refined_file_path)
+
+        content = data['data'][0]['content'][0]['text']['value']
+        summaries = log_fused_summaries(content, prompts, os.path.basename(refined_file_path))
+        if cache_key:
+            refinement_cache.put(cache_key, refined_file_path, *summaries[0], summaries=summaries)
+
+        logging.info(f"File refined successfully with {len(prompts)} fused prompts")
+        return True
+    except Exception as e:
+        logging.error(f"Exception occurred while applying fused prompts to file {file_id}: {e}")
+        return False
+
+# Instructions for the chat completions engine, which returns the refined file inline instead of as a download
+CHAT_REFINER_INSTRUCTIONS = (
+    "You are a helpful AI assistant who refactors code to make it more efficient. "
+    "The file to refine is included in the user's message. "
+    "1. Re-write the code in the same language as the original code, keeping its behaviour unchanged. "
+    "2. Reply with the complete refined file in a single fenced code block; do not omit any part of it. "
+    "3. After the code, provide clear summaries: "
+    "   a) Changes made between CHANGES_START and CHANGES_END markers "
+    "   b) Next steps for improvement between NEXT_STEPS_START and NEXT_STEPS_END markers "
+    "   Both summaries should be concise, single-line bullet points."
+)
+
+# Fenced block with at least three backticks, closed by a fence of the same length
+CODE_BLOCK_PATTERN = re.compile(r'^[ \t]*(`{3,})[^\n`]*\n(.*?)^[ \t]*\1[ \t]*$', re.MULTILINE | re.DOTALL)
+
+# Counts tokens of streamed replies, which carry no usage on older API versions; created on first use
+_chat_tokenizer = None
+
+def count_chat_tokens(text):
+    global _chat_tokenizer
+    if _chat_tokenizer is None:
+        _chat_tokenizer = Tokenizer()
+    return _chat_tokenizer.count(text)
+
+class ChatRefiner(NamedTuple):
+    """Stands in for an assistant when refining through chat completions; a deployment and its system prompt."""
+    model: str
+    instructions: str = CHAT_REFINER_INSTRUCTIONS
+
+def build_chat_messages(refiner, prompt, code_path):
+    """Chat messages carrying the prompt and the code of code_path inline."""
+    with open(code_path, 'r', encoding='utf-8', errors='replace') as f:
+        source = f.read()
+    # The fence must be longer than any backtick run inside the code, e.g. in Markdown files
+    longest_run = max((len(run) for run in re.findall(r'`+', source)), default=0)
+    fence = '`' * max(3, longest_run + 1)
+    file_name = os.path.basename(code_path)
+    language = os.path.splitext(file_name)[1].lstrip('.')
+    return [
+        {"role": "system", "content": refiner.instructions},
+        {"role": "user", "content": f"{prompt}\n\nFile {file_name}:\n{fence}{language}\n{source}\n{fence}"}
+    ]
+
+def extract_code_block(content):
+    """Return the longest fenced code block of a reply, or None if it has none."""
+    blocks = [match.group(2) for match in CODE_BLOCK_PATTERN.finditer(content)]
+    return max(blocks, key=len) if blocks else None
+
+class ChatReply:
+    """Accumulates a streamed chat completion and the measurements llm_metrics records for it."""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.start_time = time.time()
+        start_retry_count()
+        self.first_token_time = None
+        self.parts = []
+        self.finish_reason = None
+        self.usage = None
+
+    def add(self, chunk):
+        # Azure sends content filter results in chunks without choices
+        if getattr(chunk, 'usage', None) is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return
+        choice = chunk.choices[0]
+        if choice.delta is not None and choice.delta.content:
+            if self.first_token_time is None:
+                self.first_token_time = time.time()
+            self.parts.append(choice.delta.content)
+        self.finish_reason = choice.finish_reason or self.finish_reason
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    @property
+    def outcome(self):
+        if self.finish_reason == 'stop':
+            return 'completed'
+        return self.finish_reason or 'incomplete'
+
+    def measurements(self):
+        """Time to first token as queue time, generation as run time, throttling retries and token usage (estimated if not sent)."""
+        end_time = time.time()
+        measurements = {'total_seconds': end_time - self.start_time, 'retries': retry_count()}
+        if self.first_token_time is not None:
+            measurements['queue_seconds'] = self.first_token_time - self.start_time
+            measurements['run_seconds'] = end_time - self.first_token_time
+        if self.usage is not None:
+            measurements['prompt_tokens'] = self.usage.prompt_tokens
+            measurements['completion_tokens'] = self.usage.completion_tokens
+        else:
+            measurements['prompt_tokens'] = sum(count_chat_tokens(message['content']) for message in self.messages)
+            measurements['completion_tokens'] = count_chat_tokens(self.text) if self.parts else 0
+        return measurements
+
+def run_chat_request(client, refiner, prompt, code_path, description, operation='refine', source_path=None):
+    """
+    Send a prompt with the code of code_path inline to chat completions and stream the reply.
+    Returns the reply text, or None if the request failed or the reply was cut off.
+    Timings and token usage are recorded in llm_metrics under the operation with a _chat suffix.
+    """
+    reply = ChatReply(build_chat_messages(refiner, prompt, code_path))
+    try:
+        stream = client.chat.completions.create(
+            model=refiner.model, messages=reply.messages, stream=True, timeout=RUN_TIMEOUT_SECONDS
+        )
+        for chunk in stream:
+            reply.add(chunk)
+        if reply.finish_reason != 'stop':
+            logging.warning(f"Chat request did not complete for {description} (finish reason: {reply.finish_reason})")
+            return None
+        return reply.text
+    except Exception as e:
+        logging.error(f"Chat request failed for {description}: {e}")
+        return None
+    finally:
+        llm_metrics.record(
+            f"{operation}_chat", source_path or code_path, refiner.model,
+            reply.outcome if reply.finish_reason else 'error', **reply.measurements()
+        )
+
+def write_chat_output(content, refined_file_path):
+    """Write the code block of a chat reply to refined_file_path. Returns False if the reply has no code."""
+    code = extract_code_block(content)
+    if code is None:
+        return False
+    with open(refined_file_path, 'w', encoding='utf-8') as f:
+        f.write(code)
+    return True
+
+def log_fused_summaries(content, prompts, file_name):
+    """Log the per-prompt change summaries of a fused response. Returns the logged (changes, next_steps) pairs."""
+    summaries = []
+    for index in range(1, len(prompts) + 1):
+        changes_summary = extract_section(content, f"PROMPT_{index}_CHANGES_START", f"PROMPT_{index}_CHANGES_END")
+        next_steps = extract_section(content, f"PROMPT_{index}_NEXT_STEPS_START", f"PROMPT_{index}_NEXT_STEPS_END")
+        summaries.append((
+            f"[Prompt {index}] {changes_summary or 'No specific changes provided'}",
+            next_steps or "No specific next steps identified"
+        ))
+        log_modifications(file_name, *summaries[-1])
+    return summaries
+
+def store_chat_output(content, prompts, refined_file_path, cache_key=None):
+    """
+    Write, track, log and cache the refined file of a chat reply. prompts holds the fused prompts,
+    or a single prompt for a plain request. Returns False if the reply has no code block.
+    """
+    file_name = os.path.basename(refined_file_path)
+    if not write_chat_output(content, refined_file_path):
+        logging.error(f"No code block found in chat response for {file_name}")
+        return False
+    metrics_tracker.track_file(refined_file_path)
+    if len(prompts) > 1:
+        summaries = log_fused_summaries(content, prompts, file_name)
+    else:
+        summaries = [(
+            extract_section(content, 'CHANGES_START', 'CHANGES_END') or "No specific changes provided",
+            extract_section(content, 'NEXT_STEPS_START', 'NEXT_STEPS_END') or "No specific next steps identified"
+        )]
+        log_modifications(file_name, *summaries[0])
+    if cache_key:
+        refinement_cache.put(cache_key, refined_file_path, *summaries[0], summaries=summaries if len(prompts) > 1 else None)
+    logging.info(f"File refined successfully through chat completions with {len(prompts)} prompt(s)")
+    return True
+
+def apply_green_prompts_chat(client, refiner, file_path, prompt, refined_file_path, cache_key=None):
+    """Chat completions counterpart of apply_green_prompts; the source is sent inline instead of uploaded."""
+    logging.info(f"Applying prompt through chat completions: {prompt} to file {os.path.basename(file_path)}")
+    try:
+        content = run_chat_request(
+            client, refiner, prompt, file_path, f"file {os.path.basename(file_path)}", operation='refine'
+        )
+        return content is not None and store_chat_output(content, [prompt], refined_file_path, cache_key)
+    except Exception as e:
+        logging.error(f"Exception occurred while applying prompt '{prompt}' to file {file_path}: {e}")
+        return False
+
+def apply_fused_prompts_chat(client, refiner, file_path, prompts, refined_file_path, cache_key=None):
+    """Chat completions counterpart of apply_fused_prompts."""
+    logging.info(f"Applying {len(prompts)} fused prompts through chat completions to file {os.path.basename(file_path)}")
+    try:
+        content = run_chat_request(
+            client, refiner, build_fused_prompt(prompts), file_path, f"file {os.path.basename(file_path)}",
+            operation='refine_fused'
+        )
+        return content is not None and store_chat_output(content, prompts, refined_file_path, cache_key)
+    except Exception as e:
+        logging.error(f"Exception occurred while applying fused prompts to file {file_path}: {e}")
+        return False
+
+def pack_small_files(file_list, max_file_bytes, token_budget):
+    """
+    Group small files into packs that fit the token budget.
+    Returns (packs, single_files); packs never contain two files with the same name.
+    """
+    packs = []
+    single_files = []
+    current_pack, current_names, current_tokens = [], set(), 0
+    for file_path in file_list:
+        size = os.path.getsize(file_path)
+        file_name = os.path.basename(file_path)
+        if size == 0 or size > max_file_bytes:
+            single_files.append(file_path)
+            continue
+        tokens = size // ESTIMATED_BYTES_PER_TOKEN + 1
+        if current_pack and (current_tokens + tokens > token_budget or file_name in current_names):
+            packs.append(current_pack)
+            current_pack, current_names, current_tokens = [], set(), 0
+        current_pack.append(file_path)
+        current_names.add(file_name)
+        current_tokens += tokens
+    if current_pack:
+        packs.append(current_pack)
+
+    # A pack of one gains nothing over the regular per-file path
+    single_files.extend(pack[0] for pack in packs if len(pack) == 1)
+    return [pack for pack in packs if len(pack) > 1], single_files
+
+def extract_file_section(content, file_name):
+    """Return the part of a packed response between FILE_START <file_name> and the next FILE_END."""
+    start_marker = f"FILE_START {file_name}"
+    start_idx = content.find(start_marker)
+    if start_idx == -1:
+        return ''
+    start_idx += len(start_marker)
+    end_idx = content.find('FILE_END', start_idx)
+    return content[start_idx:] if end_idx == -1 else content[start_idx:end_idx]
+
+def apply_green_prompts_packed(client, assistant, file_entries, prompt):
+    """
+    Refine several small files with a single assistant request.
+    file_entries holds (file_id, source_path, refined_file_path, cache_key) tuples.
+    Returns the set of source paths whose refined file was returned and written.
+    """
+    file_names = [os.path.basename(source_path) for _, source_path, _, _ in file_entries]
+    packed_prompt = (
+        f"{prompt}\n\n"
+        f"{len(file_entries)} files are attached: {', '.join(file_names)}. "
+        "Apply the instructions to each file independently and share every refined file as a separate "
+        "downloadable file with exactly the same file name as its original. "
+        "Instead of a single summary, give one block per file in the form: "
+        "FILE_START <file name> CHANGES_START - [change] CHANGES_END NEXT_STEPS_START - [recommendation] NEXT_STEPS_END FILE_END"
+    )
+    logging.info(f"Applying prompt to packed files: {', '.join(file_names)}")
+    refined_paths = set()
+    try:
+        data = run_assistant_request(
+            client, assistant, packed_prompt, [file_id for file_id, _, _, _ in file_entries],
+            f"packed files {', '.join(file_names)}", operation='refine_packed'
+        )
+        if data is None:
+            return refined_paths
+
+        # Collect every generated file and the full response text across the assistant's messages
+        generated_files = {}
+        text_parts = []
+        for message in data['data']:
+            if message.get('role') != 'assistant':
+                continue
+            for item in message.get('content') or []:
+                if item.get('type') != 'text':
+                    continue
+                text_parts.append(item['text']['value'])
+                for annotation in item['text'].get('annotations') or []:
+                    if annotation.get('type') == 'file_path':
+                        generated_name = os.path.basename(annotation['text'])
+                        generated_files.setdefault(generated_name, annotation['file_path']['file_id'])
+        content = '\n'.join(text_parts)
+
+        for _, source_path, refined_file_path, cache_key in file_entries:
+            file_name = os.path.basename(source_path)
+            code = generated_files.get(file_name)
+            if not code:
+                logging.warning(f"Packed response did not include a refined file for: {file_name}")
+                continue
+            upload_registry.track_generated_file(code)
+            try:
+                client.files.content(code).write_to_file(refined_file_path)
+                metrics_tracker.track_file(refined_file_path)
+
+                section = extract_file_section(content, file_name)
+                changes_summary = extract_section(section, 'CHANGES_START', 'CHANGES_END') or "No specific changes provided"
+                next_steps = extract_section(section, 'NEXT_STEPS_START', 'NEXT_STEPS_END') or "No specific next steps identified"
+                log_modifications(os.path.basename(refined_file_path), changes_summary, next_steps)
+                refinement_cache.put(cache_key, refined_file_path, changes_summary, next_steps)
+                refined_paths.add(source_path)
+            except Exception as e:
+                logging.error(f"Error writing packed refined file {file_name}: {e}")
+
+        logging.info(f"Packed request refined {len(refined_paths)} of {len(file_entries)} files")
+    except Exception as e:
+        logging.error(f"Exception occurred while applying prompt '{prompt}' to packed files: {e}")
+    return refined_paths
+
+# Files larger than CHUNK_MAX_CHARS are split by function/class and refined chunk by chunk (0 disables)
+CHUNK_MAX_CHARS = get_int_env_variable('CHUNK_MAX_CHARS', 6000)
+CHUNK_MAX_WORKERS = max(1, get_int_env_variable('CHUNK_MAX_WORKERS', 4))
+
+def build_chunk_prompt(prompt, file_name, header, index, total):
+    """Wrap a refinement prompt with the context needed to refine one chunk of a larger file."""
+    return (
+        f"{prompt}\n\n"
+        f"The attached code is part {index} of {total} of the file {file_name}. "
+        f"The file starts with these imports and declarations, which are kept unchanged:\n{header}\n"
+        "Refine only this part. Keep its public names and signatures so it still fits into the rest of the file, "
+        "and do not repeat the imports."
+    )
+
+def _refine_chunk(client, assistant, prompt, file_path, chunks, index, work_dir):
+    """Refine one chunk through the assistant. Returns (refined_text, changes, next_steps) or None."""
+    file_name = os.path.basename(file_path)
+    base_name, ext = os.path.splitext(file_name)
+    chunk_path = os.path.join(work_dir, f"{base_name}_part{index + 1}{ext}")
+    refined_chunk_path = os.path.join(work_dir, f"{base_name}_part{index + 1}_refined{ext}")
+    with open(chunk_path, 'w', encoding='utf-8') as f:
+        f.write(chunks.chunks[index])
+
+    chunk_prompt = build_chunk_prompt(prompt, file_name, chunks.header, index + 1, len(chunks.chunks))
+    if isinstance(assistant, ChatRefiner):
+        content = run_chat_request(
+            client, assistant, chunk_prompt, chunk_path, f"chunk {index + 1} of {file_name}",
+            operation='refine_chunk', source_path=file_path
+        )
+        if content is None or not write_chat_output(content, refined_chunk_path):
+            return None
+        with open(refined_chunk_path, 'r', encoding='utf-8') as f:
+            refined_text = f.read()
+        return (refined_text, extract_section(content, 'CHANGES_START', 'CHANGES_END'),
+                extract_section(content, 'NEXT_STEPS_START', 'NEXT_STEPS_END'))
+
+    file_id = upload_registry.upload(client, chunk_path)
+    data = run_assistant_request(
+        client, assistant, chunk_prompt, [file_id], f"chunk {index + 1} of {file_name}",
+        operation='refine_chunk', source_path=file_path
+    )
+    if data is None:
+        return None
+
+    code = None
+    if data['data'] and data['data'][0]['content'] and data['data'][0]['content'][0]['text']['annotations']:
+        code = data['data'][0]['content'][0]['text']['annotations'][0]['file_path']['file_id']
+    if not code:
+        return None
+    upload_registry.track_generated_file(code)
+    client.files.content(code).write_to_file(refined_chunk_path)
+    with open(refined_chunk_path, 'r', encoding='utf-8') as f:
+        refined_text = f.read()
+    changes_summary, next_steps = extract_changes_summary(data)
+    return refined_text, changes_summary, next_steps
+
+def refine_file_in_chunks(client, assistant, file_path, prompt, refined_file_path, cache_key=None):
+    """
+    Refine a large file chunk by chunk in parallel and reassemble it in the original order.
+    Returns None when the file is small or cannot be split, otherwise whether any chunk was refined.
+    """
+    if CHUNK_MAX_CHARS <= 0 or os.path.getsize(file_path) <= CHUNK_MAX_CHARS:
+        return None
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            source = f.read()
+    except UnicodeDecodeError:
+        return None
+    chunks = split_into_chunks(source, os.path.splitext(file_path)[1], CHUNK_MAX_CHARS)
+    if chunks is None:
+        return None
+
+    file_name = os.path.basename(file_path)
+    logging.info(f"Refining {file_name} in {len(chunks.chunks)} chunks")
+    with tempfile.TemporaryDirectory() as work_dir:
+        def refine(index):
+            try:
+                return _refine_chunk(client, assistant, prompt, file_path, chunks, index, work_dir)
+            except Exception as e:
+                logging.error(f"Error refining chunk {index + 1} of {file_name}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=CHUNK_MAX_WORKERS) as executor:
+            results = list(executor.map(refine, range(len(chunks.chunks))))
+
+    refined_count = sum(1 for result in results if result)
+    if not refined_count:
+        logging.warning(f"No chunk of {file_name} could be refined")
+        return False
+
+    # Chunks that failed keep their original text so the file stays complete
+    refined_chunks = [result[0] if result else chunk for result, chunk in zip(results, chunks.chunks)]
+    with open(refined_file_path, 'w', encoding='utf-8') as f:
+        f.write(chunks.reassemble(refined_chunks))
+
+    metrics_tracker.track_file(refined_file_path)
+    changes = [result[1] for result in results if result and result[1]]
+    next_steps = next((result[2] for result in results if result and result[2]), "No specific next steps identified")
+    changes_summary = '; '.join(dict.fromkeys(changes)) or "No specific changes provided"
+    log_modifications(os.path.basename(refined_file_path), changes_summary, next_steps)
+    if cache_key:
+        refinement_cache.put(cache_key, refined_file_path, changes_summary, next_steps)
+    logging.info(f"Refined {refined_count} of {len(chunks.chunks)} chunks of {file_name}")
+    return True
+
 def finalize_processing():
     """Call this function at the end of the main processing loop."""
     update_final_overview()
+    llm_metrics.write_summary()
+    run_ledger.close()
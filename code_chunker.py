@@ -0,0 +1,183 @@
+import ast
+import logging
+from typing import List, NamedTuple, Optional
+
+PYTHON_EXTENSIONS = {'.py'}
+BRACE_EXTENSIONS = {'.java', '.cpp', '.cc', '.cxx', '.hpp', '.h', '.cs'}
+
+# Prefixes of top-level lines that belong to the shared header of a brace-language file
+BRACE_HEADER_PREFIXES = ('import ', 'package ', 'using ', '#include', '#pragma', '#define', '#import')
+
+# How many single enclosing blocks (namespace -> class) to step into before splitting members
+MAX_NESTING_DESCENT = 3
+
+
+class CodeChunks(NamedTuple):
+    """A source file split into a verbatim header, refinable chunks and a verbatim footer."""
+    header: str
+    chunks: List[str]
+    footer: str
+
+    def reassemble(self, refined_chunks: List[str]) -> str:
+        """Rebuild the file from refined chunks in their original order."""
+        parts = [self.header]
+        for chunk in refined_chunks:
+            parts.append(chunk if chunk.endswith('\n') else chunk + '\n')
+        parts.append(self.footer)
+        return ''.join(parts)
+
+
+def _group_segments(segments: List[str], max_chunk_chars: int) -> List[str]:
+    """Merge consecutive segments greedily so each chunk stays under max_chunk_chars where possible."""
+    chunks = []
+    current = ''
+    for segment in segments:
+        if current and len(current) + len(segment) > max_chunk_chars:
+            chunks.append(current)
+            current = ''
+        current += segment
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _split_python(source: str, max_chunk_chars: int) -> Optional[CodeChunks]:
+    """Split Python source at top-level function, class and statement boundaries using ast."""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        logging.warning(f"Unable to parse Python source for chunking: {e}")
+        return None
+
+    lines = source.splitlines(keepends=True)
+    nodes = tree.body
+    if not nodes:
+        return None
+
+    # Module docstring, imports and __future__ statements at the top form the shared header
+    header_count = 0
+    for node in nodes:
+        is_docstring = (header_count == 0 and isinstance(node, ast.Expr)
+                        and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str))
+        if isinstance(node, (ast.Import, ast.ImportFrom)) or is_docstring:
+            header_count += 1
+        else:
+            break
+    header_end = nodes[header_count - 1].end_lineno if header_count else 0
+
+    segments = []
+    previous_end = header_end
+    for node in nodes[header_count:]:
+        # Comments and blank lines before a node travel with it; decorators belong to their definition
+        segments.append(''.join(lines[previous_end:node.end_lineno]))
+        previous_end = node.end_lineno
+
+    return CodeChunks(
+        header=''.join(lines[:header_end]),
+        chunks=_group_segments(segments, max_chunk_chars),
+        footer=''.join(lines[previous_end:])
+    )
+
+
+def _line_depths(lines: List[str]):
+    """Return the brace depth after each line, ignoring braces inside strings, chars and comments."""
+    depths = []
+    depth = 0
+    in_block_comment = False
+    for line in lines:
+        i = 0
+        quote = None
+        while i < len(line):
+            char = line[i]
+            pair = line[i:i + 2]
+            if in_block_comment:
+                if pair == '*/':
+                    in_block_comment = False
+                    i += 1
+            elif quote:
+                if char == '\\':
+                    i += 1
+                elif char == quote:
+                    quote = None
+            elif pair == '//':
+                break
+            elif pair == '/*':
+                in_block_comment = True
+                i += 1
+            elif char in ('"', "'"):
+                quote = char
+            elif char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth < 0:
+                    return None
+            i += 1
+        depths.append(depth)
+    return depths if depth == 0 else None
+
+
+def _split_brace(source: str, max_chunk_chars: int) -> Optional[CodeChunks]:
+    """Split Java, C++ and C# source at member boundaries using brace depth."""
+    lines = source.splitlines(keepends=True)
+    depths = _line_depths(lines)
+    if depths is None:
+        logging.warning("Unbalanced braces, skipping chunking")
+        return None
+
+    level, start, end = 0, 0, len(lines)
+    for _ in range(MAX_NESTING_DESCENT):
+        # Step into a single enclosing block (namespace or class) that holds nearly all of the code
+        opening = next((i for i in range(start, end) if depths[i] > level), None)
+        if opening is None:
+            break
+        closing = next((i for i in range(opening, end) if depths[i] <= level), None)
+        if closing is None:
+            break
+        outside = ''.join(lines[start:opening] + lines[closing + 1:end])
+        inside = ''.join(lines[opening + 1:closing])
+        further_blocks = any(depths[i] > level for i in range(closing + 1, end))
+        outside_code = [line for line in outside.splitlines()
+                        if line.strip() and not line.strip().startswith(BRACE_HEADER_PREFIXES + ('//', '/*', '*'))]
+        if further_blocks or len(outside_code) > 3 or len(inside) < len(outside):
+            break
+        level, start, end = level + 1, opening + 1, closing
+
+    segments = []
+    segment_start = start
+    for i in range(start, end):
+        stripped = lines[i].rstrip()
+        complete = stripped.endswith(('}', ';')) or (level == 0 and stripped.lstrip().startswith('#'))
+        if depths[i] == level and complete:
+            segments.append(''.join(lines[segment_start:i + 1]))
+            segment_start = i + 1
+    trailing = ''.join(lines[segment_start:end])
+
+    # Leading imports, includes and using directives stay verbatim in the header
+    header = ''.join(lines[:start])
+    while segments and all(not line.strip() or line.strip().startswith(BRACE_HEADER_PREFIXES + ('//', '/*', '*'))
+                           for line in segments[0].splitlines()):
+        header += segments.pop(0)
+
+    return CodeChunks(
+        header=header,
+        chunks=_group_segments(segments, max_chunk_chars),
+        footer=trailing + ''.join(lines[end:])
+    )
+
+
+def split_into_chunks(source: str, extension: str, max_chunk_chars: int) -> Optional[CodeChunks]:
+    """
+    Split source into top-level functions/classes (Python) or members (brace languages).
+    Returns None when the language is unsupported, the source cannot be parsed, or there is only one chunk.
+    """
+    extension = extension.lower()
+    if extension in PYTHON_EXTENSIONS:
+        chunks = _split_python(source, max_chunk_chars)
+    elif extension in BRACE_EXTENSIONS:
+        chunks = _split_brace(source, max_chunk_chars)
+    else:
+        return None
+    if chunks is None or len(chunks.chunks) < 2:
+        return None
+    return chunks
@@ -0,0 +1,252 @@
+import os
+import re
+import ast
+import shutil
+import logging
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+from html.parser import HTMLParser
+from typing import List, NamedTuple, Optional
+
+# Compiler diagnostics look like "<file>:<line>[:<col>]: [fatal ]error: <message>"
+COMPILER_ERROR_PATTERN = re.compile(r':\d+(?::\d+)?: (?:fatal )?error: (.*)')
+
+# Missing header diagnostics of gcc ("foo.h: No such file or directory") and clang ("'foo.h' file not found")
+MISSING_HEADER_PATTERN = re.compile(r"^(?:'(.+)' file not found|(.+): No such file or directory)$")
+
+# Most headers replaced by empty stubs before a C/C++ file is reported as unvalidated
+MAX_STUB_HEADERS = 50
+
+# Positions differ between the original and the refined file, so they are left out of comparisons
+POSITION_PATTERN = re.compile(r'\b(?:line|column) \d+|\(line \d+\)|:\d+(?::\d+)?')
+
+HTML_VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'
+}
+# Elements whose end tag HTML lets authors omit
+HTML_OPTIONAL_END_ELEMENTS = {
+    'html', 'head', 'body', 'p', 'li', 'dt', 'dd', 'option', 'optgroup', 'tr', 'td', 'th',
+    'thead', 'tbody', 'tfoot', 'colgroup', 'rb', 'rt', 'rp'
+}
+
+DEFAULT_TIMEOUT_SECONDS = 60
+
+
+class ValidationResult(NamedTuple):
+    """Outcome of checking one file; checker is empty when no check applies to its language."""
+    ok: bool
+    checker: str
+    message: str
+
+
+class _HTMLBalanceChecker(HTMLParser):
+    """Reports end tags without a start tag and elements that are never closed."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.errors = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in HTML_VOID_ELEMENTS:
+            self.stack.append((tag, self.getpos()[0]))
+
+    def handle_startendtag(self, tag, attrs):
+        pass
+
+    def handle_endtag(self, tag):
+        if tag in HTML_VOID_ELEMENTS:
+            return
+        open_tags = [name for name, _ in self.stack]
+        if tag not in open_tags:
+            self.errors.append(f"unexpected </{tag}> at line {self.getpos()[0]}")
+            return
+        while self.stack:
+            name, line = self.stack.pop()
+            if name == tag:
+                break
+            if name not in HTML_OPTIONAL_END_ELEMENTS:
+                self.errors.append(f"<{name}> opened at line {line} is not closed")
+
+    def close(self):
+        super().close()
+        for name, line in self.stack:
+            if name not in HTML_OPTIONAL_END_ELEMENTS:
+                self.errors.append(f"<{name}> opened at line {line} is not closed")
+
+
+def _read(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+def _check_python(path, timeout, context_dir):
+    try:
+        ast.parse(_read(path), filename=os.path.basename(path))
+        return []
+    except SyntaxError as e:
+        return [f"{e.msg} (line {e.lineno})"]
+
+
+def _check_xml(path, timeout, context_dir):
+    try:
+        ET.parse(path)
+        return []
+    except ET.ParseError as e:
+        return [str(e)]
+
+
+def _check_html(path, timeout, context_dir):
+    checker = _HTMLBalanceChecker()
+    checker.feed(_read(path))
+    checker.close()
+    return checker.errors
+
+
+def _run_compiler(command, timeout):
+    """Run a syntax check command; returns its error lines, or None if it could not give a verdict."""
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logging.warning(f"Validation timed out after {timeout}s: {' '.join(command)}")
+        return None
+    except OSError as e:
+        logging.warning(f"Unable to run validator {command[0]}: {e}")
+        return None
+    if completed.returncode == 0:
+        return []
+    # Paths differ between the refined and the original file, so they are dropped from the messages
+    output = (completed.stderr + completed.stdout).replace(command[-1], '')
+    errors = [match.group(1).strip() for match in COMPILER_ERROR_PATTERN.finditer(output)]
+    return errors or [line for line in output.splitlines() if line.strip()][:5] or ['compilation failed']
+
+
+def _check_java(path, timeout, context_dir):
+    javac = shutil.which(os.getenv('JAVAC_PATH', 'javac'))
+    if not javac:
+        return None
+    with tempfile.TemporaryDirectory() as class_dir:
+        # Sibling classes of the original resolve through the sourcepath but are not compiled
+        return _run_compiler([javac, '-proc:none', '-implicit:none', '-Xlint:none', '-sourcepath', context_dir,
+                              '-d', class_dir, path], timeout)
+
+
+def _missing_headers(errors):
+    headers = set()
+    for error in errors:
+        match = MISSING_HEADER_PATTERN.match(error)
+        if match:
+            headers.add(match.group(1) or match.group(2))
+    return headers
+
+
+def _check_c_family(compiler_variable, default_compiler):
+    def check(path, timeout, context_dir):
+        compiler = shutil.which(os.getenv(compiler_variable, default_compiler))
+        if not compiler:
+            return None
+        # gcc stops at the first missing header, which would hide every error after it. Headers that
+        # cannot be found are replaced by empty stubs until the whole file is checked; the errors the
+        # stubs cause show up in the original as well and are discounted there.
+        with tempfile.TemporaryDirectory() as stub_dir:
+            stubbed = set()
+            while True:
+                # Local headers are looked up next to the original file, then among the stubs
+                errors = _run_compiler([compiler, '-fsyntax-only', '-w', '-I', context_dir, '-I', stub_dir, path], timeout)
+                missing = _missing_headers(errors or []) - stubbed
+                if not missing:
+                    return errors
+                stub_paths = {header: os.path.normpath(os.path.join(stub_dir, header)) for header in missing}
+                if (len(stubbed) + len(missing) > MAX_STUB_HEADERS
+                        or any(os.path.isabs(header) or not stub_path.startswith(stub_dir + os.sep)
+                               for header, stub_path in stub_paths.items())):
+                    logging.info(f"Unable to stub the missing headers of {os.path.basename(path)}, leaving it unvalidated")
+                    return None
+                for stub_path in stub_paths.values():
+                    os.makedirs(os.path.dirname(stub_path), exist_ok=True)
+                    open(stub_path, 'w').close()
+                stubbed |= missing
+    return check
+
+
+def _check_with(variable, default_tool, *flags):
+    def check(path, timeout, context_dir):
+        tool = shutil.which(os.getenv(variable, default_tool))
+        if not tool:
+            return None
+        return _run_compiler([tool, *flags, path], timeout)
+    return check
+
+
+# Extension -> (checker name, check function); checks return error messages, or None when unavailable
+CHECKERS = {
+    '.py': ('ast', _check_python),
+    '.java': ('javac', _check_java),
+    '.c': ('gcc', _check_c_family('GCC_PATH', 'gcc')),
+    '.cpp': ('g++', _check_c_family('GXX_PATH', 'g++')),
+    '.cc': ('g++', _check_c_family('GXX_PATH', 'g++')),
+    '.cxx': ('g++', _check_c_family('GXX_PATH', 'g++')),
+    '.xml': ('xml', _check_xml),
+    '.html': ('html', _check_html),
+    '.htm': ('html', _check_html),
+    '.php': ('php -l', _check_with('PHP_PATH', 'php', '-l')),
+    '.rb': ('ruby -c', _check_with('RUBY_PATH', 'ruby', '-c')),
+}
+
+
+def _normalise(message):
+    return POSITION_PATTERN.sub('', message).strip()
+
+
+def _errors(path, timeout, context_dir) -> Optional[List[str]]:
+    checker = CHECKERS.get(os.path.splitext(path)[1].lower())
+    if checker is None:
+        return None
+    try:
+        return checker[1](path, timeout, context_dir)
+    except Exception as e:
+        logging.warning(f"Validator {checker[0]} failed on {path}: {e}")
+        return None
+
+
+def validate_source(path, original_path=None, timeout=DEFAULT_TIMEOUT_SECONDS) -> ValidationResult:
+    """
+    Check that a refined file parses or compiles. When the original file is given, errors the
+    original shows as well (missing dependencies, unsupported syntax) do not fail the check,
+    since they say nothing about the refinement.
+    """
+    checker_name = CHECKERS.get(os.path.splitext(path)[1].lower(), ('', None))[0]
+    context_dir = os.path.dirname(os.path.abspath(original_path or path))
+    errors = _errors(path, timeout, context_dir)
+    if errors is None:
+        # The checker is missing or could not give a verdict; the file is accepted unvalidated
+        return ValidationResult(True, '', f"unvalidated, no verdict from {checker_name}" if checker_name else 'no validator available')
+    if not errors:
+        return ValidationResult(True, checker_name, 'ok')
+
+    if original_path:
+        original_errors = _errors(original_path, timeout, context_dir) or []
+        known = {_normalise(error) for error in original_errors}
+        new_errors = [error for error in errors if _normalise(error) not in known]
+        if not new_errors:
+            return ValidationResult(True, checker_name, 'errors also present in the original')
+        errors = new_errors
+    return ValidationResult(False, checker_name, '; '.join(errors[:5]))
+
+
+def validate_code(code, file_name, original_path=None, timeout=DEFAULT_TIMEOUT_SECONDS) -> ValidationResult:
+    """validate_source for code held in memory; it is written under its real name so compilers accept it."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, file_name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(code)
+        return validate_source(path, original_path, timeout)
+
+
+def build_fix_prompt(prompt, result):
+    """Extend a refinement prompt with the validation errors of the previous attempt."""
+    return (
+        f"{prompt}\n\nA previous refinement of this file did not pass the {result.checker} check: "
+        f"{result.message}. Return a refined version that is syntactically valid and compiles."
+    )
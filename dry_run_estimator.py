@@ -0,0 +1,245 @@
+import os
+import csv
+import glob
+import logging
+from collections import defaultdict
+from typing import List, NamedTuple
+
+from code_chunker import split_into_chunks
+from llm_metrics import SUCCESS_OUTCOMES, percentile
+from rate_limiter import ESTIMATED_BYTES_PER_TOKEN
+from token_counter import Tokenizer
+
+# Fallbacks when there is no latency history yet
+DEFAULT_SECONDS_PER_CALL = 60.0
+DEFAULT_COMPLETION_RATIO = 1.0
+
+# Fixed per-request overhead (assistant instructions, message framing) in prompt tokens
+REQUEST_OVERHEAD_TOKENS = 300
+
+# Concurrency levels shown in the wall-time table
+CONCURRENCY_LEVELS = [1, 2, 4, 8, 16, 32]
+
+
+class LatencyHistory:
+    """Per-operation call durations and completion/prompt token ratios from earlier llm_requests_*.csv files."""
+
+    def __init__(self, rows):
+        self.seconds = defaultdict(list)
+        self.completion_ratios = defaultdict(list)
+        for row in rows:
+            if row.get('outcome') not in SUCCESS_OUTCOMES:
+                continue
+            operation = row.get('operation', '')
+            try:
+                self.seconds[operation].append(float(row['total_seconds']))
+            except (KeyError, TypeError, ValueError):
+                pass
+            try:
+                prompt_tokens = float(row['prompt_tokens'])
+                completion_tokens = float(row['completion_tokens'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if prompt_tokens > 0:
+                self.completion_ratios[operation].append(completion_tokens / prompt_tokens)
+
+    @classmethod
+    def load(cls, result_dir):
+        rows = []
+        for path in sorted(glob.glob(os.path.join(result_dir, 'llm_requests_*.csv'))):
+            try:
+                with open(path, 'r', newline='', encoding='utf-8') as f:
+                    rows.extend(csv.DictReader(f))
+            except Exception as e:
+                logging.warning(f"Unable to read LLM request history {path}: {e}")
+        return cls(rows)
+
+    @property
+    def samples(self):
+        return sum(len(values) for values in self.seconds.values())
+
+    def _lookup(self, table, operation):
+        # Variants such as refine_chunk fall back to refine, then to every operation
+        for key in (operation, operation.split('_')[0]):
+            if table.get(key):
+                return table[key]
+        return [value for values in table.values() for value in values]
+
+    def seconds_per_call(self, operation, pct=50):
+        values = self._lookup(self.seconds, operation)
+        return percentile(values, pct) if values else DEFAULT_SECONDS_PER_CALL
+
+    def completion_ratio(self, operation):
+        values = self._lookup(self.completion_ratios, operation)
+        return percentile(values, 50) if values else DEFAULT_COMPLETION_RATIO
+
+
+class FileEstimate(NamedTuple):
+    """Expected LLM work for one source file; calls may be fractional for packed files."""
+    path: str
+    directory: str
+    loc: int
+    file_tokens: int
+    calls: float
+    prompt_tokens: float
+    completion_tokens: float
+    seconds: float
+    p95_seconds: float
+
+
+def estimate_run(file_list, source_directory, request_prompts, fuse_prompts, generate_tests, test_prompt,
+                 chunk_max_chars, packs=(), history=None, tokenizer=None, pack_prompts=None) -> List[FileEstimate]:
+    """
+    Count the LLM calls a refinement run would make for file_list and estimate their tokens
+    and durations. Cache hits are not predicted, so the figures are an upper bound.
+    Packs are sent pack_prompts (the unfused prompts), defaulting to request_prompts.
+    """
+    history = history or LatencyHistory([])
+    tokenizer = tokenizer or Tokenizer()
+    refine_operation = 'refine_fused' if fuse_prompts else 'refine'
+    prompt_tokens = [tokenizer.count(prompt) + REQUEST_OVERHEAD_TOKENS for prompt in request_prompts]
+    pack_prompt_tokens = [tokenizer.count(prompt) + REQUEST_OVERHEAD_TOKENS for prompt in (pack_prompts or request_prompts)]
+    test_prompt_tokens = tokenizer.count(test_prompt or '') + REQUEST_OVERHEAD_TOKENS
+    pack_of = {file_path: pack for pack in packs for file_path in pack}
+
+    estimates = []
+    for file_path in file_list:
+        try:
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                source = f.read()
+        except OSError as e:
+            logging.warning(f"Unable to read {file_path}: {e}")
+            continue
+        file_tokens = tokenizer.count(source)
+        calls = sent = received = seconds = p95_seconds = 0.0
+
+        def add(operation, count, tokens):
+            nonlocal calls, sent, received, seconds, p95_seconds
+            calls += count
+            sent += tokens
+            received += tokens * history.completion_ratio(operation)
+            seconds += count * history.seconds_per_call(operation)
+            p95_seconds += count * history.seconds_per_call(operation, 95)
+
+        base_name = os.path.splitext(os.path.basename(file_path))[0]
+        generates_tests = generate_tests and 'test' not in base_name.lower()
+        if generates_tests:
+            add('unit_test', 1, file_tokens + test_prompt_tokens)
+
+        pack = pack_of.get(file_path)
+        chunks = None
+        if pack is None and chunk_max_chars > 0 and len(source) > chunk_max_chars:
+            chunks = split_into_chunks(source, os.path.splitext(file_path)[1], chunk_max_chars)
+        if pack is not None:
+            # One request per prompt carries the whole pack; each file bears its share of the call
+            for overhead in pack_prompt_tokens:
+                add('refine_packed', 1 / len(pack), file_tokens + overhead / len(pack))
+        else:
+            for overhead in prompt_tokens:
+                if chunks is not None:
+                    for chunk in chunks.chunks:
+                        add('refine_chunk', 1, tokenizer.count(chunks.header + chunk) + overhead)
+                else:
+                    add(refine_operation, 1, file_tokens + overhead)
+
+        # Tests for the refined file, which is about the size of the original
+        if generates_tests:
+            add('unit_test', 1, file_tokens + test_prompt_tokens)
+
+        estimates.append(FileEstimate(
+            path=file_path,
+            directory=os.path.relpath(os.path.dirname(file_path), source_directory),
+            loc=sum(1 for line in source.splitlines() if line.strip()),
+            file_tokens=file_tokens,
+            calls=calls,
+            prompt_tokens=sent,
+            completion_tokens=received,
+            seconds=seconds,
+            p95_seconds=p95_seconds
+        ))
+    return estimates
+
+
+def estimate_wall_seconds(serial_seconds, total_calls, total_tokens, concurrency,
+                          requests_per_minute=0, tokens_per_minute=0):
+    """Wall time at a concurrency level, never faster than the configured rate limits allow."""
+    wall = serial_seconds / max(1, concurrency)
+    if requests_per_minute > 0:
+        wall = max(wall, total_calls / requests_per_minute * 60)
+    if tokens_per_minute > 0:
+        wall = max(wall, total_tokens / tokens_per_minute * 60)
+    return wall
+
+
+def write_dry_run_report(estimates, report_path, concurrency, prompt_cost_per_1k=0.0, completion_cost_per_1k=0.0,
+                         requests_per_minute=0, tokens_per_minute=0, token_budget=0, history=None, tokenizer=None):
+    """Log the estimate with a per-directory breakdown and write it to report_path as CSV."""
+    def cost(prompt_tokens, completion_tokens):
+        return prompt_tokens / 1000 * prompt_cost_per_1k + completion_tokens / 1000 * completion_cost_per_1k
+
+    by_directory = defaultdict(list)
+    for estimate in estimates:
+        by_directory[estimate.directory].append(estimate)
+
+    fields = ['Directory', 'Files', 'LOC', 'File Tokens', 'LLM Calls', 'Prompt Tokens', 'Completion Tokens',
+              'Call Minutes (P50)', 'Call Minutes (P95)', 'Estimated Cost']
+
+    def summarise(directory, rows):
+        prompt_tokens = sum(row.prompt_tokens for row in rows)
+        completion_tokens = sum(row.completion_tokens for row in rows)
+        return {
+            'Directory': directory,
+            'Files': len(rows),
+            'LOC': sum(row.loc for row in rows),
+            'File Tokens': sum(row.file_tokens for row in rows),
+            'LLM Calls': round(sum(row.calls for row in rows), 1),
+            'Prompt Tokens': round(prompt_tokens),
+            'Completion Tokens': round(completion_tokens),
+            'Call Minutes (P50)': round(sum(row.seconds for row in rows) / 60, 1),
+            'Call Minutes (P95)': round(sum(row.p95_seconds for row in rows) / 60, 1),
+            'Estimated Cost': round(cost(prompt_tokens, completion_tokens), 4)
+        }
+
+    # Most expensive directories first
+    rows = sorted((summarise(directory, rows) for directory, rows in by_directory.items()),
+                  key=lambda row: row['Prompt Tokens'] + row['Completion Tokens'], reverse=True)
+    total = summarise('TOTAL', estimates)
+
+    try:
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+        with open(report_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows + [total])
+        logging.info(f"Dry-run estimate written to {report_path}")
+    except Exception as e:
+        logging.error(f"Error writing dry-run estimate: {e}")
+
+    total_tokens = total['Prompt Tokens'] + total['Completion Tokens']
+    serial_seconds = sum(estimate.seconds for estimate in estimates)
+    lines = ["", "=== Dry run: estimated refinement workload ===",
+             f"{'Directory':<40} {'Files':>6} {'LOC':>8} {'Calls':>8} {'Tokens':>10} {'Minutes':>8} {'Cost':>9}"]
+    for row in rows + [total]:
+        lines.append(
+            f"{row['Directory'][:40]:<40} {row['Files']:>6} {row['LOC']:>8} {row['LLM Calls']:>8} "
+            f"{row['Prompt Tokens'] + row['Completion Tokens']:>10} {row['Call Minutes (P50)']:>8} "
+            f"{row['Estimated Cost']:>9}"
+        )
+    lines.append("")
+    lines.append("Estimated wall time by concurrency (P50 latency):")
+    for level in sorted(set(CONCURRENCY_LEVELS) | {concurrency}):
+        wall = estimate_wall_seconds(serial_seconds, total['LLM Calls'], total_tokens, level,
+                                     requests_per_minute, tokens_per_minute)
+        marker = '  <- configured' if level == concurrency else ''
+        lines.append(f"  {level:>3} in flight: {wall / 60:8.1f} min{marker}")
+    if history is not None:
+        lines.append(f"Latency history: {history.samples} earlier requests"
+                     + ("" if history.samples else f" (none, assuming {DEFAULT_SECONDS_PER_CALL:g}s per call)"))
+    if tokenizer is not None and not tokenizer.exact:
+        lines.append(f"Token counts estimated at {ESTIMATED_BYTES_PER_TOKEN} bytes per token (install tiktoken for exact counts)")
+    if token_budget > 0 and total_tokens > token_budget:
+        lines.append(f"Estimated {total_tokens} tokens exceed REFINER_TOKEN_BUDGET={token_budget}; "
+                     f"the lowest-ranked files would not be refined")
+    lines.append("Cache hits are not predicted, so these figures are an upper bound.")
+    logging.info("\n".join(lines))
+    return total
@@ -0,0 +1,261 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import threading
+from collections import defaultdict
+from typing import Iterable, List, Optional
+
+# Directories that never hold source worth refining or measuring
+DEFAULT_PRUNED_DIRECTORIES = frozenset({
+    '.git', '.hg', '.svn', 'node_modules', '__pycache__', '.venv', 'venv', '.tox', '.nox',
+    '.mypy_cache', '.pytest_cache', '.ruff_cache', '.idea', '.vs', 'target', '.greencode_cache'
+})
+
+# Directory listings modified this recently are rescanned, since mtime may not have ticked yet
+MTIME_SAFETY_SECONDS = 2
+
+# The refiner's own test suite, never refined or measured as part of the project around it
+TOOL_TESTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests')
+
+
+def _glob_to_regex(pattern):
+    """Translate a gitignore glob (with ** support) into a regular expression."""
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex += '/.*'
+            i += 3
+            continue
+        if char == '*':
+            regex += '.*' if pattern.startswith('**', i) else '[^/]*'
+            i += 2 if pattern.startswith('**', i) else 1
+            continue
+        if char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                body = pattern[i + 1:end]
+                regex += '[' + ('^' + body[1:] if body.startswith('!') else body) + ']'
+                i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+    return re.compile(regex + r'\Z')
+
+
+class IgnoreRules:
+    """The patterns of one .gitignore file, matched relative to the directory that holds it."""
+
+    def __init__(self, base_dir, lines):
+        self.base_dir = base_dir
+        self.rules = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            directory_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if line:
+                self.rules.append((_glob_to_regex(line), negated, directory_only, anchored))
+
+    @classmethod
+    def load(cls, base_dir):
+        try:
+            with open(os.path.join(base_dir, '.gitignore'), 'r', encoding='utf-8', errors='ignore') as f:
+                return cls(base_dir, f.readlines())
+        except OSError:
+            return None
+
+    def match(self, path, is_dir):
+        """Return True (ignored), False (re-included by a ! rule) or None (no rule applies)."""
+        relative = os.path.relpath(path, self.base_dir).replace(os.sep, '/')
+        name = relative.rsplit('/', 1)[-1]
+        result = None
+        for regex, negated, directory_only, anchored in self.rules:
+            if directory_only and not is_dir:
+                continue
+            if regex.match(relative if anchored else name):
+                result = not negated
+        return result
+
+
+class FileIndex:
+    """
+    One os.scandir walk of a directory tree that prunes excluded and .gitignore'd directories,
+    recording each file once so any number of extension queries reuse the same walk.
+    With a cache_path, directory listings are persisted and reused while the directory mtime
+    is unchanged, so later runs and other scripts only stat the directories.
+    """
+
+    def __init__(self, root, pruned_dirs=DEFAULT_PRUNED_DIRECTORIES, excluded_paths=(),
+                 use_gitignore=True, cache_path=None):
+        self.root = os.path.abspath(root)
+        self.pruned_dirs = frozenset(pruned_dirs)
+        self.excluded_paths = {os.path.normcase(os.path.abspath(path))
+                               for path in (*excluded_paths, TOOL_TESTS_DIRECTORY)}
+        self.use_gitignore = use_gitignore
+        self.cache_path = cache_path
+        self.paths = []
+        self._by_extension = defaultdict(list)
+        self._build()
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('directories', {})
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cached_listings, listings):
+        if not self.cache_path:
+            return
+        # Keep listings of other roots sharing the cache file; this root's are replaced
+        prefix = self.root + os.sep
+        listings = {**{directory: listing for directory, listing in cached_listings.items()
+                       if directory != self.root and not directory.startswith(prefix)}, **listings}
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'root': self.root, 'directories': listings}, f)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            logging.warning(f"Unable to save file index cache {self.cache_path}: {e}")
+
+    def _list_directory(self, directory, cached_listings, listings, now):
+        """Return (file names, subdirectory names), from the cache when the directory is unchanged."""
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            return [], []
+        cached = cached_listings.get(directory)
+        if cached and cached['mtime_ns'] == mtime_ns and mtime_ns / 1e9 < cached['scanned_at'] - MTIME_SAFETY_SECONDS:
+            listings[directory] = cached
+            return cached['files'], cached['dirs']
+
+        files, dirs = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.name)
+                        elif entry.is_file():
+                            files.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.warning(f"Unable to scan directory {directory}: {e}")
+        listings[directory] = {'mtime_ns': mtime_ns, 'scanned_at': now, 'files': files, 'dirs': dirs}
+        return files, dirs
+
+    @staticmethod
+    def _is_ignored(path, is_dir, rules):
+        # Rules from deeper .gitignore files override those of their parents
+        for ignore_rules in reversed(rules):
+            result = ignore_rules.match(path, is_dir)
+            if result is not None:
+                return result
+        return False
+
+    def _build(self):
+        start_time = time.time()
+        cached_listings = self._load_cache()
+        listings = {}
+        stack = [(self.root, ())]
+        while stack:
+            directory, rules = stack.pop()
+            files, dirs = self._list_directory(directory, cached_listings, listings, start_time)
+            if self.use_gitignore and '.gitignore' in files:
+                ignore_rules = IgnoreRules.load(directory)
+                if ignore_rules is not None:
+                    rules = rules + (ignore_rules,)
+
+            for name in files:
+                path = os.path.join(directory, name)
+                if rules and self._is_ignored(path, False, rules):
+                    continue
+                self.paths.append(path)
+            for name in dirs:
+                path = os.path.join(directory, name)
+                if (name in self.pruned_dirs
+                        or os.path.normcase(path) in self.excluded_paths
+                        or (rules and self._is_ignored(path, True, rules))):
+                    continue
+                stack.append((path, rules))
+
+        self.paths.sort()
+        for path in self.paths:
+            self._by_extension[os.path.splitext(path)[1]].append(path)
+        self._save_cache(cached_listings, listings)
+        logging.info(f"Indexed {len(self.paths)} files under {self.root} in {time.time() - start_time:.2f}s")
+
+    def find(self, extensions: Optional[Iterable[str]] = None, excluded_files: Iterable[str] = ()) -> List[str]:
+        """
+        Return indexed files whose extension is in extensions (all files if None), minus excluded
+        names and the refiner's own modules.
+        """
+        if extensions is None:
+            candidates = self.paths
+        else:
+            candidates = sorted(path for extension in set(extensions) for path in self._by_extension.get(extension, ()))
+        excluded = set(excluded_files)
+        tool_paths = tool_module_paths()
+        return [path for path in candidates
+                if os.path.basename(path) not in excluded and os.path.normcase(os.path.abspath(path)) not in tool_paths]
+
+
+def tool_module_paths():
+    """
+    Normalised paths of the loaded modules that sit next to this one, i.e. the refiner's own code.
+    They are never offered for refinement, even when a new helper module is missing from EXCLUDED_FILES.
+    """
+    tool_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = set()
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, '__file__', None)
+        if module_file and os.path.dirname(os.path.abspath(module_file)) == tool_dir:
+            paths.add(os.path.normcase(os.path.abspath(module_file)))
+    return paths
+
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+
+def get_file_index(root, excluded_dirs=(), excluded_paths=(), use_gitignore=True, cache_path=None) -> FileIndex:
+    """Return the FileIndex for root and these exclusions, building it once per process."""
+    key = (os.path.abspath(root), frozenset(excluded_dirs), frozenset(excluded_paths), use_gitignore)
+    with _index_lock:
+        index = _index_cache.get(key)
+        if index is None:
+            index = FileIndex(root, DEFAULT_PRUNED_DIRECTORIES | set(excluded_dirs), excluded_paths, use_gitignore, cache_path)
+            _index_cache[key] = index
+        return index
+
+
+def invalidate_file_index(root=None):
+    """Forget indexes (of one root, or all) after files were added or removed."""
+    with _index_lock:
+        for key in list(_index_cache):
+            if root is None or key[0] == os.path.abspath(root):
+                del _index_cache[key]
@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import logging
+import subprocess
+from typing import NamedTuple, Optional, Set
+
+from file_discovery import DEFAULT_PRUNED_DIRECTORIES
+
+
+class IncrementalChanges(NamedTuple):
+    """Files added/modified (or left failed) and deleted since the last refinement run (absolute paths)."""
+    base_commit: str
+    changed: Set[str]
+    deleted: Set[str]
+
+
+def _run_git(repo_dir, *args) -> Optional[str]:
+    """Run a git command in repo_dir and return its stdout, or None if git fails."""
+    try:
+        result = subprocess.run(
+            ['git', '-C', str(repo_dir), *args],
+            capture_output=True, text=True, timeout=60
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.warning(f"Unable to run git in {repo_dir}: {e}")
+        return None
+    if result.returncode != 0:
+        logging.warning(f"git {' '.join(args)} failed: {result.stderr.strip()}")
+        return None
+    return result.stdout
+
+
+def get_head_commit(repo_dir) -> Optional[str]:
+    """Return the commit currently checked out in repo_dir."""
+    output = _run_git(repo_dir, 'rev-parse', 'HEAD')
+    return output.strip() if output else None
+
+
+def _file_digest(path) -> Optional[str]:
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def _is_generated(relative_path, excluded_dirs) -> bool:
+    """True for paths inside pruned or generated directories, as file_discovery prunes them."""
+    directories = os.path.normpath(relative_path).split(os.sep)[:-1]
+    return any(name in DEFAULT_PRUNED_DIRECTORIES or name in excluded_dirs for name in directories)
+
+
+def _relative_paths(output, excluded_dirs) -> Set[str]:
+    return {os.path.normpath(line) for line in output.splitlines()
+            if line.strip() and not _is_generated(line, excluded_dirs)}
+
+
+def load_refinement_state(state_path) -> Optional[dict]:
+    """Read the state recorded by the last refinement run, or None if there is none."""
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if state.get('commit') else None
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Failed to read refinement state from {state_path}: {e}")
+        return None
+
+
+def save_refinement_state(repo_dir, state_path, failed_paths=(), excluded_dirs=()) -> None:
+    """
+    Record HEAD, the contents of files that differed from it, and the files whose refinement
+    failed, so the next run picks up newer changes plus the failures and skips uncommitted
+    edits that were already refined.
+    """
+    commit = get_head_commit(repo_dir)
+    if not commit:
+        return
+    excluded_dirs = set(excluded_dirs)
+    modified = _run_git(repo_dir, 'diff', '--name-only', '--relative', '--no-renames', '--diff-filter=AM', 'HEAD')
+    untracked = _run_git(repo_dir, 'ls-files', '--others', '--exclude-standard')
+    worktree = {}
+    for relative_path in sorted(_relative_paths(modified or '', excluded_dirs) | _relative_paths(untracked or '', excluded_dirs)):
+        digest = _file_digest(os.path.join(str(repo_dir), relative_path))
+        if digest:
+            worktree[relative_path] = digest
+    retry = sorted(os.path.relpath(os.path.abspath(path), os.path.abspath(str(repo_dir))) for path in failed_paths)
+    try:
+        os.makedirs(os.path.dirname(str(state_path)), exist_ok=True)
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump({'commit': commit, 'worktree': worktree, 'retry': retry}, f, indent=2)
+        logging.info(
+            f"Recorded refinement state at {commit[:12]} in {state_path}"
+            + (f", {len(retry)} failed files to retry" if retry else "")
+        )
+    except Exception as e:
+        logging.error(f"Failed to record refinement state: {e}")
+
+
+def get_incremental_changes(repo_dir, state_path, excluded_dirs=()) -> Optional[IncrementalChanges]:
+    """
+    Work out which files changed since the last refinement run, plus the files it failed to refine.
+    Paths under excluded_dirs (the tool's outputs) and pruned directories are ignored.
+    Returns None when a full run is required (no stored state, not a git repository, or git errors).
+    """
+    state = load_refinement_state(state_path)
+    if not state:
+        logging.info("No refinement state recorded, running a full refinement.")
+        return None
+    base_commit = state['commit']
+    excluded_dirs = set(excluded_dirs)
+
+    # --relative keeps paths relative to repo_dir and ignores changes outside it;
+    # --no-renames reports a rename as a delete plus an add so stale outputs are cleaned up
+    changed = _run_git(repo_dir, 'diff', '--name-only', '--relative', '--no-renames', '--diff-filter=AM', base_commit)
+    deleted = _run_git(repo_dir, 'diff', '--name-only', '--relative', '--no-renames', '--diff-filter=D', base_commit)
+    untracked = _run_git(repo_dir, 'ls-files', '--others', '--exclude-standard')
+    if changed is None or deleted is None or untracked is None:
+        logging.warning("Could not determine changes from git, running a full refinement.")
+        return None
+    changed = _relative_paths(changed, excluded_dirs) | _relative_paths(untracked, excluded_dirs)
+    deleted = _relative_paths(deleted, excluded_dirs)
+
+    # Uncommitted edits refined by the last run only count again once their contents change
+    for relative_path, digest in state.get('worktree', {}).items():
+        current = _file_digest(os.path.join(str(repo_dir), relative_path))
+        if current is None:
+            changed.discard(relative_path)
+            deleted.add(relative_path)
+        elif current == digest:
+            changed.discard(relative_path)
+        else:
+            changed.add(relative_path)
+
+    retried = {path for path in state.get('retry', []) if os.path.isfile(os.path.join(str(repo_dir), path))}
+    changed |= retried
+
+    changes = IncrementalChanges(
+        base_commit=base_commit,
+        changed={os.path.normpath(os.path.join(str(repo_dir), path)) for path in changed},
+        deleted={os.path.normpath(os.path.join(str(repo_dir), path)) for path in deleted - changed}
+    )
+    logging.info(
+        f"Incremental refinement against {base_commit[:12]}: "
+        f"{len(changes.changed)} added/modified ({len(retried)} retried after failing), {len(changes.deleted)} deleted"
+    )
+    return changes
@@ -0,0 +1,99 @@
+import logging
+import threading
+from collections import Counter
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (httpx negotiates HTTP/2 only when the h2 package is installed)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Trace event emitted by httpcore when it opens a new TCP connection
+NEW_CONNECTION_EVENT = 'connection.connect_tcp.complete'
+
+
+class ConnectionStats:
+    """
+    Counts requests, newly opened connections and HTTP versions of a pooled client.
+    Requests that did not open a connection reused a kept-alive one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = 0
+        self.new_connections = 0
+        self.http_versions = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def extensions(self):
+        """Request extensions through which httpcore reports new connections to a sync client's stats."""
+        return {'trace': self.trace}
+
+    @property
+    def async_extensions(self):
+        """Request extensions for requests sent with an async client."""
+        return {'trace': self.async_trace}
+
+    def trace(self, event_name, info):
+        """httpcore trace callback for sync clients."""
+        if event_name == NEW_CONNECTION_EVENT:
+            with self._lock:
+                self.new_connections += 1
+
+    async def async_trace(self, event_name, info):
+        """httpcore trace callback for async clients."""
+        self.trace(event_name, info)
+
+    def record_response(self, response):
+        with self._lock:
+            self.requests += 1
+            self.http_versions[response.http_version] += 1
+
+    async def async_record_response(self, response):
+        self.record_response(response)
+
+    @property
+    def reused(self):
+        return max(0, self.requests - self.new_connections)
+
+    def log_summary(self):
+        """Log how many requests reused a pooled connection."""
+        with self._lock:
+            requests, new_connections = self.requests, self.new_connections
+            versions = ', '.join(f"{version}: {count}" for version, count in sorted(self.http_versions.items()))
+        if not requests:
+            return
+        logging.info(
+            f"{self.name} HTTP pool: {requests} requests over {new_connections} connections, "
+            f"{self.reused} reused ({self.reused / requests:.0%}); {versions or 'no responses'}"
+        )
+
+
+def _limits(pool_size):
+    return httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=60)
+
+
+def create_pooled_client(pool_size, timeout, http2=True, stats=None):
+    """
+    Long-lived keep-alive httpx.Client with pool_size connections. HTTP/2 is used when requested
+    and h2 is installed. Requests sent with extensions=stats.extensions count towards the reuse figures.
+    """
+    return httpx.Client(
+        http2=http2 and HTTP2_AVAILABLE,
+        limits=_limits(pool_size),
+        timeout=timeout,
+        event_hooks={'response': [stats.record_response]} if stats else None
+    )
+
+
+def create_pooled_async_client(pool_size, timeout, http2=True, stats=None):
+    """Async counterpart of create_pooled_client."""
+    return httpx.AsyncClient(
+        http2=http2 and HTTP2_AVAILABLE,
+        limits=_limits(pool_size),
+        timeout=timeout,
+        event_hooks={'response': [stats.async_record_response]} if stats else None
+    )
@@ -0,0 +1,265 @@
+import time
+import asyncio
+import logging
+import threading
+from typing import List
+
+# Names accepted by INFERENCE_BACKEND
+HUGGINGFACE = 'huggingface'
+AZURE = 'azure'
+OPENAI_COMPATIBLE = 'openai'
+
+
+# Bounds on the wait between probes while a model loads, whatever estimated_time says
+MIN_LOADING_WAIT_SECONDS = 1.0
+MAX_LOADING_WAIT_SECONDS = 60.0
+# Assumed load time when a loading response carries no estimate
+DEFAULT_LOADING_SECONDS = 20.0
+
+
+def _generation_parameters(payload):
+    return payload.get('parameters') or {}
+
+
+class InferenceBackend:
+    """
+    Turns Hugging Face style text-generation payloads ({"inputs": ..., "parameters": {...}}) into
+    requests for one kind of server, and normalises every reply to [{'generated_text': ...}] with the
+    prompt followed by the completion, as the Hugging Face Inference API returns it.
+
+    build_request and parse_response take a list of payloads; backends that set supports_batching
+    send them in one request, the others are only ever given one payload at a time.
+    """
+
+    name = ''
+    supports_batching = False
+
+    def __init__(self, url, model, headers=None):
+        self.url = url
+        self.model = model
+        self.headers = headers or {}
+
+    def build_request(self, payloads: List[dict]):
+        """Return (url, headers, json body) for the payloads."""
+        raise NotImplementedError
+
+    def parse_response(self, data, payloads: List[dict]) -> List[list]:
+        """Return one [{'generated_text': ...}] list per payload."""
+        raise NotImplementedError
+
+    def loading_seconds(self, response):
+        """Estimated seconds until the model is loaded if the response says it is still loading, else None."""
+        return None
+
+    def warm_up_payload(self) -> dict:
+        """Smallest useful request, sent at start-up to get the model loaded."""
+        return {"inputs": "def ping():", "parameters": {"max_new_tokens": 1}}
+
+    def describe(self):
+        return f"{self.name} ({self.model} at {self.url})"
+
+
+class HuggingFaceBackend(InferenceBackend):
+    """Hugging Face Inference API; payloads are sent unchanged."""
+
+    name = HUGGINGFACE
+
+    def __init__(self, base_url, model, token):
+        super().__init__(base_url + model, model, {"Authorization": f"Bearer {token}"})
+
+    def build_request(self, payloads):
+        return self.url, self.headers, payloads[0]
+
+    def parse_response(self, data, payloads):
+        if isinstance(data, dict) and 'generated_text' in data:
+            data = [data]
+        return [data]
+
+    def loading_seconds(self, response):
+        # A cold model answers 503 with {"error": "Model ... is currently loading", "estimated_time": 42.5}
+        if response.status_code != 503:
+            return None
+        try:
+            data = response.json()
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        if 'estimated_time' in data:
+            try:
+                return float(data['estimated_time'])
+            except (TypeError, ValueError):
+                return DEFAULT_LOADING_SECONDS
+        return DEFAULT_LOADING_SECONDS if 'loading' in str(data.get('error', '')).lower() else None
+
+
+class AzureBackend(InferenceBackend):
+    """Azure OpenAI chat completions deployment; the prompt is sent as a single user message."""
+
+    name = AZURE
+
+    def __init__(self, endpoint, deployment, api_key, api_version):
+        url = f"{endpoint.rstrip('/')}/openai/deployments/{deployment}/chat/completions?api-version={api_version}"
+        super().__init__(url, deployment, {"api-key": api_key})
+
+    def build_request(self, payloads):
+        payload = payloads[0]
+        parameters = _generation_parameters(payload)
+        body = {
+            "messages": [{"role": "user", "content": payload['inputs']}],
+            "max_tokens": parameters.get('max_new_tokens', 2048),
+            "temperature": parameters.get('temperature', 0.7),
+            "top_p": parameters.get('top_p', 0.95)
+        }
+        return self.url, self.headers, body
+
+    def parse_response(self, data, payloads):
+        content = data['choices'][0]['message'].get('content') or ''
+        return [[{'generated_text': f"{payloads[0]['inputs']}{content}"}]]
+
+
+class OpenAICompatibleBackend(InferenceBackend):
+    """
+    Any server with an OpenAI-compatible /v1/completions endpoint (vLLM, llama.cpp, TGI, Ollama).
+    The completions endpoint takes a list of prompts, so payloads sharing parameters are batched.
+    """
+
+    name = OPENAI_COMPATIBLE
+    supports_batching = True
+
+    def __init__(self, base_url, model, api_key=None):
+        base_url = base_url.rstrip('/')
+        if not base_url.endswith('/v1'):
+            base_url += '/v1'
+        super().__init__(f"{base_url}/completions", model,
+                         {"Authorization": f"Bearer {api_key}"} if api_key else {})
+
+    def build_request(self, payloads):
+        parameters = _generation_parameters(payloads[0])
+        body = {
+            "model": self.model,
+            "prompt": [payload['inputs'] for payload in payloads] if len(payloads) > 1 else payloads[0]['inputs'],
+            "max_tokens": parameters.get('max_new_tokens', 2048),
+            "temperature": parameters.get('temperature', 0.7),
+            "top_p": parameters.get('top_p', 0.95)
+        }
+        return self.url, self.headers, body
+
+    def parse_response(self, data, payloads):
+        texts = [''] * len(payloads)
+        for position, choice in enumerate(data.get('choices') or []):
+            index = choice.get('index', position)
+            if 0 <= index < len(payloads):
+                texts[index] = choice.get('text') or ''
+        return [[{'generated_text': f"{payload['inputs']}{text}"}] for payload, text in zip(payloads, texts)]
+
+
+class ColdStartGate:
+    """
+    Holds requests while the model is loading instead of letting each one spend its retries.
+
+    A loading response closes the gate until the server's estimated_time has passed. Then a single
+    probe request is let through while the others keep waiting; when a request gets a real answer
+    the gate opens and every waiting worker is released at once. After max_wait_seconds of loading
+    the gate gives up and loading responses are treated as ordinary 503 errors until the model
+    answers again; a max_wait_seconds of 0 disables holding altogether.
+    """
+
+    def __init__(self, max_wait_seconds=600):
+        self.max_wait_seconds = max_wait_seconds
+        self._lock = threading.Lock()
+        self._cold_since = None
+        self._reopen_at = 0.0
+        self._probing = False
+        self._gave_up = False
+
+    def _admit(self):
+        """Return 0 if the caller may send its request now, otherwise the seconds to wait before asking again."""
+        with self._lock:
+            if self._cold_since is None:
+                return 0
+            now = time.time()
+            if not self._probing and now >= self._reopen_at:
+                self._probing = True
+                return 0
+            return min(1.0, max(0.1, self._reopen_at - now))
+
+    def wait(self):
+        """Block until the caller may send its request."""
+        delay = self._admit()
+        while delay:
+            time.sleep(delay)
+            delay = self._admit()
+
+    async def wait_async(self):
+        """Async counterpart of wait."""
+        delay = self._admit()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self._admit()
+
+    def loading(self, estimated_seconds):
+        """
+        Record a loading response. Returns True if the request should wait for the model and be sent
+        again, False once the gate has given up waiting.
+        """
+        if self.max_wait_seconds <= 0:
+            # Holding is disabled
+            return False
+        with self._lock:
+            if self._gave_up:
+                return False
+            now = time.time()
+            if self._cold_since is None:
+                self._cold_since = now
+                logging.info(f"Model is loading (estimated {estimated_seconds:.0f}s), holding requests until it is ready")
+            elif now - self._cold_since > self.max_wait_seconds:
+                self._gave_up = True
+                self._cold_since = None
+                self._probing = False
+                logging.warning(f"Model still loading after {self.max_wait_seconds}s, no longer holding requests")
+                return False
+            wait = min(MAX_LOADING_WAIT_SECONDS, max(MIN_LOADING_WAIT_SECONDS, estimated_seconds))
+            self._reopen_at = now + wait
+            self._probing = False
+            return True
+
+    def ready(self):
+        """Record a response from a loaded model and release every waiting request."""
+        with self._lock:
+            if self._cold_since is not None:
+                logging.info(f"Model ready after {time.time() - self._cold_since:.0f}s, releasing held requests")
+            self._cold_since = None
+            self._probing = False
+            # A later unload (e.g. the endpoint scaling to zero) is held for again
+            self._gave_up = False
+
+    def abandon_probe(self):
+        """Let another request probe after this one failed without an answer from the server."""
+        with self._lock:
+            self._probing = False
+
+
+def create_backend(name, model_id, env):
+    """
+    Build the backend selected by INFERENCE_BACKEND. env maps setting names to values:
+    API_URL and HF_TOKEN for Hugging Face; AZURE_ENDPOINT, AZURE_API_KEY, AZURE_API_VERSION and
+    INFERENCE_MODEL (the deployment) for Azure; INFERENCE_BASE_URL, optionally INFERENCE_MODEL
+    and INFERENCE_API_KEY for an OpenAI-compatible server. model_id is the Hugging Face model id.
+    """
+    name = (name or HUGGINGFACE).strip().lower()
+    if name == HUGGINGFACE:
+        return HuggingFaceBackend(env.get('API_URL') or 'https://api-inference.huggingface.co/models/',
+                                  model_id, env.get('HF_TOKEN'))
+    if name == AZURE:
+        missing = [key for key in ('AZURE_ENDPOINT', 'AZURE_API_KEY', 'AZURE_API_VERSION', 'INFERENCE_MODEL')
+                   if not env.get(key)]
+        if missing:
+            raise ValueError(f"Missing settings for the azure inference backend: {', '.join(missing)}")
+        return AzureBackend(env['AZURE_ENDPOINT'], env['INFERENCE_MODEL'], env['AZURE_API_KEY'], env['AZURE_API_VERSION'])
+    if name == OPENAI_COMPATIBLE:
+        if not env.get('INFERENCE_BASE_URL'):
+            raise ValueError("INFERENCE_BASE_URL is required for the openai inference backend")
+        return OpenAICompatibleBackend(env['INFERENCE_BASE_URL'], env.get('INFERENCE_MODEL') or model_id,
+                                       env.get('INFERENCE_API_KEY'))
+    raise ValueError(f"Unknown INFERENCE_BACKEND '{name}'. Choose from: {HUGGINGFACE}, {AZURE}, {OPENAI_COMPATIBLE}")
@@ -0,0 +1,138 @@
+import os
+import csv
+import math
+import logging
+import threading
+from datetime import datetime
+from collections import defaultdict
+
+# Outcomes that count as a successful LLM interaction in the summary
+SUCCESS_OUTCOMES = {'completed', 'success', 'uploaded', 'reused'}
+
+# Numeric measurements summarised with percentiles
+MEASUREMENTS = [
+    'upload_seconds', 'queue_seconds', 'run_seconds', 'total_seconds',
+    'poll_count', 'prompt_tokens', 'completion_tokens', 'retries', 'cost'
+]
+
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a non-empty list of numbers."""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * pct / 100
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+class LLMMetricsRecorder:
+    """
+    Records one row per LLM interaction (upload, assistant run or inference call) in a
+    per-run CSV, and writes p50/p95/p99 summaries per operation and per file extension.
+    """
+
+    FIELDS = ['timestamp', 'operation', 'file_name', 'extension', 'model', 'outcome'] + MEASUREMENTS
+
+    def __init__(self, result_dir, prompt_cost_per_1k=0.0, completion_cost_per_1k=0.0):
+        run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.requests_path = os.path.join(result_dir, f'llm_requests_{run_id}.csv')
+        self.summary_path = os.path.join(result_dir, f'llm_summary_{run_id}.csv')
+        self.prompt_cost_per_1k = prompt_cost_per_1k
+        self.completion_cost_per_1k = completion_cost_per_1k
+        self._records = []
+        self._lock = threading.Lock()
+
+    def record(self, operation, file_path, model, outcome, **measurements):
+        """Store one interaction and append it to the per-run requests CSV."""
+        file_name = os.path.basename(file_path) if file_path else ''
+        row = {
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'operation': operation,
+            'file_name': file_name,
+            'extension': os.path.splitext(file_name)[1].lower() or '(none)',
+            'model': model or '',
+            'outcome': outcome
+        }
+        for name in MEASUREMENTS:
+            value = measurements.get(name)
+            row[name] = round(value, 3) if isinstance(value, float) else value
+        if row['cost'] is None and (row['prompt_tokens'] is not None or row['completion_tokens'] is not None):
+            row['cost'] = round(
+                (row['prompt_tokens'] or 0) / 1000 * self.prompt_cost_per_1k
+                + (row['completion_tokens'] or 0) / 1000 * self.completion_cost_per_1k, 6
+            )
+
+        with self._lock:
+            self._records.append(row)
+            try:
+                os.makedirs(os.path.dirname(self.requests_path), exist_ok=True)
+                write_header = not os.path.exists(self.requests_path)
+                with open(self.requests_path, 'a', newline='', encoding='utf-8') as f:
+                    writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                    if write_header:
+                        writer.writeheader()
+                    writer.writerow(row)
+            except Exception as e:
+                logging.error(f"Error writing LLM request metrics: {e}")
+        return row
+
+    def total_tokens(self):
+        """Prompt plus completion tokens reported so far in this run."""
+        with self._lock:
+            return sum((row['prompt_tokens'] or 0) + (row['completion_tokens'] or 0) for row in self._records)
+
+    def _summarise(self, scope, group, rows):
+        """Build one summary row per measurement for a group of interactions."""
+        succeeded = sum(1 for row in rows if row['outcome'] in SUCCESS_OUTCOMES)
+        summary_rows = []
+        for name in MEASUREMENTS:
+            values = [row[name] for row in rows if row[name] is not None]
+            if not values:
+                continue
+            summary_rows.append({
+                'Scope': scope,
+                'Group': group,
+                'Measurement': name,
+                'Requests': len(rows),
+                'Succeeded': succeeded,
+                'Samples': len(values),
+                'P50': round(percentile(values, 50), 3),
+                'P95': round(percentile(values, 95), 3),
+                'P99': round(percentile(values, 99), 3),
+                'Mean': round(sum(values) / len(values), 3),
+                'Total': round(sum(values), 3)
+            })
+        return summary_rows
+
+    def write_summary(self):
+        """Write percentile summaries for the whole run, each operation and each extension."""
+        with self._lock:
+            records = list(self._records)
+        if not records:
+            return None
+
+        by_operation = defaultdict(list)
+        by_extension = defaultdict(list)
+        for row in records:
+            by_operation[row['operation']].append(row)
+            by_extension[(row['operation'], row['extension'])].append(row)
+
+        summary_rows = self._summarise('run', 'all', records)
+        for operation, rows in sorted(by_operation.items()):
+            summary_rows += self._summarise('operation', operation, rows)
+        for (operation, extension), rows in sorted(by_extension.items()):
+            summary_rows += self._summarise('extension', f"{operation} {extension}", rows)
+        if not summary_rows:
+            return None
+
+        try:
+            with open(self.summary_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=list(summary_rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(summary_rows)
+            logging.info(f"LLM request summary written to {self.summary_path}")
+        except Exception as e:
+            logging.error(f"Error writing LLM request summary: {e}")
+        return self.summary_path
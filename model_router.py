@@ -0,0 +1,156 @@
+import os
+import re
+import ast
+import csv
+import logging
+import threading
+from datetime import datetime
+from collections import defaultdict
+from typing import NamedTuple
+
+from token_counter import Tokenizer
+
+# Branching constructs of brace and scripting languages, each adding one path through the code
+DECISION_PATTERN = re.compile(r'\b(?:if|for|foreach|while|case|catch|elif|elsif|except|when|unless)\b|&&|\|\||\?\?')
+COMMENT_AND_STRING_PATTERN = re.compile(
+    r'//[^\n]*|/\*.*?\*/|#[^\n]*|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'', re.DOTALL
+)
+
+ROUTING_FIELDS = ['timestamp', 'file', 'model', 'reason', 'tokens', 'complexity', 'refine_seconds', 'outcome']
+
+
+def _python_complexity(source):
+    decisions = 0
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, (ast.If, ast.For, ast.AsyncFor, ast.While, ast.IfExp, ast.ExceptHandler, ast.Assert)):
+            decisions += 1
+        elif isinstance(node, ast.BoolOp):
+            decisions += len(node.values) - 1
+        elif isinstance(node, ast.comprehension):
+            decisions += 1 + len(node.ifs)
+        elif hasattr(ast, 'match_case') and isinstance(node, ast.match_case):
+            decisions += 1
+    return decisions
+
+
+def estimate_complexity(source, extension):
+    """
+    Estimate the cyclomatic complexity of a whole file: 1 plus its decision points.
+    Python is measured on the AST; other languages by counting branching keywords and operators.
+    """
+    if extension.lower() == '.py':
+        try:
+            return 1 + _python_complexity(source)
+        except (SyntaxError, ValueError):
+            pass
+    return 1 + len(DECISION_PATTERN.findall(COMMENT_AND_STRING_PATTERN.sub('', source)))
+
+
+class RoutingDecision(NamedTuple):
+    """The deployment chosen for a file and the measurements behind the choice."""
+    model: str
+    reason: str
+    tokens: int
+    complexity: int
+
+
+class ModelRouter:
+    """
+    Sends small, simple files to a fast deployment and everything else to the default one.
+    A file goes to small_model only when both its token count and its estimated cyclomatic
+    complexity are within the thresholds. Decisions and per-file refinement latency are
+    written to Result/model_routing_<run>.csv.
+    """
+
+    def __init__(self, default_model, small_model, max_small_tokens, max_small_complexity, result_dir, tokenizer=None):
+        self.default_model = default_model
+        self.small_model = small_model if small_model and small_model != default_model else None
+        self.max_small_tokens = max_small_tokens
+        self.max_small_complexity = max_small_complexity
+        self.report_path = os.path.join(result_dir, f"model_routing_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        # Built on the first routing decision, so runs with routing disabled never load an encoding
+        self._tokenizer = tokenizer
+        self._decisions = {}
+        self._latencies = defaultdict(list)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.small_model is not None
+
+    @property
+    def tokenizer(self):
+        with self._lock:
+            if self._tokenizer is None:
+                self._tokenizer = Tokenizer()
+            return self._tokenizer
+
+    @property
+    def models(self):
+        return [self.default_model] + ([self.small_model] if self.enabled else [])
+
+    def route(self, file_path) -> RoutingDecision:
+        """Choose the deployment for a file; the decision is made once per file and reused."""
+        with self._lock:
+            decision = self._decisions.get(file_path)
+        if decision is not None:
+            return decision
+        if not self.enabled:
+            decision = RoutingDecision(self.default_model, 'routing disabled', 0, 0)
+        else:
+            try:
+                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                    source = f.read()
+            except OSError:
+                source = ''
+            tokens = self.tokenizer.count(source)
+            complexity = estimate_complexity(source, os.path.splitext(file_path)[1])
+            if tokens > self.max_small_tokens:
+                decision = RoutingDecision(self.default_model, f"tokens {tokens} > {self.max_small_tokens}", tokens, complexity)
+            elif complexity > self.max_small_complexity:
+                decision = RoutingDecision(
+                    self.default_model, f"complexity {complexity} > {self.max_small_complexity}", tokens, complexity
+                )
+            else:
+                decision = RoutingDecision(self.small_model, 'small and simple', tokens, complexity)
+        with self._lock:
+            self._decisions[file_path] = decision
+        return decision
+
+    def route_group(self, file_paths) -> str:
+        """Deployment for a request covering several files: the default one if any file needs it."""
+        models = {self.route(file_path).model for file_path in file_paths}
+        return self.default_model if self.default_model in models else self.small_model or self.default_model
+
+    def record(self, file_path, seconds, succeeded):
+        """Append the routing decision and the file's refinement latency to the routing CSV."""
+        decision = self.route(file_path)
+        row = {
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'file': file_path,
+            'model': decision.model,
+            'reason': decision.reason,
+            'tokens': decision.tokens,
+            'complexity': decision.complexity,
+            'refine_seconds': round(seconds, 3),
+            'outcome': 'success' if succeeded else 'fallback'
+        }
+        with self._lock:
+            self._latencies[decision.model].append(seconds)
+            try:
+                os.makedirs(os.path.dirname(self.report_path), exist_ok=True)
+                write_header = not os.path.exists(self.report_path)
+                with open(self.report_path, 'a', newline='', encoding='utf-8') as f:
+                    writer = csv.DictWriter(f, fieldnames=ROUTING_FIELDS)
+                    if write_header:
+                        writer.writeheader()
+                    writer.writerow(row)
+            except Exception as e:
+                logging.error(f"Error writing model routing decision: {e}")
+
+    def log_summary(self):
+        """Log how many files each deployment refined and their mean latency."""
+        with self._lock:
+            latencies = {model: list(values) for model, values in self._latencies.items()}
+        for model, values in sorted(latencies.items()):
+            logging.info(f"Model {model}: {len(values)} files refined, mean {sum(values) / len(values):.1f}s per file")
@@ -0,0 +1,280 @@
+import re
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+# Status codes that mean "slow down and try again"
+THROTTLED_STATUS_CODES = {429, 503}
+# Transient server failures retried with the same backoff (the codes the openai SDK retries)
+TRANSIENT_STATUS_CODES = {408, 409, 500, 502, 504}
+RETRYABLE_STATUS_CODES = THROTTLED_STATUS_CODES | TRANSIENT_STATUS_CODES
+
+# Rough bytes-per-token ratio used to charge a request against the tokens-per-minute bucket and
+# to size requests without a tokenizer
+ESTIMATED_BYTES_PER_TOKEN = 4
+
+# Throttling retries made by the transports for the request being measured in this context
+_retry_counter = contextvars.ContextVar('rate_limiter_retries', default=None)
+
+
+def start_retry_count():
+    """Start counting the transports' throttling retries for requests made from the current context."""
+    _retry_counter.set([0])
+
+
+def retry_count():
+    """Throttling retries made since start_retry_count was called in the current context."""
+    counter = _retry_counter.get()
+    return counter[0] if counter else 0
+
+
+def _count_retry():
+    counter = _retry_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header given as seconds or as an HTTP date. Returns seconds or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(headers):
+    """Read the server's requested delay from retry-after-ms (Azure) or Retry-After."""
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    return parse_retry_after(headers.get('retry-after'))
+
+
+def parse_reset_duration(value):
+    """Parse x-ratelimit-reset-* values such as '1s', '6m0s', '250ms' or '12'. Returns seconds or None."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    matched = False
+    for amount, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value):
+        matched = True
+        seconds += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds if matched else None
+
+
+class _Bucket:
+    """Token bucket refilled continuously at capacity per minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount):
+        """Take amount from the bucket if available; otherwise return how long to wait for it."""
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+        # Requests larger than the whole bucket are admitted once it is full
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            self.level -= amount
+            return 0.0
+        return (amount - self.level) * 60 / self.capacity
+
+
+class RateLimiter:
+    """
+    Shared requests-per-minute and tokens-per-minute limiter (0 disables a limit).
+    Throttling responses and x-ratelimit headers pause every caller until the server's
+    reset time, and retries use jittered exponential backoff so concurrent workers do
+    not retry in lock-step.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, max_retries=5,
+                 base_backoff=1.0, max_backoff=60.0):
+        self.request_bucket = _Bucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.token_bucket = _Bucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        """Return 0 once a request is admitted, otherwise the time to wait before trying again."""
+        with self._lock:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                return pause
+            request_wait = self.request_bucket.wait_time(1) if self.request_bucket else 0.0
+            if request_wait > 0:
+                return request_wait
+            token_wait = self.token_bucket.wait_time(tokens) if self.token_bucket and tokens else 0.0
+            if token_wait > 0:
+                # Give the request slot back; it is taken again on the next attempt
+                if self.request_bucket:
+                    self.request_bucket.level += 1
+                return token_wait
+            return 0.0
+
+    def acquire(self, tokens=0):
+        """Block until a request of roughly `tokens` tokens may be sent."""
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=0):
+        """Async counterpart of acquire."""
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold back every caller for the given number of seconds."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers, status_code=None):
+        """
+        Apply server-side rate limit feedback. Returns the Retry-After delay in seconds, if any.
+        """
+        retry_after = retry_after_seconds(headers)
+        if status_code in THROTTLED_STATUS_CODES and retry_after:
+            self.pause(retry_after)
+
+        for kind in ('requests', 'tokens'):
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if remaining is None:
+                continue
+            try:
+                remaining = float(remaining)
+            except ValueError:
+                continue
+            if remaining <= 0:
+                reset = parse_reset_duration(headers.get(f'x-ratelimit-reset-{kind}')) or retry_after or self.base_backoff
+                logging.info(f"Rate limit for {kind} exhausted, pausing requests for {reset:.1f}s")
+                self.pause(reset)
+            else:
+                # Keep the local buckets no more optimistic than the server
+                bucket = self.request_bucket if kind == 'requests' else self.token_bucket
+                if bucket is not None:
+                    with self._lock:
+                        bucket.level = min(bucket.level, remaining)
+        return retry_after
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * (2 ** attempt)))
+        return max(delay, retry_after or 0.0)
+
+
+def estimate_request_tokens(request):
+    """Estimate the prompt tokens of a JSON API request from its body size; uploads are not charged."""
+    if request.method != 'POST' or not request.headers.get('content-type', '').startswith('application/json'):
+        return 0
+    return len(request.content) // ESTIMATED_BYTES_PER_TOKEN + 1
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """
+    httpx transport that admits POST requests through a RateLimiter and retries throttled
+    responses (429/503), transient server errors and connection failures or timeouts with
+    jittered backoff. Status polls (GET) are not limited. Retries are counted for retry_count();
+    clients using it should set max_retries=0 so the SDK does not retry the same requests again.
+    """
+
+    def __init__(self, limiter, transport=None):
+        self.limiter = limiter
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        limited = request.method == 'POST'
+        tokens = estimate_request_tokens(request)
+        for attempt in range(self.limiter.max_retries + 1):
+            if limited:
+                self.limiter.acquire(tokens)
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError as e:
+                if attempt == self.limiter.max_retries:
+                    raise
+                delay = self.limiter.backoff_delay(attempt)
+                logging.warning(f"Request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                _count_retry()
+                time.sleep(delay)
+                continue
+            retry_after = self.limiter.update_from_headers(response.headers, response.status_code)
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == self.limiter.max_retries:
+                return response
+            delay = self.limiter.backoff_delay(attempt, retry_after)
+            kind = 'throttled' if response.status_code in THROTTLED_STATUS_CODES else 'failed'
+            logging.warning(f"Request {kind} ({response.status_code}), retrying in {delay:.1f}s")
+            _count_retry()
+            response.close()
+            time.sleep(delay)
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """Async counterpart of RateLimitedTransport."""
+
+    def __init__(self, limiter, transport=None):
+        self.limiter = limiter
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        limited = request.method == 'POST'
+        tokens = estimate_request_tokens(request)
+        for attempt in range(self.limiter.max_retries + 1):
+            if limited:
+                await self.limiter.acquire_async(tokens)
+            try:
+                response = await self.transport.handle_async_request(request)
+            except httpx.TransportError as e:
+                if attempt == self.limiter.max_retries:
+                    raise
+                delay = self.limiter.backoff_delay(attempt)
+                logging.warning(f"Request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                _count_retry()
+                await asyncio.sleep(delay)
+                continue
+            retry_after = self.limiter.update_from_headers(response.headers, response.status_code)
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == self.limiter.max_retries:
+                return response
+            delay = self.limiter.backoff_delay(attempt, retry_after)
+            kind = 'throttled' if response.status_code in THROTTLED_STATUS_CODES else 'failed'
+            logging.warning(f"Request {kind} ({response.status_code}), retrying in {delay:.1f}s")
+            _count_retry()
+            await response.aclose()
+            await asyncio.sleep(delay)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
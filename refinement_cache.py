@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+
+
+class RefinementCache:
+    """
+    Content-addressed on-disk store for refined files and generated tests.
+    Entries are keyed by a hash of the source bytes, prompt, model and assistant
+    instructions, and the least recently used entries are evicted once the cache
+    grows beyond its size limit.
+    """
+
+    OUTPUT_NAME = 'output'
+    METADATA_NAME = 'meta.json'
+    # Staging directories older than this were left behind by an interrupted put
+    STALE_STAGING_SECONDS = 3600
+
+    def __init__(self, cache_dir, max_size_mb):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.enabled = max_size_mb > 0
+        self._lock = threading.Lock()
+        self._total_size = None
+
+    @staticmethod
+    def make_key(file_bytes, prompt, model, instructions):
+        """Build the cache key for one source file and request configuration."""
+        digest = hashlib.sha256()
+        for part in (file_bytes, prompt.encode('utf-8'), (model or '').encode('utf-8'), (instructions or '').encode('utf-8')):
+            # Length-prefix each part so different splits of the same bytes never collide
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _entries(self):
+        """List (last_used, size, path) for every complete entry in the cache."""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.tmp'):
+                    # Staging directory of a put that may still be writing; only abandoned ones are removed
+                    try:
+                        if time.time() - entry.stat().st_mtime > self.STALE_STAGING_SECONDS:
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                    except OSError:
+                        pass
+                    continue
+                meta_path = os.path.join(entry.path, self.METADATA_NAME)
+                output_path = os.path.join(entry.path, self.OUTPUT_NAME)
+                try:
+                    size = os.path.getsize(meta_path) + os.path.getsize(output_path)
+                    entries.append((os.path.getmtime(meta_path), size, entry.path))
+                except OSError:
+                    # Incomplete entry left behind by an interrupted write
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        return entries
+
+    def restore(self, key, target_path):
+        """Copy a cached output to target_path. Returns the entry metadata, or None on a miss."""
+        if not self.enabled:
+            return None
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, self.METADATA_NAME)
+        output_path = os.path.join(entry_dir, self.OUTPUT_NAME)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            shutil.copyfile(output_path, target_path)
+            # Touch the metadata so eviction sees this entry as recently used
+            os.utime(meta_path, None)
+            return metadata
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Failed to restore cache entry {key}: {e}")
+            return None
+
+    def discard(self, key):
+        """Remove an entry, e.g. an output that later failed validation."""
+        entry_dir = self._entry_dir(key)
+        if not self.enabled or not os.path.isdir(entry_dir):
+            return
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        with self._lock:
+            # Recounted on the next put
+            self._total_size = None
+
+    def put(self, key, output_path, changes, next_steps, summaries=None):
+        """
+        Store a generated file and its summaries under the given key. Fused requests pass one
+        (changes, next_steps) pair per prompt as summaries so a restore logs the same rows.
+        """
+        if not self.enabled or not os.path.exists(output_path):
+            return
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(os.path.join(entry_dir, self.METADATA_NAME)):
+            return
+        staging_dir = f"{entry_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(staging_dir, exist_ok=True)
+            shutil.copyfile(output_path, os.path.join(staging_dir, self.OUTPUT_NAME))
+            with open(os.path.join(staging_dir, self.METADATA_NAME), 'w', encoding='utf-8') as f:
+                json.dump({
+                    'file_name': os.path.basename(output_path),
+                    'changes': changes,
+                    'next_steps': next_steps,
+                    'summaries': [list(summary) for summary in summaries] if summaries else None,
+                    'created': time.strftime('%Y-%m-%d %H:%M:%S')
+                }, f)
+            size = sum(os.path.getsize(os.path.join(staging_dir, name)) for name in os.listdir(staging_dir))
+            os.replace(staging_dir, entry_dir)
+        except OSError as e:
+            # Another worker stored the same key first, or the disk write failed
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            logging.debug(f"Skipped caching entry {key}: {e}")
+            return
+
+        with self._lock:
+            if self._total_size is None:
+                self._total_size = sum(entry_size for _, entry_size, _ in self._entries())
+            else:
+                self._total_size += size
+            if self._total_size > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits its size limit."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_size_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        self._total_size = total
+        logging.info(f"Refinement cache evicted {removed} entries, {total / (1024 * 1024):.1f} MB remaining")
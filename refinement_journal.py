@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+# Per-file stages in the order GreenCodeRefiner runs them
+STAGE_SOURCE_TESTS = 'source_tests'
+STAGE_REFINED = 'refined'
+STAGE_REFINED_TESTS = 'refined_tests'
+
+
+class RefinementJournal:
+    """
+    Append-only JSONL journal of per-file stage completion, so a run that dies part-way
+    can be resumed: finished stages are skipped and their metrics counters are re-applied.
+    Each stage entry carries a hash of the source file, so a file edited since the
+    interrupted attempt is processed again. The journal is removed once a run completes.
+    """
+
+    def __init__(self, journal_path, source_directory):
+        self.journal_path = journal_path
+        self.source_directory = source_directory
+        self._completed = {}
+        self._previous_seconds = 0.0
+        self._needs_newline = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        """Read the entries of earlier, interrupted attempts. Truncated trailing lines are ignored."""
+        if not os.path.exists(self.journal_path):
+            return
+        attempt_start = attempt_end = None
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # A crash mid-write leaves a last line without its newline
+                self._needs_newline = not line.endswith('\n')
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Ignoring incomplete journal line in {self.journal_path}")
+                    continue
+                if entry.get('event') == 'run_started':
+                    if attempt_start is not None and attempt_end is not None:
+                        self._previous_seconds += attempt_end - attempt_start
+                    attempt_start = attempt_end = entry['time']
+                    continue
+                attempt_end = entry['time']
+                self._store(entry)
+        if attempt_start is not None and attempt_end is not None:
+            self._previous_seconds += attempt_end - attempt_start
+
+    def _store(self, entry):
+        # A regenerated refined file makes tests generated from the previous one stale
+        if entry['stage'] == STAGE_REFINED:
+            self._completed.pop((entry['file'], STAGE_REFINED_TESTS), None)
+        self._completed[(entry['file'], entry['stage'])] = entry
+
+    @property
+    def resuming(self):
+        """True when an interrupted run left completed stages behind."""
+        return bool(self._completed)
+
+    @property
+    def previous_seconds(self):
+        """Wall-clock time spent by the interrupted attempts, up to their last completed stage."""
+        return self._previous_seconds
+
+    def _relative(self, file_path):
+        return os.path.relpath(file_path, self.source_directory)
+
+    @staticmethod
+    def fingerprint(file_path):
+        with open(file_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _append(self, entry):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                if self._needs_newline:
+                    f.write('\n')
+                    self._needs_newline = False
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def start_run(self):
+        """Mark the start of an attempt so its duration can be recovered after a crash."""
+        self._append({'event': 'run_started', 'time': time.time()})
+
+    def completed_entry(self, file_path, stage):
+        """Return the journal entry if this stage finished for the current file contents."""
+        entry = self._completed.get((self._relative(file_path), stage))
+        if entry is None or entry.get('source_hash') != self.fingerprint(file_path):
+            return None
+        return entry
+
+    def skip_if_done(self, file_path, stage, metrics_tracker):
+        """
+        Return True if this stage already finished in an interrupted attempt, re-applying
+        the metrics it tracked then so final_overview.csv counts it exactly once.
+        """
+        entry = self.completed_entry(file_path, stage)
+        if entry is None:
+            return False
+        metrics_tracker.add_tracked(entry.get('tracked', []))
+        logging.info(f"Skipping {stage} for {entry['file']}, already completed before the restart")
+        return True
+
+    def mark_done(self, file_path, stage, tracked):
+        """Record a finished stage with the files it tracked, as collected by MetricsTracker.capture()."""
+        entry = {
+            'file': self._relative(file_path),
+            'stage': stage,
+            'source_hash': self.fingerprint(file_path),
+            'tracked': [[path, ext, loc] for path, ext, loc in tracked],
+            'time': time.time()
+        }
+        self._append(entry)
+        with self._lock:
+            self._store(entry)
+
+    def complete(self):
+        """Remove the journal after a run finished, so the next run starts fresh."""
+        with self._lock:
+            self._completed.clear()
+            self._needs_newline = False
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
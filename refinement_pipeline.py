@@ -0,0 +1,73 @@
+import queue
+import logging
+import threading
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+# Marks the end of the input for one worker of the next stage
+_END = object()
+
+
+class PipelineStage(NamedTuple):
+    """One pipeline stage: handler(item) runs on `workers` threads and returns the item for the next stage."""
+    name: str
+    handler: Callable
+    workers: int
+
+
+def run_pipeline(items: Iterable, stages: List[PipelineStage], queue_size: int,
+                 on_error: Optional[Callable] = None, should_stop: Optional[Callable] = None) -> None:
+    """
+    Push items through the stages, with a bounded queue in front of every stage so a fast
+    stage cannot run arbitrarily far ahead of a slow one. Each stage has its own worker
+    threads, so file N+1 can be in an early stage while file N is in a later one.
+
+    A handler returning None drops the item. If a handler raises, on_error(item, error) is
+    called and the item is dropped. should_stop() is checked before each new item is admitted.
+    """
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+    remaining_workers = [stage.workers for stage in stages]
+    counter_lock = threading.Lock()
+
+    def worker(index):
+        stage = stages[index]
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(stages) else None
+        while True:
+            item = inbox.get()
+            if item is _END:
+                break
+            try:
+                result = stage.handler(item)
+            except Exception as e:
+                logging.error(f"Pipeline stage '{stage.name}' failed for {item}: {e}")
+                if on_error:
+                    on_error(item, e)
+                continue
+            if result is not None and outbox is not None:
+                outbox.put(result)
+
+        # The last worker of a stage to finish closes the next stage's input
+        with counter_lock:
+            remaining_workers[index] -= 1
+            last_worker = remaining_workers[index] == 0
+        if last_worker and outbox is not None:
+            for _ in range(stages[index + 1].workers):
+                outbox.put(_END)
+
+    threads = []
+    for index, stage in enumerate(stages):
+        for number in range(stage.workers):
+            thread = threading.Thread(target=worker, args=(index,), name=f"{stage.name}-{number + 1}")
+            thread.start()
+            threads.append(thread)
+
+    try:
+        for item in items:
+            if should_stop and should_stop():
+                break
+            queues[0].put(item)
+    finally:
+        for _ in range(stages[0].workers):
+            queues[0].put(_END)
+        for thread in threads:
+            thread.join()
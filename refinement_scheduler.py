@@ -0,0 +1,106 @@
+import os
+import csv
+import time
+import logging
+from collections import defaultdict
+from typing import List, NamedTuple, Optional
+
+
+class FileCandidate(NamedTuple):
+    """A source file with the inputs used to estimate its refinement payoff."""
+    path: str
+    energy_wh: float
+    loc: int
+    size: int
+
+
+def count_loc(file_path) -> int:
+    """Count non-blank lines, the same way MetricsTracker does."""
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            return sum(1 for line in f if line.strip())
+    except OSError:
+        return 0
+
+
+def load_directory_energy(emissions_csv) -> dict:
+    """
+    Sum the latest measured energy (Wh) of every application per solution dir
+    from a main_before_emissions_data.csv written by track_emissions.py.
+    """
+    if not emissions_csv or not os.path.exists(emissions_csv):
+        return {}
+    latest = {}
+    try:
+        with open(emissions_csv, 'r', newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                if str(row.get('Is Green Refined', '')).strip().lower() == 'true':
+                    continue
+                try:
+                    energy = float(row.get('Energy Consumed (Wh)') or 0)
+                except ValueError:
+                    continue
+                key = (row.get('solution dir', ''), row.get('Application name', ''))
+                # Rows are appended per measurement run, so the last one per application wins
+                latest[key] = energy
+    except Exception as e:
+        logging.warning(f"Unable to read emissions data from {emissions_csv}: {e}")
+        return {}
+
+    energy_by_dir = defaultdict(float)
+    for (solution_dir, _), energy in latest.items():
+        energy_by_dir[solution_dir] += energy
+    return dict(energy_by_dir)
+
+
+def rank_files(file_list, emissions_csv) -> List[FileCandidate]:
+    """
+    Order files by expected payoff: the energy of their solution dir shared out by LOC,
+    then LOC, then size. Without emissions data this falls back to the biggest files first.
+    """
+    energy_by_dir = load_directory_energy(emissions_csv)
+    measured = [(path, count_loc(path), os.path.getsize(path)) for path in file_list]
+
+    loc_by_dir = defaultdict(int)
+    for path, loc, _ in measured:
+        loc_by_dir[os.path.basename(os.path.dirname(path))] += loc
+
+    candidates = []
+    for path, loc, size in measured:
+        solution_dir = os.path.basename(os.path.dirname(path))
+        dir_energy = energy_by_dir.get(solution_dir, 0.0)
+        share = loc / loc_by_dir[solution_dir] if loc_by_dir[solution_dir] else 0.0
+        candidates.append(FileCandidate(path, dir_energy * share, loc, size))
+
+    candidates.sort(key=lambda candidate: (candidate.energy_wh, candidate.loc, candidate.size), reverse=True)
+    if energy_by_dir:
+        logging.info(f"Ranked {len(candidates)} files using energy data for {len(energy_by_dir)} solution dirs")
+    else:
+        logging.info(f"No emissions data found, ranked {len(candidates)} files by LOC and size")
+    return candidates
+
+
+class RefinementBudget:
+    """
+    Wall-clock and token budget for a refinement run (0 disables a limit).
+    Work already in flight is allowed to finish; only new work is refused.
+    """
+
+    def __init__(self, time_budget_minutes=0, token_budget=0, token_counter=None):
+        self.start_time = time.time()
+        self.time_budget_seconds = time_budget_minutes * 60
+        self.token_budget = token_budget
+        self.token_counter = token_counter
+        self._reported = False
+
+    def exhausted(self) -> Optional[str]:
+        """Return why the budget is used up, or None while work may continue."""
+        reason = None
+        if self.time_budget_seconds > 0 and time.time() - self.start_time >= self.time_budget_seconds:
+            reason = f"time budget of {self.time_budget_seconds / 60:g} minutes reached"
+        elif self.token_budget > 0 and self.token_counter and self.token_counter() >= self.token_budget:
+            reason = f"token budget of {self.token_budget} tokens reached"
+        if reason and not self._reported:
+            self._reported = True
+            logging.warning(f"Refinement budget exhausted ({reason}); remaining files are not started")
+        return reason
@@ -0,0 +1,313 @@
+import os
+import csv
+import queue
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+MODIFICATION_FIELDS = ['File Name', 'Modification Timestamp', 'Changes', 'Next Steps']
+
+# Run id under which totals and rows from the pre-ledger CSV files are imported
+LEGACY_RUN_ID = 'legacy_import'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    tool TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    files_modified INTEGER NOT NULL DEFAULT 0,
+    loc_converted INTEGER NOT NULL DEFAULT 0,
+    minutes REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_runs_finished ON runs(finished_at);
+
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    loc INTEGER NOT NULL,
+    tracked_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_files_run ON files(run_id);
+
+CREATE TABLE IF NOT EXISTS modifications (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    modified_at TEXT NOT NULL,
+    changes TEXT,
+    next_steps TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_modifications_run ON modifications(run_id);
+
+CREATE TABLE IF NOT EXISTS extension_loc (
+    run_id TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    loc INTEGER NOT NULL,
+    PRIMARY KEY (run_id, extension)
+);
+CREATE INDEX IF NOT EXISTS idx_extension_loc_extension ON extension_loc(extension);
+"""
+
+# Stops the writer thread once everything queued before it is written
+_STOP = object()
+
+
+def _timestamp():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def load_historical_data(csv_path):
+    """Read the Historical Overview section of a final_overview.csv written before the ledger existed."""
+    historical_data = {}
+    if not os.path.exists(csv_path):
+        return historical_data
+    try:
+        with open(csv_path, 'r', newline='') as csvfile:
+            historical_section = False
+            for row in csv.reader(csvfile):
+                if not row:
+                    continue
+                if row[0] == '=== Historical Overview ===':
+                    historical_section = True
+                    continue
+                if historical_section and len(row) == 2:
+                    metric, value = row
+                    if 'LOC' in value:
+                        historical_data[metric] = int(value.split()[0])
+                    elif '.' in value:
+                        historical_data[metric] = float(value)
+                    else:
+                        historical_data[metric] = int(value)
+    except Exception as e:
+        logging.warning(f"Error loading historical data: {e}")
+    return historical_data
+
+
+class RunLedger:
+    """
+    SQLite ledger of refinement runs, the files they converted and the modifications they logged.
+
+    Writes from any thread are queued and applied by one writer thread, which commits
+    whatever has accumulated as a single transaction, so concurrent workers never contend
+    on a file. final_overview.csv and modification_overview.csv are exported from the ledger,
+    and historical totals are indexed aggregate queries over finished runs.
+    """
+
+    def __init__(self, db_path, tool, batch_size=200):
+        self.db_path = db_path
+        self.tool = tool
+        self.run_id = f"{tool}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+        self.started_at = _timestamp()
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def _submit(self, sql, params):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='run-ledger-writer', daemon=True)
+                self._writer.start()
+        self._queue.put((sql, params))
+
+    def _write_loop(self):
+        connection = None
+        try:
+            connection = self._connect()
+            with connection:
+                connection.executescript(SCHEMA)
+                self._import_legacy_csv(connection)
+                connection.execute(
+                    'INSERT OR IGNORE INTO runs (run_id, tool, started_at) VALUES (?, ?, ?)',
+                    (self.run_id, self.tool, self.started_at)
+                )
+        except Exception as e:
+            logging.error(f"Failed to initialise run ledger {self.db_path}: {e}")
+            if connection is not None:
+                connection.close()
+            # Queued writes are still taken off the queue so flush() and close() do not hang
+            connection = None
+
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            # Everything queued while the previous batch was committing goes into this one
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if connection is None:
+                    stopping = any(item is _STOP for item in batch)
+                else:
+                    with connection:
+                        for item in batch:
+                            if item is _STOP:
+                                stopping = True
+                            else:
+                                connection.execute(*item)
+            except Exception as e:
+                logging.error(f"Failed to write {len(batch)} entries to run ledger: {e}")
+                stopping = stopping or any(item is _STOP for item in batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        if connection is not None:
+            connection.close()
+
+    def _import_legacy_csv(self, connection):
+        """Seed an empty ledger with the totals and modifications recorded in the old CSV files."""
+        if connection.execute('SELECT 1 FROM runs LIMIT 1').fetchone():
+            return
+        result_dir = os.path.dirname(self.db_path)
+        historical = load_historical_data(os.path.join(result_dir, 'final_overview.csv'))
+        modifications_path = os.path.join(result_dir, 'modification_overview.csv')
+        modifications = []
+        if os.path.exists(modifications_path):
+            with open(modifications_path, 'r', newline='') as csvfile:
+                modifications = [
+                    (LEGACY_RUN_ID, row.get('File Name') or '', row.get('Modification Timestamp') or '',
+                     row.get('Changes'), row.get('Next Steps'))
+                    for row in csv.DictReader(csvfile)
+                ]
+        if not historical and not modifications:
+            return
+
+        now = _timestamp()
+        connection.execute(
+            'INSERT INTO runs (run_id, tool, started_at, finished_at, files_modified, loc_converted, minutes) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (LEGACY_RUN_ID, 'import', now, now, historical.get('Total Files Modified', 0),
+             historical.get('Total LOC Converted', 0), historical.get('Total Time (minutes)', 0))
+        )
+        connection.executemany(
+            'INSERT INTO extension_loc (run_id, extension, loc) VALUES (?, ?, ?)',
+            [(LEGACY_RUN_ID, metric.split()[0].lstrip('.'), value) for metric, value in historical.items()
+             if metric.startswith('.') and metric.endswith(' Files')]
+        )
+        connection.executemany(
+            'INSERT INTO modifications (run_id, file_name, modified_at, changes, next_steps) VALUES (?, ?, ?, ?, ?)',
+            modifications
+        )
+        logging.info(f"Imported {len(modifications)} modifications and historical totals into {self.db_path}")
+
+    def record_file(self, file_path, extension, loc):
+        """Record a converted file of this run."""
+        self._submit(
+            'INSERT INTO files (run_id, file_path, extension, loc, tracked_at) VALUES (?, ?, ?, ?, ?)',
+            (self.run_id, str(file_path), extension, loc, _timestamp())
+        )
+
+    def record_modification(self, file_name, changes, next_steps):
+        """Record the changes summary and next steps the model gave for a file."""
+        self._submit(
+            'INSERT INTO modifications (run_id, file_name, modified_at, changes, next_steps) VALUES (?, ?, ?, ?, ?)',
+            (self.run_id, file_name, _timestamp(), changes, next_steps)
+        )
+
+    def finish_run(self, files_modified, loc_by_extension, minutes):
+        """Store the run's final counters; only finished runs count towards historical totals."""
+        for extension, loc in loc_by_extension.items():
+            self._submit(
+                'INSERT OR REPLACE INTO extension_loc (run_id, extension, loc) VALUES (?, ?, ?)',
+                (self.run_id, extension, loc)
+            )
+        self._submit(
+            'UPDATE runs SET finished_at = ?, files_modified = ?, loc_converted = ?, minutes = ? WHERE run_id = ?',
+            (_timestamp(), files_modified, sum(loc_by_extension.values()), round(minutes, 2), self.run_id)
+        )
+        self.flush()
+
+    def flush(self):
+        """Block until every queued write is committed, or the writer thread has stopped."""
+        writer = self._writer
+        if writer is None:
+            return
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks and writer.is_alive():
+                self._queue.all_tasks_done.wait(0.5)
+
+    def close(self):
+        """Commit outstanding writes and stop the writer thread."""
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._queue.put(_STOP)
+            writer.join()
+
+    def _query(self, sql, params=()):
+        self.flush()
+        connection = self._connect()
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def historical_totals(self):
+        """Return (files modified, LOC converted, minutes, {extension: LOC}) over all finished runs."""
+        files_modified, loc_converted, minutes = self._query(
+            'SELECT COALESCE(SUM(files_modified), 0), COALESCE(SUM(loc_converted), 0), COALESCE(SUM(minutes), 0) '
+            'FROM runs WHERE finished_at IS NOT NULL'
+        )[0]
+        loc_by_extension = dict(self._query(
+            'SELECT extension, SUM(loc) FROM extension_loc '
+            'WHERE run_id IN (SELECT run_id FROM runs WHERE finished_at IS NOT NULL) '
+            'GROUP BY extension ORDER BY extension'
+        ))
+        return files_modified, loc_converted, minutes, loc_by_extension
+
+    @staticmethod
+    def _write_csv(csv_path, rows):
+        # Written beside the target and swapped in, so readers never see a half-written file
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+        temp_path = f"{csv_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', newline='') as csvfile:
+            csv.writer(csvfile).writerows(rows)
+        os.replace(temp_path, csv_path)
+
+    def export_final_overview(self, csv_path):
+        """Write final_overview.csv (this run's details plus historical totals) in its established layout."""
+        try:
+            run = self._query(
+                'SELECT files_modified, loc_converted, minutes FROM runs WHERE run_id = ?', (self.run_id,)
+            )
+            files_modified, loc_converted, minutes = run[0] if run else (0, 0, 0)
+            run_extensions = self._query(
+                'SELECT extension, loc FROM extension_loc WHERE run_id = ? ORDER BY extension', (self.run_id,)
+            )
+            total_files, total_loc, total_minutes, total_extensions = self.historical_totals()
+
+            rows = [['Metric', 'Value'], [], ['=== Fresh Details (Last Run) ==='],
+                    ['Total Files Modified (Last run)', files_modified],
+                    ['Total LOC Converted (Last run)', loc_converted],
+                    ['Total Time (minutes) (Last run)', round(minutes, 2)]]
+            rows += [[f'.{extension} Files (Last run)', f"{loc} LOC"] for extension, loc in run_extensions]
+            rows += [[], ['=== Historical Overview ==='],
+                     ['Total Files Modified', total_files],
+                     ['Total LOC Converted', total_loc],
+                     ['Total Time (minutes)', round(total_minutes, 2)]]
+            rows += [[f'.{extension} Files', f"{loc} LOC"] for extension, loc in total_extensions.items()]
+            self._write_csv(csv_path, rows)
+            logging.info(f"Updated final overview at: {csv_path}")
+        except Exception as e:
+            logging.error(f"Failed to update final overview: {e}")
+
+    def export_modifications(self, csv_path):
+        """Write modification_overview.csv with every modification in the ledger, oldest first."""
+        try:
+            rows = self._query('SELECT file_name, modified_at, changes, next_steps FROM modifications ORDER BY id')
+            self._write_csv(csv_path, [MODIFICATION_FIELDS] + [list(row) for row in rows])
+            logging.info(f"Exported {len(rows)} modifications to: {csv_path}")
+        except Exception as e:
+            logging.error(f"Failed to export modifications: {e}")
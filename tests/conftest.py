@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The refiner's modules are scripts beside this directory rather than an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
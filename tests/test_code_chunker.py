@@ -0,0 +1,113 @@
+import ast
+
+from code_chunker import CodeChunks, split_into_chunks
+
+PYTHON_SOURCE = '''"""Module docstring."""
+import os
+from typing import List
+
+CONSTANT = 1
+
+
+def first():
+    return os.getcwd()
+
+
+@decorator
+def second(values: List[int]):
+    # Sum the values
+    return sum(values)
+
+
+class Third:
+    def method(self):
+        return CONSTANT
+'''
+
+JAVA_SOURCE = '''package demo;
+
+import java.util.List;
+
+public class Demo {
+    private int count = 0;
+
+    public int first() {
+        String brace = "}";
+        return count;
+    }
+
+    // A comment with a brace {
+    public int second(List<Integer> values) {
+        int total = 0;
+        for (int value : values) {
+            total += value;
+        }
+        return total;
+    }
+}
+'''
+
+
+def test_python_is_split_at_top_level_definitions():
+    chunks = split_into_chunks(PYTHON_SOURCE, '.py', max_chunk_chars=1)
+    assert chunks.header == '"""Module docstring."""\nimport os\nfrom typing import List\n'
+    assert len(chunks.chunks) == 4
+    assert chunks.chunks[2].lstrip().startswith('@decorator')
+    assert '# Sum the values' in chunks.chunks[2]
+    assert chunks.chunks[3].lstrip().startswith('class Third')
+
+
+def test_python_chunks_reassemble_to_the_original():
+    chunks = split_into_chunks(PYTHON_SOURCE, '.py', max_chunk_chars=1)
+    assert chunks.reassemble(chunks.chunks) == PYTHON_SOURCE
+
+
+def test_python_segments_are_grouped_up_to_the_size_limit():
+    chunks = split_into_chunks(PYTHON_SOURCE, '.py', max_chunk_chars=80)
+    assert 1 < len(chunks.chunks) < 4
+    assert chunks.reassemble(chunks.chunks) == PYTHON_SOURCE
+
+
+def test_refined_chunks_are_reassembled_in_order():
+    chunks = split_into_chunks(PYTHON_SOURCE, '.py', max_chunk_chars=1)
+    refined = [f'def refined_{index}():\n    pass' for index in range(len(chunks.chunks))]
+    reassembled = chunks.reassemble(refined)
+    assert reassembled.startswith(chunks.header)
+    names = [node.name for node in ast.parse(reassembled).body if isinstance(node, ast.FunctionDef)]
+    assert names == ['refined_0', 'refined_1', 'refined_2', 'refined_3']
+
+
+def test_brace_source_is_split_inside_its_class():
+    chunks = split_into_chunks(JAVA_SOURCE, '.java', max_chunk_chars=1)
+    assert chunks.header.startswith('package demo;\n\nimport java.util.List;\n\npublic class Demo {\n')
+    assert chunks.footer == '}\n'
+    assert len(chunks.chunks) == 3
+    assert 'public int first()' in chunks.chunks[1]
+    assert 'public int second' in chunks.chunks[2]
+    assert chunks.reassemble(chunks.chunks) == JAVA_SOURCE
+
+
+def test_braces_in_strings_and_comments_are_ignored():
+    chunks = split_into_chunks(JAVA_SOURCE, '.java', max_chunk_chars=1)
+    assert chunks.chunks[1].rstrip().endswith('}')
+    assert 'String brace = "}";' in chunks.chunks[1]
+
+
+def test_small_files_are_not_chunked():
+    assert split_into_chunks(PYTHON_SOURCE, '.py', max_chunk_chars=10000) is None
+    assert split_into_chunks(JAVA_SOURCE, '.java', max_chunk_chars=10000) is None
+
+
+def test_unparseable_or_unsupported_sources_are_not_chunked():
+    assert split_into_chunks('def broken(:\n    pass\n', '.py', max_chunk_chars=1) is None
+    assert split_into_chunks('class A {\n    void f() {\n}\n', '.java', max_chunk_chars=1) is None
+    assert split_into_chunks('fn main() {}\nfn other() {}\n', '.rs', max_chunk_chars=1) is None
+
+
+def test_extension_is_case_insensitive():
+    assert split_into_chunks(PYTHON_SOURCE, '.PY', max_chunk_chars=1) is not None
+
+
+def test_reassemble_terminates_chunks_with_newlines():
+    chunks = CodeChunks(header='import os\n', chunks=['a = 1', 'b = 2\n'], footer='')
+    assert chunks.reassemble(chunks.chunks) == 'import os\na = 1\nb = 2\n'
@@ -0,0 +1,123 @@
+import os
+
+import pytest
+
+import file_discovery
+from file_discovery import FileIndex, get_file_index, invalidate_file_index
+
+
+def write(root, relative_path, content=''):
+    path = os.path.join(root, *relative_path.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return path
+
+
+def relative_paths(index, root, extensions=None, excluded_files=()):
+    return sorted(os.path.relpath(path, root).replace(os.sep, '/') for path in index.find(extensions, excluded_files))
+
+
+@pytest.fixture(autouse=True)
+def fresh_index_cache():
+    invalidate_file_index()
+    yield
+    invalidate_file_index()
+
+
+def test_prunes_default_and_excluded_directories(tmp_path):
+    write(tmp_path, 'app/main.py')
+    write(tmp_path, 'node_modules/lib/index.js')
+    write(tmp_path, '.git/hooks/pre-commit.py')
+    write(tmp_path, 'GreenCode/app/main.py')
+    index = FileIndex(tmp_path, file_discovery.DEFAULT_PRUNED_DIRECTORIES | {'GreenCode'})
+    assert relative_paths(index, tmp_path) == ['app/main.py']
+
+
+def test_excluded_paths_prune_only_that_directory(tmp_path):
+    write(tmp_path, 'Result/report.py')
+    write(tmp_path, 'app/Result/model.py')
+    index = FileIndex(tmp_path, excluded_paths=[os.path.join(tmp_path, 'Result')])
+    assert relative_paths(index, tmp_path) == ['app/Result/model.py']
+
+
+def test_find_filters_extensions_and_excluded_names(tmp_path):
+    write(tmp_path, 'a.py')
+    write(tmp_path, 'b.java')
+    write(tmp_path, 'c.txt')
+    write(tmp_path, 'sub/setup.py')
+    index = FileIndex(tmp_path)
+    assert relative_paths(index, tmp_path, ['.py', '.java']) == ['a.py', 'b.java', 'sub/setup.py']
+    assert relative_paths(index, tmp_path, ['.py'], excluded_files=['setup.py']) == ['a.py']
+
+
+def test_gitignore_rules(tmp_path):
+    write(tmp_path, '.gitignore', '*.log\nbuild/\n/top.py\n!keep.log\n# comment\n')
+    write(tmp_path, 'app.log')
+    write(tmp_path, 'keep.log')
+    write(tmp_path, 'build/out.py')
+    write(tmp_path, 'top.py')
+    write(tmp_path, 'pkg/top.py')
+    write(tmp_path, 'pkg/build.py')
+    index = FileIndex(tmp_path)
+    assert relative_paths(index, tmp_path, ['.py', '.log']) == ['keep.log', 'pkg/build.py', 'pkg/top.py']
+
+
+def test_nested_gitignore_overrides_parent(tmp_path):
+    write(tmp_path, '.gitignore', '*.gen.py\n')
+    write(tmp_path, 'gen/.gitignore', '!*.gen.py\n')
+    write(tmp_path, 'a.gen.py')
+    write(tmp_path, 'gen/b.gen.py')
+    index = FileIndex(tmp_path)
+    assert relative_paths(index, tmp_path, ['.py']) == ['gen/b.gen.py']
+
+
+def test_gitignore_can_be_disabled(tmp_path):
+    write(tmp_path, '.gitignore', '*.py\n')
+    write(tmp_path, 'a.py')
+    assert relative_paths(FileIndex(tmp_path, use_gitignore=False), tmp_path, ['.py']) == ['a.py']
+
+
+def test_glob_to_regex():
+    assert file_discovery._glob_to_regex('**/cache').match('a/b/cache')
+    assert file_discovery._glob_to_regex('**/cache').match('cache')
+    assert file_discovery._glob_to_regex('docs/**').match('docs/a/b.md')
+    assert file_discovery._glob_to_regex('file?.[!c]s').match('file1.js')
+    assert not file_discovery._glob_to_regex('file?.[!c]s').match('file1.cs')
+    assert not file_discovery._glob_to_regex('*.py').match('pkg/a.py')
+
+
+def test_cached_listing_is_reused_while_directory_mtime_is_unchanged(tmp_path):
+    root = tmp_path / 'project'
+    write(root, 'a.py')
+    cache_path = os.path.join(tmp_path, 'cache', 'file_index.json')
+    old_mtime = os.stat(root).st_mtime - 60
+    os.utime(root, (old_mtime, old_mtime))
+    FileIndex(root, cache_path=cache_path)
+
+    # A file added with the directory mtime restored is invisible to the cached listing
+    write(root, 'b.py')
+    os.utime(root, (old_mtime, old_mtime))
+    assert relative_paths(FileIndex(root, cache_path=cache_path), root) == ['a.py']
+
+    os.utime(root, None)
+    assert relative_paths(FileIndex(root, cache_path=cache_path), root) == ['a.py', 'b.py']
+
+
+def test_get_file_index_is_built_once_per_root_and_exclusions(tmp_path):
+    write(tmp_path, 'a.py')
+    index = get_file_index(tmp_path, ['GreenCode'])
+    assert get_file_index(tmp_path, ['GreenCode']) is index
+    assert get_file_index(tmp_path, ['Result']) is not index
+
+    write(tmp_path, 'b.py')
+    assert relative_paths(get_file_index(tmp_path, ['GreenCode']), tmp_path) == ['a.py']
+    invalidate_file_index(tmp_path)
+    assert relative_paths(get_file_index(tmp_path, ['GreenCode']), tmp_path) == ['a.py', 'b.py']
+
+
+def test_refiner_modules_and_tests_are_never_offered():
+    tool_dir = os.path.dirname(file_discovery.TOOL_TESTS_DIRECTORY)
+    found = get_file_index(tool_dir).find(['.py'])
+    assert os.path.abspath(file_discovery.__file__) not in found
+    assert not any(path.startswith(file_discovery.TOOL_TESTS_DIRECTORY + os.sep) for path in found)
@@ -0,0 +1,163 @@
+import asyncio
+import time
+from email.utils import formatdate
+
+import httpx
+import pytest
+
+from rate_limiter import (
+    AsyncRateLimitedTransport, RateLimitedTransport, RateLimiter, _Bucket, estimate_request_tokens,
+    parse_reset_duration, parse_retry_after, retry_after_seconds, retry_count, start_retry_count
+)
+
+
+def scripted_transport(outcomes, requests=None):
+    """MockTransport answering each request with the next status code, or raising the next exception."""
+    outcomes = list(outcomes)
+
+    def handler(request):
+        if requests is not None:
+            requests.append(request)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return httpx.Response(outcome)
+
+    return httpx.MockTransport(handler)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after('-1') == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    assert 25 <= parse_retry_after(formatdate(time.time() + 30, usegmt=True)) <= 30
+
+
+def test_retry_after_ms_takes_precedence():
+    assert retry_after_seconds({'retry-after-ms': '1500', 'retry-after': '9'}) == 1.5
+    assert retry_after_seconds({'retry-after-ms': 'bad', 'retry-after': '9'}) == 9.0
+    assert retry_after_seconds({}) is None
+
+
+def test_parse_reset_duration():
+    assert parse_reset_duration('12') == 12.0
+    assert parse_reset_duration('6m0s') == 360.0
+    assert parse_reset_duration('1h2m3.5s') == 3723.5
+    assert parse_reset_duration('250ms') == 0.25
+    assert parse_reset_duration('later') is None
+    assert parse_reset_duration('') is None
+
+
+def test_bucket_admits_until_empty_then_reports_wait():
+    bucket = _Bucket(60)
+    assert bucket.wait_time(60) == 0.0
+    assert bucket.wait_time(1) == pytest.approx(1.0, abs=0.05)
+
+
+def test_bucket_admits_oversized_request_once_full():
+    bucket = _Bucket(10)
+    assert bucket.wait_time(1000) == 0.0
+    assert bucket.wait_time(1) > 0
+
+
+def test_token_wait_returns_the_request_slot():
+    limiter = RateLimiter(requests_per_minute=10, tokens_per_minute=100)
+    assert limiter._reserve(100) == 0.0
+    assert limiter._reserve(50) > 0
+    # The refused request did not keep a request slot
+    assert limiter.request_bucket.level == pytest.approx(9, abs=0.01)
+
+
+def test_throttled_response_pauses_every_caller():
+    limiter = RateLimiter()
+    assert limiter.update_from_headers({'retry-after': '30'}, 429) == 30.0
+    assert 29 < limiter._reserve(0) <= 30
+
+
+def test_retry_after_on_success_does_not_pause():
+    limiter = RateLimiter()
+    limiter.update_from_headers({'retry-after': '30'}, 200)
+    assert limiter._reserve(0) == 0.0
+
+
+def test_exhausted_rate_limit_headers_pause_until_reset():
+    limiter = RateLimiter()
+    limiter.update_from_headers({'x-ratelimit-remaining-tokens': '0', 'x-ratelimit-reset-tokens': '20s'}, 200)
+    assert 19 < limiter._reserve(0) <= 20
+
+
+def test_remaining_headers_lower_local_buckets():
+    limiter = RateLimiter(requests_per_minute=100)
+    limiter.update_from_headers({'x-ratelimit-remaining-requests': '3'}, 200)
+    assert limiter.request_bucket.level == 3
+
+
+def test_backoff_delay_is_bounded_and_honours_retry_after():
+    limiter = RateLimiter(base_backoff=1.0, max_backoff=4.0)
+    assert all(0 <= limiter.backoff_delay(attempt) <= 4.0 for attempt in range(10))
+    assert limiter.backoff_delay(0, retry_after=7) == 7
+
+
+def test_estimate_request_tokens_charges_json_posts_only():
+    post = httpx.Request('POST', 'https://example.test', json={'prompt': 'x' * 400})
+    assert estimate_request_tokens(post) > 100
+    assert estimate_request_tokens(httpx.Request('GET', 'https://example.test')) == 0
+    upload = httpx.Request('POST', 'https://example.test', files={'file': ('a.py', b'x' * 400)})
+    assert estimate_request_tokens(upload) == 0
+
+
+def test_transport_retries_throttling_transient_errors_and_connection_failures():
+    limiter = RateLimiter(max_retries=5, base_backoff=0)
+    transport = scripted_transport([429, httpx.ConnectError('refused'), 502, 200])
+    start_retry_count()
+    with httpx.Client(transport=RateLimitedTransport(limiter, transport)) as client:
+        assert client.post('https://example.test', json={}).status_code == 200
+    assert retry_count() == 3
+
+
+def test_transport_does_not_retry_client_errors():
+    requests = []
+    limiter = RateLimiter(max_retries=5, base_backoff=0)
+    transport = scripted_transport([400], requests)
+    with httpx.Client(transport=RateLimitedTransport(limiter, transport)) as client:
+        assert client.post('https://example.test', json={}).status_code == 400
+    assert len(requests) == 1
+
+
+def test_transport_returns_last_response_once_retries_are_spent():
+    limiter = RateLimiter(max_retries=2, base_backoff=0)
+    transport = scripted_transport([503, 503, 503])
+    with httpx.Client(transport=RateLimitedTransport(limiter, transport)) as client:
+        assert client.post('https://example.test', json={}).status_code == 503
+
+
+def test_transport_reraises_connection_failure_once_retries_are_spent():
+    limiter = RateLimiter(max_retries=1, base_backoff=0)
+    transport = scripted_transport([httpx.ConnectTimeout('slow'), httpx.ConnectTimeout('slow')])
+    with httpx.Client(transport=RateLimitedTransport(limiter, transport)) as client:
+        with pytest.raises(httpx.ConnectTimeout):
+            client.post('https://example.test', json={})
+
+
+def test_transport_does_not_limit_status_polls():
+    limiter = RateLimiter(requests_per_minute=1)
+    transport = scripted_transport([200, 200, 200])
+    with httpx.Client(transport=RateLimitedTransport(limiter, transport)) as client:
+        for _ in range(3):
+            client.get('https://example.test')
+    # The single request slot is still available for a POST
+    assert limiter._reserve(0) == 0.0
+
+
+def test_async_transport_retries():
+    limiter = RateLimiter(max_retries=5, base_backoff=0)
+    transport = scripted_transport([httpx.ReadTimeout('slow'), 429, 504, 200])
+
+    async def send():
+        start_retry_count()
+        async with httpx.AsyncClient(transport=AsyncRateLimitedTransport(limiter, transport)) as client:
+            response = await client.post('https://example.test', json={})
+        return response.status_code, retry_count()
+
+    assert asyncio.run(send()) == (200, 3)
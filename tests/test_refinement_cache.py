@@ -0,0 +1,130 @@
+import os
+import time
+
+import pytest
+
+from refinement_cache import RefinementCache
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return path
+
+
+def read(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def make_key(source):
+    return RefinementCache.make_key(source.encode('utf-8'), 'prompt', 'model', 'instructions')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return RefinementCache(str(tmp_path / 'cache'), max_size_mb=1)
+
+
+def test_key_depends_on_every_part():
+    key = RefinementCache.make_key(b'code', 'prompt', 'model', 'instructions')
+    assert key == RefinementCache.make_key(b'code', 'prompt', 'model', 'instructions')
+    assert key != RefinementCache.make_key(b'code2', 'prompt', 'model', 'instructions')
+    assert key != RefinementCache.make_key(b'code', 'prompt2', 'model', 'instructions')
+    assert key != RefinementCache.make_key(b'code', 'prompt', 'model2', 'instructions')
+    assert key != RefinementCache.make_key(b'code', 'prompt', 'model', None)
+
+
+def test_key_parts_are_length_prefixed():
+    assert RefinementCache.make_key(b'ab', 'c', '', '') != RefinementCache.make_key(b'a', 'bc', '', '')
+
+
+def test_put_then_restore(cache, tmp_path):
+    key = make_key('print(1)')
+    output = write(str(tmp_path / 'out' / 'a.py'), 'print(1)  # refined')
+    cache.put(key, output, 'changes', 'next steps')
+
+    target = str(tmp_path / 'restored' / 'nested' / 'a.py')
+    metadata = cache.restore(key, target)
+    assert read(target) == 'print(1)  # refined'
+    assert metadata['changes'] == 'changes'
+    assert metadata['next_steps'] == 'next steps'
+    assert metadata['summaries'] is None
+
+
+def test_fused_summaries_round_trip(cache, tmp_path):
+    key = make_key('x = 1')
+    output = write(str(tmp_path / 'a.py'), 'x = 1')
+    summaries = [('[Prompt 1] a', 'n1'), ('[Prompt 2] b', 'n2')]
+    cache.put(key, output, *summaries[0], summaries=summaries)
+    assert cache.restore(key, str(tmp_path / 'b.py'))['summaries'] == [list(summary) for summary in summaries]
+
+
+def test_restore_miss_returns_none(cache, tmp_path):
+    assert cache.restore(make_key('missing'), str(tmp_path / 'a.py')) is None
+    assert not os.path.exists(tmp_path / 'a.py')
+
+
+def test_put_keeps_the_first_entry_for_a_key(cache, tmp_path):
+    key = make_key('y = 2')
+    cache.put(key, write(str(tmp_path / 'first.py'), 'first'), 'c', 'n')
+    cache.put(key, write(str(tmp_path / 'second.py'), 'second'), 'c', 'n')
+    cache.restore(key, str(tmp_path / 'restored.py'))
+    assert read(tmp_path / 'restored.py') == 'first'
+
+
+def test_discard_removes_entry(cache, tmp_path):
+    key = make_key('z = 3')
+    cache.put(key, write(str(tmp_path / 'a.py'), 'z = 3'), 'c', 'n')
+    cache.discard(key)
+    assert cache.restore(key, str(tmp_path / 'b.py')) is None
+
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = RefinementCache(str(tmp_path / 'cache'), max_size_mb=0)
+    key = make_key('a')
+    cache.put(key, write(str(tmp_path / 'a.py'), 'a'), 'c', 'n')
+    assert not os.path.exists(tmp_path / 'cache')
+    assert cache.restore(key, str(tmp_path / 'b.py')) is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = RefinementCache(str(tmp_path / 'cache'), max_size_mb=1)
+    payload = 'x' * (300 * 1024)
+    keys = [make_key(f'source {index}') for index in range(4)]
+    for age, key in enumerate(keys[:3]):
+        cache.put(key, write(str(tmp_path / f'{age}.py'), payload), 'c', 'n')
+        # Spread the last-used times so the eviction order is deterministic
+        meta_path = os.path.join(cache._entry_dir(key), RefinementCache.METADATA_NAME)
+        os.utime(meta_path, (time.time() - 100 + age, time.time() - 100 + age))
+
+    # Restoring the oldest entry makes it the most recently used
+    cache.restore(keys[0], str(tmp_path / 'restored.py'))
+    cache.put(keys[3], write(str(tmp_path / '3.py'), payload), 'c', 'n')
+
+    assert cache.restore(keys[1], str(tmp_path / 'evicted.py')) is None
+    for key in (keys[0], keys[2], keys[3]):
+        assert cache.restore(key, str(tmp_path / 'kept.py')) is not None
+
+
+def test_staging_directories_are_not_listed_and_stale_ones_are_removed(cache, tmp_path):
+    cache.put(make_key('a'), write(str(tmp_path / 'a.py'), 'a'), 'c', 'n')
+    fresh = os.path.join(cache.cache_dir, 'ab', 'ab' + '0' * 62 + '.1.2.tmp')
+    stale = os.path.join(cache.cache_dir, 'cd', 'cd' + '0' * 62 + '.1.2.tmp')
+    write(os.path.join(fresh, RefinementCache.OUTPUT_NAME), 'partial')
+    write(os.path.join(stale, RefinementCache.OUTPUT_NAME), 'abandoned')
+    old = time.time() - RefinementCache.STALE_STAGING_SECONDS - 10
+    os.utime(stale, (old, old))
+
+    assert len(cache._entries()) == 1
+    assert os.path.isdir(fresh)
+    assert not os.path.exists(stale)
+
+
+def test_incomplete_entries_are_removed(cache, tmp_path):
+    key = make_key('b')
+    cache.put(key, write(str(tmp_path / 'b.py'), 'b'), 'c', 'n')
+    os.remove(os.path.join(cache._entry_dir(key), RefinementCache.OUTPUT_NAME))
+    assert cache._entries() == []
+    assert not os.path.exists(cache._entry_dir(key))
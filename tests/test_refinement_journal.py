@@ -0,0 +1,105 @@
+import json
+import os
+
+import pytest
+
+from refinement_journal import STAGE_REFINED, STAGE_REFINED_TESTS, STAGE_SOURCE_TESTS, RefinementJournal
+
+
+class RecordingTracker:
+    """Collects the files a skipped stage re-applies, like MetricsTracker.add_tracked."""
+
+    def __init__(self):
+        self.tracked = []
+
+    def add_tracked(self, tracked):
+        self.tracked.extend(tracked)
+
+
+@pytest.fixture
+def project(tmp_path):
+    source = tmp_path / 'app.py'
+    source.write_text('print(1)\n', encoding='utf-8')
+    return tmp_path, str(source), str(tmp_path / 'Result' / 'refinement_journal.jsonl')
+
+
+def test_new_journal_is_not_resuming(project):
+    root, _, journal_path = project
+    journal = RefinementJournal(journal_path, str(root))
+    assert not journal.resuming
+    assert journal.previous_seconds == 0
+
+
+def test_completed_stage_is_skipped_after_restart(project):
+    root, source, journal_path = project
+    journal = RefinementJournal(journal_path, str(root))
+    journal.start_run()
+    journal.mark_done(source, STAGE_REFINED, [('GreenCode/app.py', 'py', 1)])
+
+    restarted = RefinementJournal(journal_path, str(root))
+    tracker = RecordingTracker()
+    assert restarted.resuming
+    assert restarted.skip_if_done(source, STAGE_REFINED, tracker)
+    assert tracker.tracked == [['GreenCode/app.py', 'py', 1]]
+    assert not restarted.skip_if_done(source, STAGE_SOURCE_TESTS, tracker)
+
+
+def test_edited_source_is_processed_again(project):
+    root, source, journal_path = project
+    RefinementJournal(journal_path, str(root)).mark_done(source, STAGE_REFINED, [])
+    with open(source, 'a', encoding='utf-8') as f:
+        f.write('print(2)\n')
+    assert RefinementJournal(journal_path, str(root)).completed_entry(source, STAGE_REFINED) is None
+
+
+def test_new_refinement_makes_refined_tests_stale(project):
+    root, source, journal_path = project
+    journal = RefinementJournal(journal_path, str(root))
+    journal.mark_done(source, STAGE_REFINED, [])
+    journal.mark_done(source, STAGE_REFINED_TESTS, [])
+    journal.mark_done(source, STAGE_REFINED, [])
+    assert journal.completed_entry(source, STAGE_REFINED_TESTS) is None
+
+    restarted = RefinementJournal(journal_path, str(root))
+    assert restarted.completed_entry(source, STAGE_REFINED) is not None
+    assert restarted.completed_entry(source, STAGE_REFINED_TESTS) is None
+
+
+def test_truncated_last_line_is_ignored_and_terminated(project):
+    root, source, journal_path = project
+    RefinementJournal(journal_path, str(root)).mark_done(source, STAGE_SOURCE_TESTS, [])
+    with open(journal_path, 'a', encoding='utf-8') as f:
+        f.write('{"file": "app.py", "sta')
+
+    journal = RefinementJournal(journal_path, str(root))
+    assert journal.completed_entry(source, STAGE_SOURCE_TESTS) is not None
+    journal.mark_done(source, STAGE_REFINED, [])
+
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert json.loads(lines[-1])['stage'] == STAGE_REFINED
+    assert RefinementJournal(journal_path, str(root)).completed_entry(source, STAGE_REFINED) is not None
+
+
+def test_previous_seconds_sums_interrupted_attempts(project):
+    root, _, journal_path = project
+    os.makedirs(os.path.dirname(journal_path))
+    entries = [
+        {'event': 'run_started', 'time': 100.0},
+        {'file': 'app.py', 'stage': STAGE_SOURCE_TESTS, 'source_hash': 'x', 'tracked': [], 'time': 130.0},
+        {'event': 'run_started', 'time': 500.0},
+        {'file': 'app.py', 'stage': STAGE_REFINED, 'source_hash': 'x', 'tracked': [], 'time': 510.0},
+    ]
+    with open(journal_path, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(entry) + '\n' for entry in entries)
+    assert RefinementJournal(journal_path, str(root)).previous_seconds == pytest.approx(40.0)
+
+
+def test_complete_removes_the_journal(project):
+    root, source, journal_path = project
+    journal = RefinementJournal(journal_path, str(root))
+    journal.mark_done(source, STAGE_REFINED, [])
+    journal.complete()
+    assert not os.path.exists(journal_path)
+    assert not journal.resuming
+    journal.complete()
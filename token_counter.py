@@ -0,0 +1,29 @@
+import logging
+
+from rate_limiter import ESTIMATED_BYTES_PER_TOKEN
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+class Tokenizer:
+    """Counts tokens with tiktoken when installed, otherwise estimates them from the byte size."""
+
+    def __init__(self, encoding_name='cl100k_base'):
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.get_encoding(encoding_name)
+            except Exception as e:
+                logging.warning(f"tiktoken encoding {encoding_name} unavailable, estimating tokens from size: {e}")
+
+    @property
+    def exact(self):
+        return self.encoding is not None
+
+    def count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return len(text.encode('utf-8')) // ESTIMATED_BYTES_PER_TOKEN + 1
@@ -22,6 +22,9 @@ warnings.filterwarnings("ignore", category=FutureWarning, module="codecarbon")
 # Handle the nvml error 
 from pynvml import nvmlInit, nvmlShutdown, NVMLError
 
+# Local imports
+from file_discovery import get_file_index
+
 
 # Load environment variables
 env_path = os.path.abspath(".env")
@@ -30,6 +33,7 @@ SOURCE_DIRECTORY = os.path.dirname(env_path)
 
 GREEN_REFINED_DIRECTORY = os.path.join(SOURCE_DIRECTORY, "GreenCode")
 RESULT_DIR = os.path.join(SOURCE_DIRECTORY, "Result")
+FILE_INDEX_CACHE = os.path.join(SOURCE_DIRECTORY, ".greencode_cache", "file_index.json")
 REPORT_DIR = os.path.join(SOURCE_DIRECTORY, "Report")
 
 # List of files and directories to exclude from processing
@@ -179,27 +183,16 @@ def process_emissions_for_file(tracker, script_path, emissions_csv, file_type, r
             logging.error(f"Error writing data for {script_name}: {e}")
 
 def process_files_by_type(base_dir, emissions_data_csv, result_dir, file_extension, excluded_files, excluded_dirs, tracker, test_command_generator):
+    # For SOURCE_DIRECTORY, exclude files in GREEN_REFINED_DIRECTORY; one index serves every language
+    excluded_paths = (GREEN_REFINED_DIRECTORY,) if base_dir == SOURCE_DIRECTORY else ()
+    index = get_file_index(base_dir, excluded_dirs, excluded_paths, cache_path=FILE_INDEX_CACHE)
+
     files = []
-    for root, dirs, file_list in os.walk(base_dir):
-        # Exclude specified directories
-        dirs[:] = [d for d in dirs if d not in excluded_dirs]
-
-        # Additional check to ensure we're only processing files in the correct directory
-        if base_dir == SOURCE_DIRECTORY:
-            # For SOURCE_DIRECTORY, exclude files in GREEN_REFINED_DIRECTORY
-            file_list = [f for f in file_list if GREEN_REFINED_DIRECTORY not in root]
-        elif base_dir == GREEN_REFINED_DIRECTORY:
-            # For GREEN_REFINED_DIRECTORY, only process files within this directory
-            file_list = [f for f in file_list if GREEN_REFINED_DIRECTORY in root]
-
-        for script in file_list:
-            if (script.endswith(file_extension) and 
-                script not in excluded_files and 
-                is_test_file(os.path.join(root, script))):  # Only add test files
-                script_path = os.path.join(root, script)
-                test_command = test_command_generator(script_path)
-                if test_command:
-                    files.append((script_path, test_command))
+    for script_path in index.find({file_extension}, excluded_files):
+        if is_test_file(script_path):  # Only add test files
+            test_command = test_command_generator(script_path)
+            if test_command:
+                files.append((script_path, test_command))
     
     # Process test files
     for script_path, test_command in files: